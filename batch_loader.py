@@ -0,0 +1,133 @@
+import time
+import threading
+import numpy as np
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+
+class BatchLoader(object):
+    def __init__(self, idxs, batch_size, buffer_specs, fill_batch, num_workers=4, max_queue_size=10):
+        '''
+        Multi-worker, prefetching replacement for a @threadsafe_generator.
+
+        Every epoch the idxs are permuted and cut into batches; worker w assembles
+        batches w, w+num_workers, w+2*num_workers, ... so the workers never share
+        a lock while building a batch. Batches are written into a fixed pool of
+        preallocated buffers ("slots") which are recycled once the consumer asks
+        for the next batch, so at most max_queue_size finished batches wait in
+        memory at any time.
+
+        Pass it to fit_generator with workers=0: the loader already does the prefetching,
+        and the buffer of a batch is reused as soon as the next one is requested.
+
+        idxs: dataset indices to iterate over
+        batch_size: positive int
+        buffer_specs: list of (shape, dtype), one per buffer, shape without the batch axis
+        fill_batch: fill_batch(batch_idxs, *buffers) writes the batch into buffers
+                    (views of length len(batch_idxs)) and returns what to yield
+        num_workers: number of threads assembling batches
+        max_queue_size: number of finished batches that may wait for the consumer
+        '''
+        self.idxs = np.array(idxs)
+        self.batch_size = batch_size
+        self.steps = int(np.ceil(len(self.idxs)/float(batch_size)))
+        self.fill_batch = fill_batch
+        self.num_workers = num_workers
+        self.seed = np.random.randint(2**31)
+
+        num_slots = max_queue_size + num_workers + 1
+        self.slots = [[np.empty((batch_size,) + tuple(shape), dtype=dtype) for shape, dtype in buffer_specs] for _ in range(num_slots)]
+        self.free = queue.Queue()
+        for slot in range(num_slots): self.free.put(slot)
+        self.ready = queue.Queue()
+        self.in_use = None
+
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.consumer_wait = 0.
+        self.worker_wait = 0.
+        self.start_time = time.time()
+        self.stop_time = None
+        self.workers = [threading.Thread(target=self.work, args=(w,)) for w in range(num_workers)]
+        for worker in self.workers:
+            worker.daemon = True
+            worker.start()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.in_use is not None:
+            # the consumer is done with the previous batch
+            self.free.put(self.in_use)
+            self.in_use = None
+
+        tic = time.time()
+        slot, output = self.ready.get()
+        self.consumer_wait += time.time() - tic
+        if isinstance(output, Exception):
+            self.close()
+            raise output
+
+        self.in_use = slot
+        self.batches += 1
+        return output
+
+    __next__ = next
+
+    def work(self, worker_id):
+        epoch = 0
+        while not self.stop_event.is_set():
+            perm = np.random.RandomState(self.seed + epoch).permutation(self.idxs)
+            for step in range(worker_id, self.steps, self.num_workers):
+                slot = self.get_free_slot()
+                if slot is None: return
+                batch_idxs = perm[(step*self.batch_size):((step+1)*self.batch_size)]
+                buffers = [buf[:len(batch_idxs)] for buf in self.slots[slot]]
+                try:
+                    output = self.fill_batch(batch_idxs, *buffers)
+                except Exception as e:
+                    self.ready.put((slot, e))
+                    return
+                self.ready.put((slot, output))
+            epoch += 1
+
+    def get_free_slot(self):
+        tic = time.time()
+        while not self.stop_event.is_set():
+            try:
+                slot = self.free.get(timeout=.1)
+            except queue.Empty:
+                continue
+            with self.lock:
+                self.worker_wait += time.time() - tic
+            return slot
+        return None
+
+    def close(self):
+        if self.stop_time is None: self.stop_time = time.time()
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join()
+
+    def stats(self):
+        '''
+        batches_per_sec: batches handed to the consumer per second
+        input_wait: fraction of the time the consumer (the GPU) waited on the loader
+        worker_idle: fraction of worker time spent waiting for a free buffer, i.e. the loader is ahead
+        '''
+        elapsed = max((self.stop_time or time.time()) - self.start_time, 1e-8)
+        return {'batches': self.batches,
+                'batches_per_sec': self.batches / elapsed,
+                'input_wait': self.consumer_wait / elapsed,
+                'worker_idle': self.worker_wait / (elapsed * self.num_workers)}
+
+    @staticmethod
+    def summarize(all_stats):
+        return 'Loader: %.1f batches/s. Input wait: %.1f%%. Worker idle: %.1f%%' % (
+            np.mean([s['batches_per_sec'] for s in all_stats]),
+            100*np.mean([s['input_wait'] for s in all_stats]),
+            100*np.mean([s['worker_idle'] for s in all_stats]))
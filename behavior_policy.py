@@ -0,0 +1,103 @@
+import numpy as np
+
+
+def hash_states(x, seed=0, chunk=4096):
+    '''
+    One uint64 per state (row of x), e.g. for frames: sum_j w_j * m_j mod 2^64 over the raw
+    bits w_j of the state's values (floats are not rounded) with random odd multipliers m_j.
+    States with the same bytes get the same hash. Different states collide only with small
+    probability, which is not zero
+    '''
+    x = np.ascontiguousarray(x)
+    x = x.reshape(len(x), -1)
+    if x.dtype.itemsize in [1, 2, 4, 8]:
+        words = x.view('u%s' % x.dtype.itemsize)
+    else:
+        words = x.view(np.uint8)
+    multipliers = np.random.RandomState(seed).randint(0, 2**62, size=words.shape[1]).astype(np.uint64)*np.uint64(2) + np.uint64(1)
+    hashes = np.empty(len(x), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for start in range(0, len(x), chunk):
+            hashes[start:(start+chunk)] = (words[start:(start+chunk)].astype(np.uint64)*multipliers).sum(axis=1, dtype=np.uint64)
+    return hashes
+
+
+class BehaviorPolicy(object):
+    def __init__(self, action_space_dim, hashed=False, classifier=None):
+        '''
+        pi_old(a|x) estimated from the dataset, for off policy estimators that do not know pi_old.
+
+        Discrete states: a (states, actions) count table built in one bincount pass,
+        pi_old(a|x) is the frequency of a among the visits of x. States not in the
+        dataset get the uniform distribution.
+
+        action_space_dim: number of actions
+        hashed: states are arrays (e.g. frames), keyed by hash_states
+        classifier: a learned model of pi_old instead of the table. Needs fit(x, a) and
+                    predict_proba(x) -> (len(x), action_space_dim)
+        '''
+        self.action_space_dim = action_space_dim
+        self.hashed = hashed
+        self.classifier = classifier
+        self.states = None
+        self.table = None
+
+    @classmethod
+    def of_dataset(cls, dataset, action_space_dim, **kw):
+        '''
+        The BehaviorPolicy fit on dataset['x'], dataset['a'], built once and cached on the dataset
+        (refit if either is replaced)
+        '''
+        x, a = dataset['x'], dataset['a']
+        cache = getattr(dataset, 'behavior_policies', None)
+        if cache is None:
+            cache = dataset.behavior_policies = []
+        key = (action_space_dim, kw.get('hashed', False), id(kw.get('classifier')))
+        for x_, a_, key_, policy in cache:
+            if (x_ is x) and (a_ is a) and (key_ == key):
+                return policy
+
+        policy = cls(action_space_dim, **kw).fit(x, a)
+        cache[:] = [entry for entry in cache if (entry[0] is x) and (entry[1] is a)] + [(x, a, key, policy)]
+        return policy
+
+    def keys(self, x):
+        x = np.asarray(x)
+        if self.hashed: return hash_states(x)
+        assert x.size == len(x), 'One number per state, or use hashed=True'
+        return x.reshape(-1)
+
+    def fit(self, x, a):
+        a = np.asarray(a).reshape(-1).astype(int)
+        if self.classifier is not None:
+            self.classifier.fit(x, a)
+            return self
+
+        self.states, state = np.unique(self.keys(x), return_inverse=True)
+        counts = np.bincount(state.reshape(-1)*self.action_space_dim + a, minlength=len(self.states)*self.action_space_dim)
+        counts = counts.reshape(len(self.states), self.action_space_dim).astype(float)
+        self.table = counts / counts.sum(axis=1, keepdims=True)
+        return self
+
+    def all_actions(self, x):
+        '''
+        pi_old(.|x), (len(x), action_space_dim)
+        '''
+        if self.classifier is not None:
+            return np.asarray(self.classifier.predict_proba(x))
+
+        keys = self.keys(x)
+        probabilities = np.full((len(keys), self.action_space_dim), 1./self.action_space_dim)
+        if len(self.states) == 0:
+            return probabilities
+        idx = np.minimum(np.searchsorted(self.states, keys), len(self.states) - 1)
+        seen = self.states[idx] == keys
+        probabilities[seen] = self.table[idx[seen]]
+        return probabilities
+
+    def __call__(self, x, a):
+        '''
+        pi_old(a_i|x_i) for every i
+        '''
+        a = np.asarray(a).reshape(-1).astype(int)
+        return self.all_actions(x)[np.arange(len(a)), a]
@@ -1,16 +1,33 @@
+import os
+import hashlib
 import gym
 import numpy as np
 from numpy.linalg import norm
 from gym.envs.box2d.car_racing import *
 from gym.envs.box2d.car_dynamics import ENGINE_POWER
+from gym.envs.box2d.car_dynamics import WHEEL_W, WHEEL_R, WHEEL_WHITE, SIZE
+from track_index import TrackIndex
+from software_renderer import SoftwareRasterizer, gl_color
 # from gym.envs.classic_control.rendering import Geom, _add_attrs
 # from pyglet.gl import *
 
+TRACK_CACHE_VERSION = 1 # bump when _generate_track or the cached geometry changes
+
 
 class ExtendedCarRacing(CarRacing):
-    def __init__(self, init_seed, stochastic, max_pos_costs):
+    def __init__(self, init_seed, stochastic, max_pos_costs, track_cache_dir=None, software_render=False):
+        '''
+        track_cache_dir: where to save/load the geometry of the deterministic track,
+                         so other processes skip generating it. None keeps it in memory only
+        software_render: draw the state pixels with numpy instead of GL. No window or X server
+                         is needed and render('human') does nothing (render_human=True still uses GL)
+        '''
         super(ExtendedCarRacing, self).__init__()
+        self.software_render = software_render
+        self.rasterizer = None
         self.deterministic = not stochastic
+        self.track_cache_dir = track_cache_dir
+        self.track_geometry = None
         self.init_seed = init_seed
         self.seed(init_seed)
         self.max_pos_costs = max_pos_costs
@@ -38,6 +55,30 @@ class ExtendedCarRacing(CarRacing):
         return (self.pos_cost_counter > self.max_pos_costs), punish
 
     def _create_track(self):
+        '''
+        Deterministic tracks are generated once: the geometry is kept (and saved to
+        track_cache_dir) and only the Box2D tiles are recreated on reset
+        '''
+        if not self.deterministic:
+            geometry = self._generate_track()
+        else:
+            if self.track_geometry is None:
+                self.track_geometry = self.load_track_geometry()
+            if self.track_geometry is None:
+                geometry = self._generate_track()
+                if geometry is not None:
+                    self.track_geometry = geometry
+                    self.save_track_geometry()
+            geometry = self.track_geometry
+
+        if geometry is None: return False
+        self._build_track(geometry)
+        return True
+
+    def _generate_track(self):
+        '''
+        Returns the track and its polygons as arrays, None if it failed
+        '''
         CHECKPOINTS = 12
 
         # Create checkpoints
@@ -127,7 +168,7 @@ class ExtendedCarRacing(CarRacing):
         i = len(track)
         while True:
             i -= 1
-            if i==0: return False  # Failed
+            if i==0: return None  # Failed
             pass_through_start = track[i][0] > self.start_alpha and track[i-1][0] <= self.start_alpha
             if pass_through_start and i2==-1:
                 i2 = i
@@ -148,7 +189,7 @@ class ExtendedCarRacing(CarRacing):
             np.square( first_perp_x*(track[0][2] - track[-1][2]) ) +
             np.square( first_perp_y*(track[0][3] - track[-1][3]) ))
         if well_glued_together > TRACK_DETAIL_STEP:
-            return False
+            return None
 
         # Red-white border on hard turns
         border = [False]*len(track)
@@ -166,7 +207,8 @@ class ExtendedCarRacing(CarRacing):
             for neg in range(BORDER_MIN_COUNT):
                 border[i-neg] |= border[i]
 
-        # Create tiles
+        # Tiles and red-white border polygons, in drawing order
+        polygons, colors, is_tile = [], [], []
         for i in range(len(track)):
             alpha1, beta1, x1, y1 = track[i]
             alpha2, beta2, x2, y2 = track[i-1]
@@ -174,26 +216,83 @@ class ExtendedCarRacing(CarRacing):
             road1_r = (x1 + TRACK_WIDTH*math.cos(beta1), y1 + TRACK_WIDTH*math.sin(beta1))
             road2_l = (x2 - TRACK_WIDTH*math.cos(beta2), y2 - TRACK_WIDTH*math.sin(beta2))
             road2_r = (x2 + TRACK_WIDTH*math.cos(beta2), y2 + TRACK_WIDTH*math.sin(beta2))
-            t = self.world.CreateStaticBody( fixtures = fixtureDef(
-                shape=polygonShape(vertices=[road1_l, road1_r, road2_r, road2_l])
-                ))
-            t.userData = t
             c = 0.01*(i%3)
-            t.color = [ROAD_COLOR[0] + c, ROAD_COLOR[1] + c, ROAD_COLOR[2] + c]
-            t.road_visited = False
-            t.road_friction = 1.0
-            t.fixtures[0].sensor = True
-            self.road_poly.append(( [road1_l, road1_r, road2_r, road2_l], t.color ))
-            self.road.append(t)
+            polygons.append([road1_l, road1_r, road2_r, road2_l])
+            colors.append([ROAD_COLOR[0] + c, ROAD_COLOR[1] + c, ROAD_COLOR[2] + c])
+            is_tile.append(True)
             if border[i]:
                 side = np.sign(beta2 - beta1)
                 b1_l = (x1 + side* TRACK_WIDTH        *math.cos(beta1), y1 + side* TRACK_WIDTH        *math.sin(beta1))
                 b1_r = (x1 + side*(TRACK_WIDTH+BORDER)*math.cos(beta1), y1 + side*(TRACK_WIDTH+BORDER)*math.sin(beta1))
                 b2_l = (x2 + side* TRACK_WIDTH        *math.cos(beta2), y2 + side* TRACK_WIDTH        *math.sin(beta2))
                 b2_r = (x2 + side*(TRACK_WIDTH+BORDER)*math.cos(beta2), y2 + side*(TRACK_WIDTH+BORDER)*math.sin(beta2))
-                self.road_poly.append(( [b1_l, b1_r, b2_r, b2_l], (1,1,1) if i%2==0 else (1,0,0) ))
-        self.track = track
-        return True
+                polygons.append([b1_l, b1_r, b2_r, b2_l])
+                colors.append((1,1,1) if i%2==0 else (1,0,0))
+                is_tile.append(False)
+
+        track_index = TrackIndex(track, PLAYFIELD)
+        return {'track': np.array(track),
+                'polygons': np.array(polygons),
+                'colors': np.array(colors, dtype=float),
+                'is_tile': np.array(is_tile),
+                'index_offsets': track_index.offsets,
+                'index_segments': track_index.segments,
+                'index_extent': track_index.extent,
+                'index_cell_size': track_index.cell_size}
+
+    def _build_track(self, geometry):
+        self.road = []
+        for vertices, color, is_tile in zip(geometry['polygons'], geometry['colors'], geometry['is_tile']):
+            vertices = [tuple(v) for v in vertices]
+            color = list(color) if is_tile else tuple(color)
+            if is_tile:
+                t = self.world.CreateStaticBody( fixtures = fixtureDef(
+                    shape=polygonShape(vertices=vertices)
+                    ))
+                t.userData = t
+                t.color = color
+                t.road_visited = False
+                t.road_friction = 1.0
+                t.fixtures[0].sensor = True
+                self.road.append(t)
+            self.road_poly.append(( vertices, color ))
+        self.road_poly_array = np.array(geometry['polygons'], dtype=float)
+        self.road_poly_colors = gl_color(geometry['colors'])
+        self.track = [tuple(x) for x in geometry['track']]
+        self.track_index = TrackIndex(self.track, PLAYFIELD, cell_size=geometry['index_cell_size'], offsets=geometry['index_offsets'], segments=geometry['index_segments'])
+
+    def track_cache_path(self):
+        '''
+        track_seed_<init_seed>_v<TRACK_CACHE_VERSION>_<hash of the track constants>.npz, so a
+        cache of another track generator is never loaded
+        '''
+        params = (TRACK_DETAIL_STEP, TRACK_TURN_RATE, TRACK_WIDTH, TRACK_RAD, BORDER, BORDER_MIN_COUNT, SCALE, PLAYFIELD)
+        key = hashlib.sha1(repr(params).encode('utf-8')).hexdigest()[:12]
+        return os.path.join(self.track_cache_dir, 'track_seed_%s_v%s_%s.npz' % (self.init_seed, TRACK_CACHE_VERSION, key))
+
+    def load_track_geometry(self):
+        '''
+        The cached geometry, None if there is none or its TrackIndex grid was built for another extent
+        '''
+        if (self.track_cache_dir is None) or not os.path.isfile(self.track_cache_path()):
+            return None
+        with np.load(self.track_cache_path()) as f:
+            geometry = dict((key, f[key]) for key in f.files)
+        if ('index_extent' not in geometry) or ('index_cell_size' not in geometry) or (float(geometry['index_extent']) != float(PLAYFIELD)):
+            return None
+        return geometry
+
+    def save_track_geometry(self):
+        if self.track_cache_dir is None: return
+        if not os.path.exists(self.track_cache_dir):
+            try:
+                os.makedirs(self.track_cache_dir)
+            except OSError:
+                pass # another process made it
+        # write then rename, other processes never see half a file
+        tmp_path = self.track_cache_path() + '.%s.tmp.npz' % os.getpid()
+        np.savez(tmp_path, **self.track_geometry)
+        os.rename(tmp_path, self.track_cache_path())
 
     def reset(self):
         self._destroy()
@@ -252,22 +351,8 @@ class ExtendedCarRacing(CarRacing):
         done = False
         if action is not None: # First step without action, called from reset()
             # Distance to center of track
-            distances_arr = MinList()
-            
             p0 = np.array([self.car.hull.position.x,self.car.hull.position.y])
-            for idx in range(len(self.track)):
-                alpha1, beta1, x2, y2 = self.track[idx]
-                alpha2, beta2, x1, y1 = self.track[idx-1]
-
-                # self.viewer.draw_line((x1,y1),(x2,y2), color=(0,1,0))
-                p1 = np.array([x1,y1])
-                p2 = np.array([x2,y2])
-                
-                if norm(p2-p0) <= distances_arr.get_min()[0] + 10:
-                    distance, point = self.distance_from_segment_to_point(p1,p2,p0)
-                    distances_arr.append(distance, point)
-            
-            distance_to_track, self.closest_track_point_to_hull = distances_arr.get_min()
+            distance_to_track, self.closest_track_point_to_hull = self.track_index.nearest(p0)
 
             # Acceleration
             acc_x = (self.prev_velocity_x - self.car.hull.linearVelocity[0])/dt
@@ -333,6 +418,12 @@ class ExtendedCarRacing(CarRacing):
         return norm(np.cross(A-B, A-P))/norm(B-A), projection
 
     def render(self, mode='human', render_human=False):
+        if self.software_render:
+            if mode == 'state_pixels':
+                return self.render_state_pixels()
+            if (mode == 'human') and not render_human:
+                return None
+
         if self.viewer is None:
             from gym.envs.classic_control import rendering
             self.viewer = rendering.Viewer(WINDOW_W, WINDOW_H)
@@ -474,6 +565,93 @@ class ExtendedCarRacing(CarRacing):
         return arr
 
 
+    def render_state_pixels(self):
+        '''
+        render('state_pixels') in numpy: the grass, road, car and indicators
+        rasterized straight into a STATE_W x STATE_H buffer. The score label is drawn with
+        seven segment digits (score_polygons), the same few pixels as pyglet's text at this size
+        '''
+        if self.rasterizer is None:
+            self.rasterizer = SoftwareRasterizer(STATE_W, STATE_H)
+            self.grass_polygons, self.grass_colors = grass_polygons()
+
+        if "t" not in self.__dict__: return  # reset() not called yet
+
+        # same transform as render(), then the window -> viewport scaling GL does
+        zoom = 0.1*SCALE*max(1-self.t, 0) + ZOOM*SCALE*min(self.t, 1)
+        scroll_x = self.car.hull.position[0]
+        scroll_y = self.car.hull.position[1]
+        angle = -self.car.hull.angle
+        vel = self.car.hull.linearVelocity
+        if np.linalg.norm(vel) > 0.5:
+            angle = math.atan2(vel[0], vel[1])
+        cos, sin = math.cos(angle), math.sin(angle)
+        translation = np.array([WINDOW_W/2 - (scroll_x*zoom*cos - scroll_y*zoom*sin),
+                                WINDOW_H/4 - (scroll_x*zoom*sin + scroll_y*zoom*cos)])
+        window_to_state = np.array([STATE_W/float(WINDOW_W), STATE_H/float(WINDOW_H)])
+        rotation = zoom*np.array([[cos, -sin], [sin, cos]])
+        to_state = lambda points: (np.dot(points, rotation.T) + translation)*window_to_state
+
+        polygons, colors = [], []
+
+        # render_road
+        for road_polygons, road_colors in [(self.grass_polygons, self.grass_colors), (self.road_poly_array, self.road_poly_colors)]:
+            road_polygons = to_state(road_polygons)
+            visible = ((road_polygons[...,0].max(axis=1) >= 0) & (road_polygons[...,0].min(axis=1) <= STATE_W) &
+                       (road_polygons[...,1].max(axis=1) >= 0) & (road_polygons[...,1].min(axis=1) <= STATE_H))
+            polygons.extend(road_polygons[visible])
+            colors.extend(road_colors[visible])
+
+        # car.draw(viewer, draw_particles=False)
+        for obj in self.car.drawlist:
+            for f in obj.fixtures:
+                trans = f.body.transform
+                path = [trans*v for v in f.shape.vertices]
+                polygons.append(to_state(np.array([(p[0], p[1]) for p in path])))
+                colors.append(gl_color(obj.color))
+                if "phase" not in obj.__dict__: continue
+                a1 = obj.phase
+                a2 = obj.phase + 1.2  # radians
+                s1 = math.sin(a1)
+                s2 = math.sin(a2)
+                c1 = math.cos(a1)
+                c2 = math.cos(a2)
+                if s1>0 and s2>0: continue
+                if s1>0: c1 = np.sign(c1)
+                if s2>0: c2 = np.sign(c2)
+                white_poly = [
+                    (-WHEEL_W*SIZE, +WHEEL_R*c1*SIZE), (+WHEEL_W*SIZE, +WHEEL_R*c1*SIZE),
+                    (+WHEEL_W*SIZE, +WHEEL_R*c2*SIZE), (-WHEEL_W*SIZE, +WHEEL_R*c2*SIZE)
+                    ]
+                path = [trans*v for v in white_poly]
+                polygons.append(to_state(np.array([(p[0], p[1]) for p in path])))
+                colors.append(gl_color(WHEEL_WHITE))
+
+        # render_indicators(WINDOW_W, WINDOW_H), in window coordinates
+        W, H = WINDOW_W, WINDOW_H
+        s = W/40.0
+        h = H/40.0
+        quads = [([(W, 0), (W, 5*h), (0, 5*h), (0, 0)], (0,0,0))]
+        vertical_ind = lambda place, val, color: ([((place+0)*s, h + h*val), ((place+1)*s, h + h*val), ((place+1)*s, h), ((place+0)*s, h)], color)
+        horiz_ind = lambda place, val, color: ([((place+0)*s, 4*h), ((place+val)*s, 4*h), ((place+val)*s, 2*h), ((place+0)*s, 2*h)], color)
+        true_speed = np.sqrt(np.square(self.car.hull.linearVelocity[0]) + np.square(self.car.hull.linearVelocity[1]))
+        quads += [vertical_ind(5, 0.02*true_speed, (1,1,1)),
+                  vertical_ind(7, 0.01*self.car.wheels[0].omega, (0.0,0,1)), # ABS sensors
+                  vertical_ind(8, 0.01*self.car.wheels[1].omega, (0.0,0,1)),
+                  vertical_ind(9, 0.01*self.car.wheels[2].omega, (0.2,0,1)),
+                  vertical_ind(10,0.01*self.car.wheels[3].omega, (0.2,0,1)),
+                  horiz_ind(20, -10.0*self.car.wheels[0].joint.angle, (0,1,0)),
+                  horiz_ind(30, -0.8*self.car.hull.angularVelocity, (1,0,0))]
+        quads += [(quad, (1,1,1)) for quad in score_polygons("%04i" % self.reward, 1/window_to_state)]
+        for quad, color in quads:
+            polygons.append(np.array(quad)*window_to_state)
+            colors.append(gl_color(color))
+
+        r = self.rasterizer
+        r.clear()
+        r.fill_polygons(polygons, colors)
+        return r.image().copy()
+
     def draw_point(self, viewer, point, **attrs):
         '''
         Allows for one time addition of a point
@@ -500,6 +678,46 @@ class ExtendedCarRacing(CarRacing):
         viewer.add_onetime(geom)
         return geom
 
+# segments of each character, a (top) to f clockwise, g in the middle
+SEVEN_SEGMENTS = {'0': 'abcdef', '1': 'bc', '2': 'abdeg', '3': 'abcdg', '4': 'bcfg', '5': 'acdfg',
+                  '6': 'acdefg', '7': 'abc', '8': 'abcdefg', '9': 'abcdfg', '-': 'g'}
+# (x0, y0, x1, y1) of each segment on a 3x5 pixel glyph, y up
+SEGMENT_BOXES = {'a': (0, 4, 3, 5), 'b': (2, 2, 3, 5), 'c': (2, 0, 3, 3), 'd': (0, 0, 3, 1),
+                 'e': (0, 0, 1, 3), 'f': (0, 2, 1, 5), 'g': (0, 2, 3, 3)}
+
+def score_polygons(text, pixel, x=20, y=WINDOW_H*2.5/40.00):
+    '''
+    The score_label render_indicators draws (Label(text, font_size=36, x=20, y=WINDOW_H*2.5/40,
+    anchor_x='left', anchor_y='center')) as quads in window coordinates: seven segment glyphs
+    of 3x5 output pixels, 4 apart, on whole pixels. pyglet's 36 pt digits cover about 3x4
+    pixels of the 96x96 state, so the same few pixels light up.
+
+    pixel: (width, height) of an output pixel in window coordinates
+    '''
+    pixel_w, pixel_h = pixel
+    left, bottom = np.round(x/pixel_w), np.floor(y/pixel_h - 2)
+    polygons = []
+    for idx, char in enumerate(text):
+        for segment in SEVEN_SEGMENTS.get(char, ''):
+            x0, y0, x1, y1 = SEGMENT_BOXES[segment]
+            x0, x1 = (left + 4*idx + x0)*pixel_w, (left + 4*idx + x1)*pixel_w
+            y0, y1 = (bottom + y0)*pixel_h, (bottom + y1)*pixel_h
+            polygons.append([(x1, y0), (x1, y1), (x0, y1), (x0, y0)])
+    return polygons
+
+def grass_polygons():
+    '''
+    The background render_road draws before the road: the playfield, then the lighter squares
+    '''
+    k = PLAYFIELD/20.0
+    polygons = [[(-PLAYFIELD, +PLAYFIELD), (+PLAYFIELD, +PLAYFIELD), (+PLAYFIELD, -PLAYFIELD), (-PLAYFIELD, -PLAYFIELD)]]
+    colors = [(0.4, 0.8, 0.4)]
+    for x in range(-20, 20, 2):
+        for y in range(-20, 20, 2):
+            polygons.append([(k*x + k, k*y + 0), (k*x + 0, k*y + 0), (k*x + 0, k*y + k), (k*x + k, k*y + k)])
+            colors.append((0.4, 0.9, 0.4))
+    return np.array(polygons, dtype=float), gl_color(colors)
+
 class MinList(object):
     def __init__(self):
         self.distances = []
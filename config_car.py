@@ -7,13 +7,21 @@ init_seed = 2
 stochastic_env = False # = not deterministic
 max_pos_costs = 12 # The maximum allowable positive cost before ending episode early
 max_time_spent_in_episode = 2000
-env = ExtendedCarRacing(init_seed, stochastic_env, max_pos_costs)
+track_cache_dir = 'track_cache' # generated track of init_seed, shared by every process
+software_render = False # draw the state pixels with numpy: no X server/pyvirtualdisplay needed, but no window either
+def make_env():
+    return ExtendedCarRacing(init_seed, stochastic_env, max_pos_costs, track_cache_dir=track_cache_dir, software_render=software_render)
+env = make_env()
+collection_workers = 0 # env replicas collecting the dataset in lockstep. 0: env itself, rendered on screen
+collect_in_process = software_render # replicas in this process (software_render needs no GL context per process) vs one process each
 
 #### Hyperparam
 gamma = .95
 max_epochs = 3000 # max number of epochs over which to collect data
 max_Q_fitting_epochs = 50 #max number of epochs over which to converge to Q^\ast.   Fitted Q Iter
 max_eval_fitting_epochs = 50 #max number of epochs over which to converge to Q^\pi. Off Policy Eval
+warm_start = False # FQI/FQE continue from their networks of the previous iteration instead of reinitializing them
+warm_start_fitting_epochs = 20 # max Q/eval fitting epochs of those warm runs
 lambda_bound = 30. # l1 bound on lagrange multipliers
 epsilon = .01 # termination condition for two-player game
 deviation_from_old_policy_eps = 0.0 #With what probabaility to deviate from the old policy
@@ -28,6 +36,7 @@ model_type = 'cnn'
 # old_policy_name = 'pi_old_car_{0}.hdf5'.format(model_type)
 old_policy_name = 'pi_old_car_{0}_seed_2.hdf5'.format(model_type)
 freeze_cnn_layers = False
+feature_cache_dir = None # with freeze_cnn_layers, memory-map the cached conv features here. None keeps them in RAM
 starting_lambda = [1.,1.,28.]
 
 
@@ -50,6 +59,7 @@ num_frame_stack=3
 min_buffer_size_to_train = 2000
 frame_skip=3
 pic_size = (96, 96, 3)
+gray_scale_workers = 4 # processes used the first time the dataset frames are gray-scaled (result is cached on disk)
 
 # Other
 
@@ -7,7 +7,11 @@ map_size = 8
 # register( id='FrozenLake-no-slip-v0', entry_point='gym.envs.toy_text:FrozenLakeEnv', kwargs={'is_slippery': False, 'map_name':'{0}x{0}'.format(map_size)} )
 # env = gym.make('FrozenLake-no-slip-v0')
 max_time_spent_in_episode = 100
-env = ExtendedFrozenLake(max_time_spent_in_episode, map_name = '{0}x{0}'.format(map_size), is_slippery= False)
+def make_env():
+    return ExtendedFrozenLake(max_time_spent_in_episode, map_name = '{0}x{0}'.format(map_size), is_slippery= False)
+env = make_env()
+collection_workers = 0 # env replicas collecting the dataset in lockstep. 0: env itself
+collect_in_process = True # lake steps are cheap, keep the replicas in this process
 position_of_holes = np.arange(env.desc.shape[0]*env.desc.shape[1]).reshape(env.desc.shape)[np.nonzero(env.desc == 'H')]
 position_of_goals = np.arange(env.desc.shape[0]*env.desc.shape[1]).reshape(env.desc.shape)[np.nonzero(env.desc == 'G')]
 
@@ -18,6 +22,8 @@ gamma = 0.9
 max_epochs = 5000 # max number of epochs over which to collect data
 max_Q_fitting_epochs = 30 #max number of epochs over which to converge to Q^\ast.   Fitted Q Iter
 max_eval_fitting_epochs = 30 #max number of epochs over which to converge to Q^\pi. Off Policy Eval
+warm_start = False # FQI/FQE continue from their networks of the previous iteration instead of reinitializing them
+warm_start_fitting_epochs = 10 # max Q/eval fitting epochs of those warm runs
 lambda_bound = 30. # l1 bound on lagrange multipliers
 epsilon = .01 # termination condition for two-player game
 deviation_from_old_policy_eps = .95 #With what probabaility to deviate from the old policy
@@ -29,6 +35,7 @@ initial_states = [[0]] #The only initial state is [1,0...,0]. In general, this s
 non_terminal_states = np.nonzero(((env.desc == 'S') + (env.desc == 'F')).reshape(-1))[0] # Used for dynamic programming. this is an optimization to make the algorithm run faster. In general, you may not have this
 max_number_of_main_algo_iterations = 100 # After how many iterations to cut off the main algorithm
 model_type = 'mlp'
+tabular_backend = False # True: FQI/FQE solve the Bellman equations on a table instead of fitting LakeNN
 old_policy_name = 'pi_old_map_size_{0}_{1}.h5'.format(map_size, model_type)
 constraints = [.1, 0]
 starting_lambda = 'uniform'
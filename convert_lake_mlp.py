@@ -0,0 +1,28 @@
+'''
+Converts a lake mlp saved with one hot (x,a) inputs, e.g. models/pi_old_map_size_8_mlp.h5,
+into the state index, all actions head model LakeNN builds now (see env_nn.convert_one_hot_mlp).
+The converted model computes the same Q(x,a).
+'''
+import argparse
+from keras.models import load_model
+from env_nn import convert_one_hot_mlp
+
+
+def main(path, out_path, dim_of_actions):
+    model = load_model(path)
+    assert len(model.inputs) == 1, '%s does not take one hot (x,a) inputs' % path
+    dim_of_state = model.input_shape[1] - dim_of_actions
+    convert_one_hot_mlp(model, dim_of_state, dim_of_actions).save(out_path)
+    print 'Converted %s (%s states, %s actions) to %s' % (path, dim_of_state, dim_of_actions, out_path)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a one hot lake mlp to the all actions head model.')
+    parser.add_argument('path', help='.h5 model to convert')
+    parser.add_argument('--out', dest='out', default=None,
+                        help = 'Where to save the converted model. Default: overwrite path')
+    parser.add_argument('--actions', dest='actions', type=int, default=4,
+                        help = 'Number of actions')
+    args = parser.parse_args()
+
+    main(args.path, args.out or args.path, args.actions)
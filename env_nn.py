@@ -2,7 +2,7 @@
 import numpy as np
 import keras
 from keras.models import Sequential, Model as KerasModel
-from keras.layers import Input, Dense, Flatten, concatenate, dot, MaxPooling2D
+from keras.layers import Input, Dense, Flatten, Reshape, Embedding, Activation, concatenate, dot, MaxPooling2D
 from keras.losses import mean_squared_error
 from keras import optimizers
 from keras import regularizers
@@ -13,15 +13,74 @@ from model import Model
 from keras import backend as K
 from skimage import color
 import os
+from functools import partial
 from keras.layers.convolutional import Conv2D
 
 
+def run_initializers(*models):
+    '''
+    Fresh weights and optimizer state for compiled keras models, in place: the initializers of
+    their variables run again (new random draws) and no graph is built
+    '''
+    variables = []
+    for model in models:
+        variables += model.weights + getattr(model.optimizer, 'weights', [])
+    K.get_session().run([variable.initializer for variable in variables])
+
+
+def lake_policy_evaluator(gamma, num_frame_stack, frame_skip, pic_size):
+    from config_lake import action_space_map, env
+    return ExactPolicyEvaluator(action_space_map, gamma, env=env, num_frame_stack=num_frame_stack, frame_skip=frame_skip, pic_size = pic_size)
+
+
+def car_policy_evaluator(gamma, num_frame_stack, frame_skip, pic_size):
+    from config_car import action_space_map, env
+    return ExactPolicyEvaluator(action_space_map, gamma, env=env, num_frame_stack=num_frame_stack, frame_skip = frame_skip, pic_size = pic_size)
+
+
+def lake_mlp(dim_of_state, dim_of_actions, num_outputs=1, hidden_units=64):
+    '''
+    Lake mlp on the state index: hidden = tanh(state_embedding[x]), the rows of a Dense layer
+    on the one hot state. 'all_actions' is Q(x,.) (or (num_outputs, dim_of_actions) of them),
+    the output Q(x,a) is Q(x,.) masked by the one hot action, like CarNN
+    '''
+    def init(): return keras.initializers.TruncatedNormal(mean=0.0, stddev=0.1, seed=np.random.randint(2**32))
+    state = Input(shape=(1,), dtype='int32', name='state')
+    action_mask = Input(shape=(dim_of_actions,), name='mask')
+    hidden = Activation('tanh')(Flatten()(Embedding(dim_of_state, hidden_units, name='state_embedding', embeddings_initializer=init())(state)))
+    if num_outputs == 1:
+        all_actions = Dense(dim_of_actions, activation='linear', name='all_actions', kernel_initializer=init(), bias_initializer=init())(hidden)
+        output = dot([all_actions, action_mask], 1)
+    else:
+        all_actions = Dense(num_outputs*dim_of_actions, activation='linear', kernel_initializer=init(), bias_initializer=init())(hidden)
+        all_actions = Reshape((num_outputs, dim_of_actions), name='all_actions')(all_actions)
+        output = dot([all_actions, action_mask], axes=(2,1))
+    model = KerasModel(inputs=[state, action_mask], outputs=output)
+    # adam = optimizers.Adam(clipnorm=1.)
+    model.compile(loss='mean_squared_error', optimizer='rmsprop', metrics=['accuracy'])
+    return model
+
+
+def convert_one_hot_mlp(model, dim_of_state, dim_of_actions):
+    '''
+    The lake_mlp computing the same Q(x,a) as a single output mlp on one hot (x,a) inputs
+    (e.g. a saved pi_old_map_size_8_mlp.h5). Each action gets its own block of hidden units,
+    tanh(W_x[x] + W_a[a] + b), read only by its column of the head
+    '''
+    W, b, w, c = model.get_weights()
+    converted = lake_mlp(dim_of_state, dim_of_actions, 1, len(b)*dim_of_actions)
+    embeddings = W[:dim_of_state, np.newaxis, :] + W[dim_of_state:] + b # (states, actions, hidden)
+    converted.get_layer('state_embedding').set_weights([embeddings.reshape(dim_of_state, -1)])
+    converted.get_layer('all_actions').set_weights([np.kron(np.eye(dim_of_actions), w), np.repeat(c, dim_of_actions)])
+    return converted
+
+
 class LakeNN(Model):
     def __init__(self, num_inputs, num_outputs, grid_shape, dim_of_actions, gamma, convergence_of_model_epsilon=1e-10, model_type='mlp', position_of_holes=None, position_of_goals=None, num_frame_stack=None, frame_skip= None, pic_size = None, **kw):
         '''
         An implementation of fitted Q iteration
 
-        num_inputs: number of inputs
+        num_inputs: number of inputs (unused by the mlp, which takes state and action indices)
         num_outputs: number of outputs
         dim_of_actions: dimension of action space
         convergence_of_model_epsilon: small float. Defines when the model has converged.
@@ -29,6 +88,7 @@ class LakeNN(Model):
         super(LakeNN, self).__init__()
         self.convergence_of_model_epsilon = convergence_of_model_epsilon 
         self.model_type = model_type
+        self.num_outputs = num_outputs
         self.dim_of_actions = dim_of_actions
         self.dim_of_state = grid_shape[0] * grid_shape[1]
         self.grid_shape = grid_shape
@@ -54,22 +114,25 @@ class LakeNN(Model):
         else:
             self.position_of_goals = position_of_goals
 
+        if self.model_type == 'cnn':
+            self.cnn_rep_table = self.create_cnn_rep_table()
+
         self.model = self.create_model(num_inputs, num_outputs)
-        #debug purposes
-        from config_lake import action_space_map, env
+        #debug purposes, built on first use
         if 'exact' in kw: 
             self.policy_evalutor = kw['exact']
         else:
-            self.policy_evalutor = ExactPolicyEvaluator(action_space_map, gamma, env=env, num_frame_stack=num_frame_stack, frame_skip=frame_skip, pic_size = pic_size)
+            self.make_policy_evalutor = partial(lake_policy_evaluator, gamma, num_frame_stack, frame_skip, pic_size)
+
+    def reinitialize(self):
+        '''
+        Fresh weights and optimizer state, in place, see run_initializers
+        '''
+        run_initializers(self.model)
 
     def create_model(self, num_inputs, num_outputs):
         if self.model_type == 'mlp':
-            model = Sequential()
-            def init(): return keras.initializers.TruncatedNormal(mean=0.0, stddev=0.1, seed=np.random.randint(2**32))
-            model.add(Dense(64, activation='tanh', input_shape=(num_inputs,),kernel_initializer=init(), bias_initializer=init()))
-            model.add(Dense(num_outputs, activation='linear',kernel_initializer=init(), bias_initializer=init()))
-            # adam = optimizers.Adam(clipnorm=1.)
-            model.compile(loss='mean_squared_error', optimizer='rmsprop', metrics=['accuracy'])
+            model = lake_mlp(self.dim_of_state, self.dim_of_actions, num_outputs)
         elif self.model_type == 'cnn':
             # input layer
             # 3 channels: holes, goals, player
@@ -95,9 +158,16 @@ class LakeNN(Model):
             
             # interpret
             hidden1 = Dense(10, activation='elu',kernel_initializer=init(), bias_initializer=init())(flat1)
-            hidden2 = Dense(self.dim_of_actions, activation='linear',kernel_initializer=init(), bias_initializer=init())(hidden1)
-            
-            output = dot([hidden2, actions], 1)
+            if num_outputs == 1:
+                hidden2 = Dense(self.dim_of_actions, activation='linear',kernel_initializer=init(), bias_initializer=init())(hidden1)
+                
+                output = dot([hidden2, actions], 1)
+            else:
+                # one Q(x,.) per output (cost), each masked by the action
+                hidden2 = Dense(num_outputs*self.dim_of_actions, activation='linear',kernel_initializer=init(), bias_initializer=init())(hidden1)
+                hidden2 = Reshape((num_outputs, self.dim_of_actions))(hidden2)
+
+                output = dot([hidden2, actions], axes=(2,1))
             # predict
             # output = Dense(1, activation='linear',kernel_initializer=init(), bias_initializer=init())(hidden1)
             model = KerasModel(inputs=[inp, neighbors, actions], outputs=output)
@@ -124,8 +194,22 @@ class LakeNN(Model):
         else:
             return None
 
+    def one_hot_inputs(self):
+        '''
+        True for an mlp taking one hot (x,a) vectors, e.g. a model saved before the index inputs
+        (convert_lake_mlp.py turns it into a lake_mlp)
+        '''
+        return self.model_type == 'mlp' and len(self.model.inputs) == 1
+
     def representation(self, *args, **kw):
-        if self.model_type == 'mlp':
+        if self.model_type == 'mlp' and not self.one_hot_inputs():
+            if len(args) == 1:
+                return np.array(args[0]).astype(int).reshape(-1,1)
+            elif len(args) == 2:
+                return [np.array(args[0]).astype(int).reshape(-1,1), np.eye(self.dim_of_actions)[np.array(args[1]).astype(int)] ]
+            else:
+                raise NotImplemented
+        elif self.model_type == 'mlp':
             if len(args) == 1:
                 return np.eye(self.dim_of_state)[np.array(args[0]).astype(int)]
             elif len(args) == 2:
@@ -133,45 +217,35 @@ class LakeNN(Model):
             else:
                 raise NotImplemented
         elif self.model_type == 'cnn':
+            grid, surrounding = self.cnn_rep_table
+            x = np.array(args[0]).astype(int).reshape(-1)
             if len(args) == 1:
-                position = np.eye(self.dim_of_state)[np.array(args[0]).astype(int)].reshape(-1,self.grid_shape[0],self.grid_shape[1])
-                X, surrounding = self.create_cnn_rep_helper(position)
-                return [X, surrounding]
+                return [grid[x], surrounding[x]]
             elif len(args) == 2:
-                position = np.eye(self.dim_of_state)[np.array(args[0]).astype(int)].reshape(-1,self.grid_shape[0],self.grid_shape[1])
-                X, surrounding = self.create_cnn_rep_helper(position)
-                return [X, surrounding, np.eye(self.dim_of_actions)[np.array(args[1]).astype(int)] ]
+                return [grid[x], surrounding[x], np.eye(self.dim_of_actions)[np.array(args[1]).astype(int)] ]
             else:
                 raise NotImplemented
         else:
             raise NotImplemented
 
-    def create_cnn_rep_helper(self, position):
-        how_many = position.shape[0]
-        holes = np.repeat(self.position_of_holes[np.newaxis, :, :], how_many, axis=0)
-        goals = np.repeat(self.position_of_goals[np.newaxis, :, :], how_many, axis=0)
-
-        ix_x, ix_y, ix_z = np.where(position)
-        surrounding = self.is_next_to([self.position_of_holes, self.position_of_goals], ix_y, ix_z)
-
-        return np.sum([position*.5, holes*1, goals*(-1)], axis = 0)[:,:,:,np.newaxis], np.hstack(surrounding)
-
-    def is_next_to(self, obstacles, x, y):
-        # obstacles must be list
-        assert np.all(np.array([obstacle.shape for obstacle in obstacles]) == obstacles[0].shape)
-        surround = lambda x,y: [(x, y-1), (x+1, y), (x, y+1), (x-1, y)]
-
-        ret = []
-        for idx in range(len(x)):
-            neighbors = []
-            for a,b in surround(x[idx], y[idx]):
-                # only works if all obstacles are same shape
-                neighbor = np.vstack([obstacle[a, b] for obstacle in obstacles]) if 0 <= a < obstacles[0].shape[0] and 0 <= b < obstacles[0].shape[1] else np.array([0.]*len(obstacles)).reshape(1,-1).T
-                neighbors.append(neighbor)
-
-            ret.append(np.hstack(neighbors))
-
-        return np.stack(ret, axis=1)
+    def create_cnn_rep_table(self):
+        '''
+        The cnn input of every state, so a batch is a gather:
+            grid: (states, rows, cols, 1), .5 at the player, 1 on holes, -1 on goals
+            holes_and_goals: (states, 2*actions), hole then goal indicator of the neighbor
+                             in each action's direction, 0 off the grid
+        '''
+        rows, cols = self.grid_shape
+        obstacles = self.position_of_holes - self.position_of_goals
+        grid = np.repeat(obstacles[np.newaxis, :, :, np.newaxis].astype(np.float32), self.dim_of_state, axis=0)
+        grid.reshape(self.dim_of_state, -1)[np.arange(self.dim_of_state), np.arange(self.dim_of_state)] += .5
+
+        # neighbors (x, y-1), (x+1, y), (x, y+1), (x-1, y), looked up in maps padded with zeros
+        x, y = np.divmod(np.arange(self.dim_of_state), cols)
+        dx, dy = np.array([0, 1, 0, -1]), np.array([-1, 0, 1, 0])
+        neighbor_x, neighbor_y = x[:, np.newaxis] + dx + 1, y[:, np.newaxis] + dy + 1
+        surrounding = np.hstack([np.pad(obstacle, 1, 'constant')[neighbor_x, neighbor_y] for obstacle in [self.position_of_holes, self.position_of_goals]])
+        return grid, surrounding.astype(np.float32)
 
     def predict(self, X, a, **kw):
         return self.model.predict(self.representation(X,a))
@@ -188,6 +262,13 @@ class LakeNN(Model):
                #  ...
                # (x_N, a_m))
         X = np.array(X).reshape(-1)
+        if self.model_type == 'mlp' and not self.one_hot_inputs():
+            # one pass over the states through the all actions head
+            if getattr(self, 'all_actions_model', None) is not self.model:
+                self.all_actions_func = K.function([self.model.get_layer('state').input], [self.model.get_layer('all_actions').output])
+                self.all_actions_model = self.model
+            return self.all_actions_func([self.representation(X)])[0]
+
         X_a = self.cartesian_product(X, np.arange(self.dim_of_actions))
 
 
@@ -197,8 +278,10 @@ class LakeNN(Model):
                  # (Q_xN_a1, Q_xN_a2,... Q_xN_am)
         # by reshaping using C ordering
 
-        Q_x_a = self.predict(X_a[:,0], X_a[:,1]).reshape(X.shape[0],self.dim_of_actions,order='C')
-        return Q_x_a
+        Q_x_a = self.predict(X_a[:,0], X_a[:,1]).reshape(X.shape[0],self.dim_of_actions,-1,order='C')
+        if self.num_outputs == 1:
+            return Q_x_a[:,:,0]
+        return np.swapaxes(Q_x_a, 1, 2) # (N, num_outputs, dim_of_actions) like CarNN
 
 
 class EarlyStoppingByConvergence(Callback):
@@ -255,20 +338,38 @@ class EarlyStoppingByConvergence(Callback):
 
 
 class CarNN(Model):
-    def __init__(self, input_shape, dim_of_actions, gamma, convergence_of_model_epsilon=1e-10, model_type='cnn', num_frame_stack=None, frame_skip = None, pic_size = None, freeze_cnn_layers=False):
+    def __init__(self, input_shape, dim_of_actions, gamma, convergence_of_model_epsilon=1e-10, model_type='cnn', num_frame_stack=None, frame_skip = None, pic_size = None, freeze_cnn_layers=False, num_outputs=1):
+        '''
+        num_outputs: number of Q functions (e.g. one per cost) sharing the network.
+                     If > 1, all_actions returns (N, num_outputs, dim_of_actions)
+        '''
         super(CarNN, self).__init__()
 
         self.all_actions_func = None
+        self.features_func = None
+        self.head = None
+        self.head_all_actions_func = None
         self.convergence_of_model_epsilon = convergence_of_model_epsilon 
         self.model_type = model_type
         self.dim_of_actions = dim_of_actions
+        self.num_outputs = num_outputs
         self.input_shape = input_shape
         self.freeze_cnn_layers = freeze_cnn_layers
+        self.learning_rate = 0.0005
         self.model = self.create_model(input_shape)
 
-        #debug purposes
-        from config_car import action_space_map, env
-        self.policy_evalutor = ExactPolicyEvaluator(action_space_map, gamma, env=env, num_frame_stack=num_frame_stack, frame_skip = frame_skip, pic_size = pic_size)
+        #debug purposes, built on first use
+        self.make_policy_evalutor = partial(car_policy_evaluator, gamma, num_frame_stack, frame_skip, pic_size)
+
+    def reinitialize(self):
+        '''
+        Fresh weights and optimizer state of the model and head, in place, see run_initializers
+        '''
+        models = [self.model] + ([] if self.head is None else [self.head])
+        run_initializers(*models)
+        for model in models:
+            K.set_value(model.optimizer.lr, self.learning_rate)
+        if self.head is not None: self.sync_to_head()
 
     def create_model(self, input_shape):
         if self.model_type == 'cnn':
@@ -282,13 +383,11 @@ class CarNN(Model):
             pool2 = MaxPooling2D()(conv2)
             flat1 = Flatten(name='flattened')(pool2)
             dense1 = Dense(256, activation='elu',kernel_initializer=init(), bias_initializer=init(), kernel_regularizer=regularizers.l2(1e-6))(flat1)
-            all_actions = Dense(self.dim_of_actions, name='all_actions', activation="linear",kernel_initializer=init(), bias_initializer=init(), kernel_regularizer=regularizers.l2(1e-6))(dense1)
-            
-            output = dot([all_actions, action_mask], 1)
+            all_actions, output = self.action_values(dense1, action_mask, init)
 
             model = KerasModel(inputs=[inp, action_mask], outputs=output)
 
-            rmsprop = optimizers.RMSprop(lr=0.0005, rho=0.95, epsilon=1e-08, decay=0.0)
+            rmsprop = optimizers.RMSprop(lr=self.learning_rate, rho=0.95, epsilon=1e-08, decay=0.0)
             model.compile(loss='mean_squared_error', optimizer=rmsprop, metrics=['accuracy'])
 
             # if self.freeze_cnn_layers:
@@ -300,12 +399,85 @@ class CarNN(Model):
 
             
             self.all_actions_func = K.function([model.get_layer('inp').input], [model.get_layer('all_actions').output])
+            self.features_func = K.function([model.get_layer('inp').input], [model.get_layer('flattened').output])
             # self.all_actions_func = None
         else:
             raise NotImplemented
 
         return model
 
+    def create_head(self):
+        '''
+        The dense layers on top of 'flattened' as a model of their own, trained on
+        precomputed conv features instead of frames. Only valid with frozen conv layers.
+        '''
+        assert self.freeze_cnn_layers, 'Conv features can only be cached if the conv layers are frozen'
+        features = Input(shape=(self.feature_dim(),), name='features')
+        action_mask = Input(shape=(self.dim_of_actions,), name='mask')
+        def init(): return keras.initializers.TruncatedNormal(mean=0.0, stddev=0.001, seed=np.random.randint(2**32))
+
+        dense1 = Dense(256, activation='elu',kernel_initializer=init(), bias_initializer=init(), kernel_regularizer=regularizers.l2(1e-6))(features)
+        all_actions, output = self.action_values(dense1, action_mask, init)
+
+        head = KerasModel(inputs=[features, action_mask], outputs=output)
+
+        rmsprop = optimizers.RMSprop(lr=self.learning_rate, rho=0.95, epsilon=1e-08, decay=0.0)
+        head.compile(loss='mean_squared_error', optimizer=rmsprop, metrics=['accuracy'])
+
+        self.head = head
+        self.head_all_actions_func = K.function([features], [all_actions])
+        self.sync_to_head()
+        return head
+
+    def action_values(self, dense1, action_mask, init):
+        '''
+        Returns Q(x,.) for all actions and Q(x,a) for the action in action_mask
+        '''
+        if self.num_outputs == 1:
+            all_actions = Dense(self.dim_of_actions, name='all_actions', activation="linear",kernel_initializer=init(), bias_initializer=init(), kernel_regularizer=regularizers.l2(1e-6))(dense1)
+            output = dot([all_actions, action_mask], 1)
+        else:
+            # one Q(x,.) per output (cost), each masked by the same action
+            all_actions = Dense(self.num_outputs*self.dim_of_actions, activation="linear",kernel_initializer=init(), bias_initializer=init(), kernel_regularizer=regularizers.l2(1e-6))(dense1)
+            all_actions = Reshape((self.num_outputs, self.dim_of_actions), name='all_actions')(all_actions)
+            output = dot([all_actions, action_mask], axes=(2,1))
+        return all_actions, output
+
+    def dense_layers(self, model):
+        return [layer for layer in model.layers if isinstance(layer, Dense)]
+
+    def sync_to_head(self):
+        for layer, head_layer in zip(self.dense_layers(self.model), self.dense_layers(self.head)):
+            head_layer.set_weights(layer.get_weights())
+
+    def sync_from_head(self):
+        for layer, head_layer in zip(self.dense_layers(self.model), self.dense_layers(self.head)):
+            layer.set_weights(head_layer.get_weights())
+
+    def copy_over_to(self, to_):
+        super(CarNN, self).copy_over_to(to_)
+        if (self.head is not None) and (to_.head is not None):
+            to_.head.set_weights(self.head.get_weights())
+
+    def feature_dim(self):
+        return K.int_shape(self.model.get_layer('flattened').output)[-1]
+
+    def conv_weights(self):
+        '''
+        Weights of every layer below 'flattened', i.e. what the cached features depend on
+        '''
+        weights = []
+        for layer in self.model.layers:
+            if layer.name == 'flattened': break
+            weights += layer.get_weights()
+        return weights
+
+    def features(self, X, x_preprocessed=False):
+        return self.features_func(self.representation(X, x_preprocessed=x_preprocessed))[0]
+
+    def all_actions_from_features(self, features):
+        return self.head_all_actions_func([features])[0]
+
 
     def fit(self, X, y, verbose=0, batch_size=512, epochs=1000, evaluate=False, tqdm_verbose=True, additional_callbacks=[], **kw):
 
@@ -319,10 +491,12 @@ class CarNN(Model):
         else:
             return None
 
-    def fit_generator(self, generator, verbose=0, batch_size=512, epochs=1000, evaluate=False, tqdm_verbose=True, additional_callbacks=[], **kw):
+    def fit_generator(self, generator, verbose=0, batch_size=512, epochs=1000, evaluate=False, tqdm_verbose=True, additional_callbacks=[], on_features=False, **kw):
 
         self.callbacks_list = additional_callbacks #+ [EarlyStoppingByConvergence(epsilon=self.convergence_of_model_epsilon, diff =1e-10, verbose=verbose)]#, TQDMCallback(show_inner=False, show_outer=tqdm_verbose)]
-        self.model.fit_generator(generator,verbose=verbose==2, epochs=epochs, callbacks=self.callbacks_list, **kw)
+        model = self.head if on_features else self.model
+        model.fit_generator(generator,verbose=verbose==2, epochs=epochs, callbacks=self.callbacks_list, **kw)
+        if on_features: self.sync_from_head()
 
         if evaluate:
             return self.evaluate()
@@ -0,0 +1,125 @@
+import numpy as np
+import multiprocessing
+
+
+def step_env(env, action, frame_skip=1, time_steps=None, total_cost=None):
+    '''
+    One agent step: the action repeated frame_skip times, costs summed.
+    Returns x', [c, g...], done, early_done, punishment
+    '''
+    cost = []
+    for _ in range(frame_skip):
+        x_prime, costs, done, _ = env.step(action)
+        cost.append(costs)
+        if done:
+            break
+    cost = np.vstack([np.hstack(x) for x in cost]).sum(axis=0)
+    early_done, punishment = env.is_early_episode_termination(cost=cost[0], time_steps=time_steps, total_cost=total_cost)
+    return x_prime, cost, done, early_done, punishment
+
+
+def _work(remote, make_env, frame_skip):
+    env = make_env()
+    while True:
+        cmd, data = remote.recv()
+        try:
+            if cmd == 'reset':
+                if data is not None:
+                    env.seed(data)
+                    np.random.seed(data)
+                remote.send(env.reset())
+            elif cmd == 'step':
+                action, time_steps, total_cost = data
+                remote.send(step_env(env, action, frame_skip, time_steps, total_cost))
+            elif cmd == 'getattr':
+                remote.send(getattr(env, data))
+            elif cmd == 'close':
+                remote.close()
+                break
+        except Exception as e:
+            remote.send(e)
+
+
+def _recv(remote):
+    output = remote.recv()
+    if isinstance(output, Exception):
+        raise output
+    return output
+
+
+class EnvPool(object):
+    def __init__(self, make_env, num_envs, frame_skip=1, env=None, in_process=False):
+        '''
+        num_envs replicas of an environment, each stepped in its own process.
+        The caller queries its policy once for all replicas and steps them together.
+
+        make_env: function () -> env, called in every worker
+        num_envs: number of replicas
+        frame_skip: times each action is repeated per step
+        env: if given, a single replica run in this process on env itself (num_envs must be 1)
+        in_process: build the num_envs replicas in this process and step them one after
+                    the other (e.g. headless car envs with software_render)
+        '''
+        self.num_envs = num_envs
+        self.frame_skip = frame_skip
+        self.envs = None
+        self.remotes = []
+        self.workers = []
+
+        if env is not None:
+            assert num_envs == 1, 'An env given to the pool is its only replica'
+            self.envs = [env]
+            return
+        if in_process:
+            self.envs = [make_env() for _ in range(num_envs)]
+            return
+
+        for _ in range(num_envs):
+            remote, worker_remote = multiprocessing.Pipe()
+            worker = multiprocessing.Process(target=_work, args=(worker_remote, make_env, frame_skip))
+            worker.daemon = True
+            worker.start()
+            worker_remote.close()
+            self.remotes.append(remote)
+            self.workers.append(worker)
+
+    def reset(self, idxs, seeds=None):
+        '''
+        Resets the replicas idxs, each seeded with seeds[i] if given. Returns their x
+        '''
+        seeds = [None]*len(idxs) if seeds is None else seeds
+        if self.envs is not None:
+            for idx, seed in zip(idxs, seeds):
+                if seed is not None: self.envs[idx].seed(seed)
+            return [self.envs[idx].reset() for idx in idxs]
+
+        for idx, seed in zip(idxs, seeds):
+            self.remotes[idx].send(('reset', seed))
+        return [_recv(self.remotes[idx]) for idx in idxs]
+
+    def step(self, idxs, actions, time_steps, total_costs):
+        '''
+        Steps the replicas idxs at the same time. Returns a list of step_env outputs
+        '''
+        if self.envs is not None:
+            return [step_env(self.envs[idx], action, self.frame_skip, t, total_cost) for idx, action, t, total_cost in zip(idxs, actions, time_steps, total_costs)]
+
+        for idx, action, t, total_cost in zip(idxs, actions, time_steps, total_costs):
+            self.remotes[idx].send(('step', (action, t, total_cost)))
+        return [_recv(self.remotes[idx]) for idx in idxs]
+
+    def get(self, idx, attr):
+        if self.envs is not None:
+            return getattr(self.envs[idx], attr)
+        self.remotes[idx].send(('getattr', attr))
+        return _recv(self.remotes[idx])
+
+    def close(self):
+        for remote in self.remotes:
+            try:
+                remote.send(('close', None))
+            except IOError:
+                pass
+        for worker in self.workers:
+            worker.join()
+        self.remotes, self.workers = [], []
@@ -2,17 +2,26 @@
 
 import numpy as np
 import scipy.signal as signal
+import scipy.stats as stats
 from replay_buffer import Buffer
+from env_pool import EnvPool
 import os
 
 
 class ExactPolicyEvaluator(object):
-    def __init__(self, action_space_map, gamma, env=None, num_frame_stack=None, frame_skip = None, pic_size = None, constraint_thresholds=None, constraints_cared_about=None):
+    def __init__(self, action_space_map, gamma, env=None, num_frame_stack=None, frame_skip = None, pic_size = None, constraint_thresholds=None, constraints_cared_about=None, tabular=True, num_trials=1, num_workers=0, env_factory=None):
         '''
         An implementation of Exact Policy Evaluation through Monte Carlo
 
         In this case since the environment is fixed and initial states are fixed
         then this will be exact
+
+        tabular: if the env exposes its transitions (env.P, e.g. the lake), evaluate greedy
+                 policies from env.P instead of rolling them out. One batched policy call
+                 over all states, same values as the rollout
+        num_trials: Monte Carlo trials for stochastic envs/policies
+        num_workers: env replicas stepping those trials in parallel processes. 0 runs them one by one on env
+        env_factory: function () -> env building a replica in a worker. Default: a forked copy of env
         '''
         self.gamma = gamma
         self.action_space_map = action_space_map
@@ -34,6 +43,14 @@ class ExactPolicyEvaluator(object):
 
         self.monitor = Monitor(self.env, 'videos')
 
+        self.num_trials = num_trials
+        self.num_workers = num_workers
+        self.env_factory = env_factory if env_factory is not None else (lambda: self.env)
+        self.confidence_intervals = None
+
+        self.tabular = tabular and hasattr(self.env, 'P') and (self.env.env_type in ['lake']) and (frame_skip in [None, 1]) and (num_frame_stack in [None, 1])
+        self.transitions = None
+
     def run(self, policy, *args, **kw):
 
         environment_is_dynamic = not self.env.deterministic
@@ -49,7 +66,10 @@ class ExactPolicyEvaluator(object):
 
 
         if not environment_is_dynamic and policy_is_greedy:
-            c,g,perf = self.determinstic_env_and_greedy_policy(policy, **kw)
+            if self.tabular and not kw.get('render', False):
+                c,g,perf = self.tabular_env_and_greedy_policy(policy)
+            else:
+                c,g,perf = self.determinstic_env_and_greedy_policy(policy, **kw)
             if len(args) > 0:
                 if args[0] == 'c':
                     return c
@@ -68,6 +88,15 @@ class ExactPolicyEvaluator(object):
             return self.stochastic_env_or_policy(policy, **kw)
 
     def get_Qs(self, policy, initial_states, state_space_dim, idx=0):
+        if self.tabular:
+            if not isinstance(policy,(list,)):
+                policy = [policy]
+            values = [self.values_of_all_states(pi) for pi in policy]
+            if idx == 0:
+                return list(np.mean([c for c,g in values], axis=0)[np.array(initial_states).astype(int).reshape(-1)])
+            else:
+                return list(np.mean([g for c,g in values], axis=0)[np.array(initial_states).astype(int).reshape(-1)])
+
         Q = []
         for initial_state in initial_states:
             self.env.isd = np.eye(state_space_dim)[initial_state]
@@ -83,63 +112,106 @@ class ExactPolicyEvaluator(object):
         '''
         Run the evaluator
         '''
+        c, g, c_ci, g_ci = self.monte_carlo(policy, render=render, verbose=verbose)
+        self.confidence_intervals = (c_ci, g_ci)
+        return c,g
 
-        all_c = []
-        all_g = []
-        if len(policy) > 1: import pdb; pdb.set_trace()
-        for pi in policy:
-            trial_c = []
-            trial_g = []
-            for i in range(1):
-                c = []
-                g = []
-                self.buffer = Buffer(num_frame_stack= self.num_frame_stack,buffer_size= self.buffer_size,min_buffer_size_to_train= self.min_buffer_size_to_train,pic_size = self.pic_size,)
-                x = self.env.reset()
-                self.buffer.start_new_episode(x)
-                done = False
-                time_steps = 0
-                
-                while not done:
-                    time_steps += 1
-                    if (self.env.env_type in ['car']) or render: self.env.render()
+    def monte_carlo(self, policy, num_trials=None, num_workers=None, seed=None, confidence=.95, render=False, verbose=False):
+        '''
+        Monte Carlo estimate of C and G, with trials run on num_workers env replicas in parallel.
+        The policy is queried once per step for all replicas that run it.
+
+        policy: list of policies. Evaluates their mixture, trial t is run with policy[t % len(policy)]
+        num_trials, num_workers: default to the constructor's. num_workers=0 runs one trial at a time on self.env.
+                                 num_trials is rounded up to a multiple of len(policy), so every policy is run
+        seed: trial t seeds its env with seed+t. None: random seeds for the workers, self.env is not reseeded
 
-                    action = pi([self.buffer.current_state()])[0]
-
-                    cost = []
-                    for _ in range(self.frame_skip):
-                        x_prime, costs, done, _ = self.env.step(self.action_space_map[action])
-                        # if self.render:
-                        #     self.env.render()
-                        cost.append(costs)
-                        if done:
-                            break
-                    
-                    cost = np.vstack([np.hstack(x) for x in cost]).sum(axis=0)
+        Returns c, g, and the half widths of their confidence intervals (nan with one trial per policy)
+        '''
+        num_trials = self.num_trials if num_trials is None else num_trials
+        num_workers = self.num_workers if num_workers is None else num_workers
+        if not isinstance(policy,(list,)):
+            policy = [policy]
+        num_trials = int(np.ceil(num_trials/float(len(policy))))*len(policy)
+
+        if num_workers == 0:
+            envs = EnvPool(None, 1, frame_skip=self.frame_skip, env=self.env)
+        else:
+            if seed is None: seed = np.random.randint(2**30)
+            envs = EnvPool(self.env_factory, min(num_workers, num_trials), frame_skip=self.frame_skip)
+
+        trials = []      # (policy idx, discounted c, discounted g)
+        running = {}     # replica -> [trial, buffer, c, g]
+        next_trial = 0
+        try:
+            while (next_trial < num_trials) or running:
+                # start trials on free replicas
+                free = [idx for idx in range(envs.num_envs) if idx not in running][:num_trials-next_trial]
+                seeds = None if seed is None else [seed + next_trial + k for k in range(len(free))]
+                for idx, x in zip(free, envs.reset(free, seeds) if free else []):
+                    buf = Buffer(num_frame_stack= self.num_frame_stack,buffer_size= self.buffer_size,min_buffer_size_to_train= self.min_buffer_size_to_train,pic_size = self.pic_size,)
+                    buf.start_new_episode(x)
+                    running[idx] = [next_trial, buf, [], []]
+                    next_trial += 1
+
+                if (num_workers == 0) and ((self.env.env_type in ['car']) or render): self.env.render()
+
+                # one forward pass per policy
+                idxs = sorted(running)
+                actions = {}
+                for pi_idx, pi in enumerate(policy):
+                    group = [idx for idx in idxs if (running[idx][0] % len(policy)) == pi_idx]
+                    if len(group) == 0: continue
+                    for idx, action in zip(group, pi([running[idx][1].current_state() for idx in group])):
+                        actions[idx] = action
+
+                outputs = envs.step(idxs,
+                                    [self.action_space_map[actions[idx]] for idx in idxs],
+                                    [len(running[idx][2])+1 for idx in idxs],
+                                    [sum(running[idx][2]) for idx in idxs])
+
+                for idx, (x_prime, cost, done, early_done, _) in zip(idxs, outputs):
+                    trial, buf, c, g = running[idx]
                     if self.constraint_thresholds is not None: 
                         cost[1:][self.constraints_cared_about] = np.array(cost[1:])[self.constraints_cared_about] >= self.constraint_thresholds[:-1]
+                    done = done or early_done
+                    buf.append(actions[idx], x_prime, cost[0], done)
 
+                    if verbose: print trial,actions[idx],x_prime,cost
 
-                    early_done, _ = self.env.is_early_episode_termination(cost=cost[0], time_steps=time_steps, total_cost=sum(c))
-                    done = done or early_done
-                    self.buffer.append(action, x_prime, cost[0], done)
-                    
-                    if verbose: print x,action,x_prime,cost
-                    
                     c.append(cost[0].tolist())
                     g.append(cost[1:].tolist())
+                    if done:
+                        trials.append([trial % len(policy), self.discounted_sum(c, self.gamma), [self.discounted_sum(cost, self.gamma) for cost in np.array(g).T]])
+                        del running[idx]
+        finally:
+            envs.close()
 
-                    x = x_prime
-                trial_c.append(c)
-                trial_g.append(g)
-
-            all_c.append(np.mean([self.discounted_sum(x, self.gamma) for x in trial_c]))
-            all_g.append(np.mean([ [self.discounted_sum(cost, self.gamma) for cost in np.array(x).T] for x in trial_g], axis=0).tolist())
-            # all_g.append(np.mean([self.discounted_sum(x, self.gamma) for x in trial_g]))
-        
-        c = np.mean(all_c, axis=0)
-        g = np.mean(all_g, axis=0)
+        return self.mixture_estimate(trials, len(policy), confidence)
 
-        return c,g
+    @staticmethod
+    def mixture_estimate(trials, num_policies, confidence=.95):
+        '''
+        Mean over policies of their mean discounted C, G, stratified by policy, and
+        the half widths of the normal confidence intervals
+        '''
+        z = stats.norm.ppf(.5 + confidence/2.)
+        c_means, g_means, c_vars, g_vars = [], [], [], []
+        for pi_idx in range(num_policies):
+            c = np.array([trial[1] for trial in trials if trial[0] == pi_idx])
+            g = np.array([trial[2] for trial in trials if trial[0] == pi_idx])
+            if len(c) == 0: # monte_carlo runs every policy, this is for direct callers
+                raise ValueError('No trials of policy %s of the mixture, need num_trials >= %s' % (pi_idx, num_policies))
+            c_means.append(np.mean(c))
+            g_means.append(np.mean(g, axis=0))
+            c_vars.append(np.var(c, ddof=1)/len(c) if len(c) > 1 else np.nan)
+            g_vars.append(np.var(g, axis=0, ddof=1)/len(g) if len(g) > 1 else np.nan*np.ones(g.shape[1:]))
+
+        c = np.mean(c_means)
+        g = np.mean(g_means, axis=0)
+        c_ci = z*np.sqrt(np.sum(c_vars))/num_policies
+        g_ci = z*np.sqrt(np.sum(g_vars, axis=0))/num_policies
+        return c, g, c_ci, g_ci
 
 
     def determinstic_env_and_greedy_policy(self, policy, render=False, verbose=False, to_monitor=False, **kw):
@@ -229,6 +301,63 @@ class ExactPolicyEvaluator(object):
         else:
             return c,g, -c
 
+    def tabular_env_and_greedy_policy(self, policy):
+        '''
+        Same output as determinstic_env_and_greedy_policy, from env.P
+        '''
+        isd = np.array(self.env.isd, dtype=float)
+        all_c = []
+        all_g = []
+        for pi in policy:
+            c, g = self.values_of_all_states(pi)
+            all_c.append(isd.dot(c))
+            all_g.append(isd.dot(g))
+
+        c = np.mean(all_c)
+        g = np.mean(all_g, axis=0).tolist()
+        return c,g, -c
+
+    def values_of_all_states(self, pi):
+        '''
+        Discounted C and G of greedy policy pi from every start state: (nS,), (nS, num constraints).
+
+        Backward recursion over the episode length, so episodes cut off by
+        is_early_episode_termination are counted exactly like in the rollout
+        '''
+        nS = self.env.nS
+        next_state, costs = self.transition_model()
+        actions = np.array(pi(np.arange(nS))).astype(int).reshape(-1)
+
+        states = np.arange(nS)
+        P_pi = next_state[states, actions]                      # (nS, nS), already times (1-done)
+        costs_pi = costs[states, actions]                       # (nS, 1 + num constraints)
+
+        # the rollout stops after max_time_steps+1 steps
+        horizon = self.env.max_time_steps + 1
+        V = np.zeros_like(costs_pi)
+        for _ in range(horizon):
+            V = costs_pi + self.gamma*P_pi.dot(V)
+        return V[:,0], V[:,1:]
+
+    def transition_model(self):
+        '''
+        From env.P: expected (1-done)-weighted next state distribution (nS, nA, nS)
+        and expected costs [c, g...] (nS, nA, 1 + num constraints), as the env's step reports them
+        '''
+        if self.transitions is None:
+            nS, nA = self.env.nS, self.env.nA
+            next_state = np.zeros((nS, nA, nS))
+            costs = None
+            for x in range(nS):
+                for a in range(nA):
+                    for p, x_prime, r, d in self.env.P[x][a]:
+                        cost = np.hstack([-r, int(d and not r)])
+                        if costs is None: costs = np.zeros((nS, nA, len(cost)))
+                        costs[x,a] += p*cost
+                        next_state[x,a,x_prime] += p*(1-d)
+            self.transitions = (next_state, costs)
+        return self.transitions
+
     @staticmethod
     def discounted_sum(costs, discount):
         '''
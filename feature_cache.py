@@ -0,0 +1,67 @@
+import os
+import hashlib
+import numpy as np
+
+
+class FeatureCache(object):
+    def __init__(self, Q, dataset, cache_dir=None, batch_size=512):
+        '''
+        Output of the frozen conv stack ('flattened' layer of a CarNN) for every
+        state of the dataset, computed in one pass.
+
+        States are stacks of frame indices; prev_states and next_states mostly hold
+        the same stacks, so features are stored once per unique stack and looked up
+        through prev_states/next_states (indices into self.features).
+
+        Q: CarNN whose conv layers are frozen
+        dataset: dataset with 'frames', 'prev_states', 'next_states'
+        cache_dir: if given, the features are memory-mapped from
+                   <cache_dir>/features_<key>.npy (reused across runs), otherwise kept in RAM
+        '''
+        self.key = self.key_of(Q, dataset)
+
+        stacks = np.vstack([dataset['prev_states'], dataset['next_states']])
+        unique_stacks, inverse = np.unique(stacks, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        self.prev_states = inverse[:len(dataset['prev_states'])]
+        self.next_states = inverse[len(dataset['prev_states']):]
+
+        shape = (len(unique_stacks), Q.feature_dim())
+        if cache_dir is None:
+            self.path = None
+            self.features = np.empty(shape, dtype='float32')
+            self.compute(Q, dataset, unique_stacks, self.features, batch_size)
+        else:
+            self.path = os.path.join(cache_dir, 'features_%s.npy' % self.key)
+            if not os.path.isfile(self.path):
+                tmp_path = self.path + '.tmp'
+                out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float32', shape=shape)
+                self.compute(Q, dataset, unique_stacks, out, batch_size)
+                out.flush()
+                del out
+                # only a complete file ever shows up under self.path
+                os.rename(tmp_path, self.path)
+            self.features = np.load(self.path, mmap_mode='r')
+
+    @staticmethod
+    def compute(Q, dataset, unique_stacks, out, batch_size):
+        # unique_stacks is sorted, so the frames are read roughly in order
+        for low in range(0, len(unique_stacks), batch_size):
+            X = np.rollaxis(dataset['frames'][unique_stacks[low:(low+batch_size)]],1,4)
+            out[low:(low+batch_size)] = Q.features([X], x_preprocessed=True)
+
+    @staticmethod
+    def key_of(Q, dataset):
+        '''
+        sha1 of the conv weights and the state indices: the features change iff these do
+        '''
+        sha1 = hashlib.sha1()
+        for w in Q.conv_weights() + [dataset['prev_states'], dataset['next_states']]:
+            sha1.update(np.ascontiguousarray(w).tobytes())
+        return sha1.hexdigest()
+
+    def prev(self, idxs):
+        return np.asarray(self.features[self.prev_states[idxs]])
+
+    def next(self, idxs):
+        return np.asarray(self.features[self.next_states[idxs]])
@@ -1,9 +1,10 @@
 
 from keras import backend as K
 import numpy as np
+from feature_cache import FeatureCache
 
 class FittedAlgo(object):
-    def __init__(self):
+    def __init__(self, warm_start=False, warm_start_epochs=None):
         '''
         An implementation of fitted Q iteration
 
@@ -11,7 +12,12 @@ class FittedAlgo(object):
         dim_of_actions: dimension of action space
         max_epochs: positive int, specifies how many iterations to run the algorithm
         gamma: discount factor
+        warm_start: continue from the networks of the previous run instead of reinitializing them, see networks
+        warm_start_epochs: max_epochs of the warm runs. None: max_epochs
         '''
+        self.warm_start = warm_start
+        self.warm_start_epochs = warm_start_epochs
+        self.network_pool = {}
 
     def init_Q(self):
         '''
@@ -19,6 +25,58 @@ class FittedAlgo(object):
         '''
         pass
 
+    def networks(self, build, key=None, count=2):
+        '''
+        count networks for a run, e.g. Q_k and Q_k_minus_1, and whether they are warm.
+
+        The networks are pooled per key (architecture) and the next run reuses them instead of
+        building and compiling new graphs: reinitialized in place (reset_Q), or with warm_start
+        as the previous run left them. Lambda moves slowly, so the previous best response
+        (or evaluation) is a good start. The pool is rebuilt if the keras session was cleared.
+
+        So a network returned by run (e.g. the FQI policy) is only valid until the next run
+        with the same key: copy it (copy_over_to) to keep it, don't store the reference
+        '''
+        pool = self.network_pool.get(key)
+        if (pool is None) or (pool[0].model.outputs[0].graph is not K.get_session().graph):
+            self.network_pool[key] = [build() for _ in range(count)]
+            return self.network_pool[key], False
+        if self.warm_start:
+            return pool, True
+        for Q in pool:
+            self.reset_Q(Q)
+        return pool, False
+
+    def reset_Q(self, Q):
+        '''
+        A pooled network back to what init_Q returns, without building it again
+        '''
+        Q.reinitialize()
+        self.initialize_Q(Q)
+
+    def initialize_Q(self, Q):
+        '''
+        With frozen conv layers: conv weights of the initialization policy, fresh trainable layers
+        '''
+        if (getattr(self, 'initialization', None) is not None) and self.freeze_cnn_layers:
+            self.initialization.Q.copy_over_to(Q)
+            for layer in Q.model.layers:
+                if layer.trainable: 
+                    try:
+                        layer.kernel.initializer.run( session = K.get_session() )
+                    except:
+                        pass
+                    try:
+                        layer.bias.initializer.run( session = K.get_session() )
+                    except:
+                        pass
+            if Q.head is not None: Q.sync_to_head()
+
+    def num_epochs(self, warm):
+        if warm and (self.warm_start_epochs is not None):
+            return self.warm_start_epochs
+        return self.max_epochs
+
     def fit(self, X, y, epsilon=1e-10, **kw):
         # D_k = {(X,y)} is the dataset of the kth iteration of Fitted Q
         # self.Q_k = self.init_Q(epsilon)
@@ -33,6 +91,39 @@ class FittedAlgo(object):
         self.Q_k.epsilon = epsilon
         self.Q_k.fit_generator(generator, **kw)
 
+    def feature_cache(self, dataset, Q):
+        '''
+        Frozen conv features of the dataset. Kept on the dataset, so FQI and FQE
+        share them for as long as the conv weights and the data stay the same.
+        '''
+        cache = getattr(dataset, 'feature_cache', None)
+        if (cache is None) or (cache.key != FeatureCache.key_of(Q, dataset)):
+            cache = FeatureCache(Q, dataset, cache_dir=self.feature_cache_dir)
+            dataset.feature_cache = cache
+        return cache
+
+    def sweep_targets(self, dataset, idxs, batch_size=512, **kw):
+        '''
+        Bellman targets for every idx, computed in one pass of large batches.
+
+        Q_k_minus_1 is frozen for a whole outer iteration, so its targets can be
+        computed once up front instead of again for every training batch.
+        Returns a float64 array over the whole dataset (one column per output when
+        there are several); only idxs are filled in.
+        '''
+        idxs = np.sort(idxs) # sequential reads when the frames are memory-mapped
+        targets = np.zeros((len(dataset['a']),) + np.shape(dataset['cost'])[1:], dtype='float64')
+        for low in range(0, len(idxs), batch_size):
+            batch_idxs = idxs[low:(low+batch_size)]
+            targets[batch_idxs] = self.bellman_targets(dataset, batch_idxs, **kw)
+        return targets
+
+    def bellman_targets(self, dataset, idxs, features=None):
+        '''
+        Absract function
+        '''
+        pass
+
     def skim(self, X_a, x_prime):
         full_set = np.hstack([X_a, x_prime.reshape(1,-1).T])
         idxs = np.unique(full_set, axis=0, return_index=True)[1]
@@ -3,11 +3,11 @@ from fitted_algo import FittedAlgo
 import numpy as np
 from tqdm import tqdm
 from env_nn import *
-from thread_safe import threadsafe_generator
+from batch_loader import BatchLoader
 from keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
 
 class LakeFittedQEvaluation(FittedAlgo):
-    def __init__(self, initial_states, num_inputs, grid_shape, dim_of_actions, max_epochs, gamma,model_type='mlp', position_of_goals=None, position_of_holes=None, num_frame_stack=None):
+    def __init__(self, initial_states, num_inputs, grid_shape, dim_of_actions, max_epochs, gamma,model_type='mlp', position_of_goals=None, position_of_holes=None, num_frame_stack=None, warm_start=False, warm_start_epochs=None):
 
         '''
         An implementation of fitted Q iteration
@@ -16,6 +16,8 @@ class LakeFittedQEvaluation(FittedAlgo):
         dim_of_actions: dimension of action space
         max_epochs: positive int, specifies how many iterations to run the algorithm
         gamma: discount factor
+        warm_start: start each run from the Q of the previous one, see FittedAlgo.networks
+        warm_start_epochs: max_epochs of the warm runs. None: max_epochs
         '''
         self.model_type = model_type
         self.initial_states = initial_states
@@ -28,13 +30,13 @@ class LakeFittedQEvaluation(FittedAlgo):
         self.position_of_goals = position_of_goals
         self.num_frame_stack = num_frame_stack
 
-        super(LakeFittedQEvaluation, self).__init__()
+        super(LakeFittedQEvaluation, self).__init__(warm_start, warm_start_epochs)
 
     def run(self, policy, which_cost, dataset, epochs=500, epsilon=1e-8, desc='FQE', g_idx=None, **kw):
         # dataset is the original dataset generated by pi_{old} to which we will find
         # an approximately optimal Q
-
-        self.Q_k = self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, **kw)
+        # which_cost='all' evaluates c and every g at once: one output per cost,
+        # and the returned values are arrays [C, G_0, ..., G_m]
 
         X_a = np.hstack(dataset.get_state_action_pairs('lake'))
         x_prime = dataset['x_prime']
@@ -45,11 +47,15 @@ class LakeFittedQEvaluation(FittedAlgo):
         dataset.set_cost(which_cost, idx=g_idx)
         dataset_costs = dataset['cost'][index_of_skim]
         dones = dataset['done'][index_of_skim]
+        not_done = (1-dones.astype(int)).reshape((-1,) + (1,)*(dataset_costs.ndim-1))
         pi_of_x_prime = policy(x_prime)
         x_prime = x_prime.reshape(-1)
 
+        num_outputs = dataset_costs.shape[1] if dataset_costs.ndim > 1 else 1
+        (self.Q_k,), warm = self.networks(lambda: self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, num_outputs=num_outputs, **kw), key=num_outputs, count=1)
+
         values = []
-        for k in tqdm(range(self.max_epochs), desc=desc):
+        for k in tqdm(range(self.num_epochs(warm)), desc=desc):
 
             # {((x,a), r+gamma* Q(x',pi(x')))}
             
@@ -57,20 +63,20 @@ class LakeFittedQEvaluation(FittedAlgo):
             #     # Q_0 = 0 everywhere
             #     costs = dataset_costs
             # else:
-            costs = dataset_costs + (self.gamma*self.Q_k(x_prime, pi_of_x_prime).reshape(-1)*(1-dones.astype(int))).reshape(-1)
+            costs = dataset_costs + self.gamma*self.Q_k(x_prime, pi_of_x_prime).reshape(dataset_costs.shape)*not_done
 
             # if (k >= (self.max_epochs-100)): K.set_value(self.Q_k.model.optimizer.lr, 0.00001)
             self.fit(X_a, costs, epochs=epochs, batch_size=X_a.shape[0], epsilon=epsilon, evaluate=False, verbose=0)
-            values.append(np.mean([self.Q_k(state, policy(state)) for state in self.initial_states]))
+            values.append(np.mean([self.Q_k(state, policy(state)).reshape(-1) for state in self.initial_states], axis=0).reshape(dataset_costs.shape[1:])*dataset.scale)
             print values[-1]
             # if not self.Q_k.callbacks_list[0].converged:
             #     print 'Continuing training due to lack of convergence'
             #     self.fit(X_a, costs, epochs=epochs, batch_size=X_a.shape[0], epsilon=epsilon, evaluate=False, verbose=0)
 
-        return np.mean(values[-10:]), values #np.mean([self.Q_k(state, policy(state)) for state in self.initial_states])
+        return np.mean(values[-10:], axis=0), values #np.mean([self.Q_k(state, policy(state)) for state in self.initial_states])
 
-    def init_Q(self, epsilon=1e-10, **kw):
-        return LakeNN(self.num_inputs, 1, self.grid_shape, self.dim_of_actions, self.gamma, epsilon, **kw)
+    def init_Q(self, epsilon=1e-10, num_outputs=1, **kw):
+        return LakeNN(self.num_inputs, num_outputs, self.grid_shape, self.dim_of_actions, self.gamma, epsilon, **kw)
 
 class CarFittedQEvaluation(FittedAlgo):
     def __init__(self, state_space_dim, 
@@ -78,7 +84,14 @@ class CarFittedQEvaluation(FittedAlgo):
                        max_epochs, 
                        gamma, 
                        model_type='cnn', 
-                       num_frame_stack=None):
+                       num_frame_stack=None,
+                       initialization=None,
+                       freeze_cnn_layers=False,
+                       target_sweep=True,
+                       cache_features=True,
+                       feature_cache_dir=None,
+                       warm_start=False,
+                       warm_start_epochs=None):
 
         '''
         An implementation of fitted Q iteration
@@ -87,7 +100,18 @@ class CarFittedQEvaluation(FittedAlgo):
         dim_of_actions: dimension of action space
         max_epochs: positive int, specifies how many iterations to run the algorithm
         gamma: discount factor
+        target_sweep: compute all Bellman targets once per iteration instead of per batch
+        cache_features: with frozen conv layers, compute the conv features of the dataset
+                        once and train only the dense layers on them
+        feature_cache_dir: where to memory-map the cached features. None keeps them in RAM
+        warm_start: start each run from the Q of the previous one, see FittedAlgo.networks
+        warm_start_epochs: max_epochs of the warm runs. None: max_epochs
         '''
+        self.initialization = initialization
+        self.freeze_cnn_layers = freeze_cnn_layers
+        self.target_sweep = target_sweep
+        self.cache_features = cache_features and freeze_cnn_layers and (initialization is not None)
+        self.feature_cache_dir = feature_cache_dir
         self.model_type = model_type
 
 
@@ -105,14 +129,17 @@ class CarFittedQEvaluation(FittedAlgo):
 
         self.more_callbacks = [earlyStopping, mcp_save, reduce_lr_loss]
 
-        super(CarFittedQEvaluation, self).__init__()
+        super(CarFittedQEvaluation, self).__init__(warm_start, warm_start_epochs)
 
     def run(self, policy, which_cost, dataset, epochs=1, epsilon=1e-8, desc='FQE', g_idx=None, testing=True, **kw):
         # dataset is the original dataset generated by pi_{old} to which we will find
         # an approximately optimal Q
+        # which_cost='all' evaluates c and every g at once: one output per cost,
+        # and the returned values are arrays [C, G_0, ..., G_m]
         
         dataset.set_cost(which_cost, idx=g_idx)
         print 'Scale: ', dataset.scale
+        num_outputs = dataset['cost'].shape[1] if dataset['cost'].ndim > 1 else 1
         # try:
         #     initial_states = np.unique([episode.frames[[0]*episode.num_frame_stack] for episode in dataset.episodes], axis=0)
         # except:
@@ -120,16 +147,20 @@ class CarFittedQEvaluation(FittedAlgo):
 
         initial_states = np.rollaxis(dataset['frames'][dataset['prev_states'][[0]]],1,4)
 
-        # if self.Q_k is None:
-        self.Q_k = self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, **kw)
-        self.Q_k_minus_1 = self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, **kw)
+        (self.Q_k, self.Q_k_minus_1), warm = self.networks(lambda: self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, num_outputs=num_outputs, **kw), key=num_outputs)
         x_prime = np.rollaxis(dataset['frames'][dataset['next_states'][[0]]], 1,4)
-        self.Q_k.min_over_a([x_prime], x_preprocessed=True)[0]
-        self.Q_k_minus_1.min_over_a([x_prime], x_preprocessed=True)[0]
+        self.Q_k.all_actions([x_prime], x_preprocessed=True)
+        self.Q_k_minus_1.all_actions([x_prime], x_preprocessed=True)
+        features = None
+        if self.cache_features:
+            for Q in [self.Q_k, self.Q_k_minus_1]:
+                if Q.head is None: Q.create_head()
+            features = self.feature_cache(dataset, self.Q_k)
         self.Q_k.copy_over_to(self.Q_k_minus_1)
         values = []
+        loader_stats = []
 
-        for k in tqdm(range(self.max_epochs), desc=desc):
+        for k in tqdm(range(self.num_epochs(warm)), desc=desc):
             batch_size = 32
             
             dataset_length = len(dataset)
@@ -140,78 +171,79 @@ class CarFittedQEvaluation(FittedAlgo):
             training_steps_per_epoch = int(.3 * np.ceil(len(training_idxs)/float(batch_size)))
             validation_steps_per_epoch = int(np.ceil(len(validation_idxs)/float(batch_size)))
             # steps_per_epoch = 1 #int(np.ceil(len(dataset)/float(batch_size)))
-            train_gen = self.generator(policy, dataset, training_idxs, fixed_permutation=True, batch_size=batch_size)
-            # val_gen = self.generator(policy, dataset, validation_idxs, fixed_permutation=True, batch_size=batch_size)
+            targets = None
+            if self.target_sweep:
+                # only training_steps_per_epoch batches are drawn, so only sweep those samples
+                training_idxs = training_idxs[:(training_steps_per_epoch*batch_size)]
+                targets = self.sweep_targets(dataset, training_idxs, features=features)
+            train_gen = self.batch_loader(dataset, training_idxs, batch_size=batch_size, targets=targets, features=features)
+            # val_gen = self.batch_loader(dataset, validation_idxs, batch_size=batch_size)
             
             self.fit_generator(train_gen, 
                                steps_per_epoch=training_steps_per_epoch,
                                #validation_data=val_gen, 
                                #validation_steps=validation_steps_per_epoch,
                                epochs=epochs, 
-                               max_queue_size=10, 
-                               workers=4, 
-                               use_multiprocessing=False, 
+                               workers=0, # train_gen prefetches with its own workers
                                epsilon=epsilon, 
                                evaluate=False, 
                                verbose=0,
-                               additional_callbacks = self.more_callbacks)
+                               additional_callbacks = self.more_callbacks,
+                               on_features=features is not None)
+            train_gen.close()
+            loader_stats.append(train_gen.stats())
             self.Q_k.copy_over_to(self.Q_k_minus_1)
             if testing:
                 actions = policy(initial_states[:,np.newaxis,...], x_preprocessed=True)
                 assert len(actions) == initial_states.shape[0]
-                Q_val = self.Q_k.all_actions([initial_states], x_preprocessed=True)[np.arange(len(actions)), actions]
-                values.append(np.mean(Q_val)*dataset.scale)
+                Q_val = self.Q_k.all_actions([initial_states], x_preprocessed=True)[np.arange(len(actions)), ..., actions]
+                values.append(np.mean(Q_val, axis=0)*dataset.scale)
+
+        print BatchLoader.summarize(loader_stats)
 
         # initial_states = self.Q_k.representation(initial_states)
         if testing:
-            return np.mean(values[-10:]), values
+            return np.mean(values[-10:], axis=0), values
         actions = policy(initial_states[:,np.newaxis,...], x_preprocessed=True)
-        Q_val = self.Q_k.all_actions([initial_states], x_preprocessed=True)[np.arange(len(actions)), actions]
-        return np.mean(Q_val)*dataset.scale, values
-
-    @threadsafe_generator
-    def generator(self, policy, dataset, training_idxs, fixed_permutation=False,  batch_size = 64):
-        data_length = len(training_idxs)
-        steps = int(np.ceil(data_length/float(batch_size)))
-        i = -1
-        amount_of_data_calcd = 0
-        if fixed_permutation:
-            calcd_costs = np.empty((len(training_idxs),), dtype='float64')
-        while True:
-            i = (i + 1) % steps
-            # print 'Getting batch: %s to %s' % ((i*batch_size),((i+1)*batch_size))
-            if fixed_permutation:
-                if i == 0: perm = np.random.permutation(training_idxs)
-                batch_idxs = perm[(i*batch_size):((i+1)*batch_size)]
+        Q_val = self.Q_k.all_actions([initial_states], x_preprocessed=True)[np.arange(len(actions)), ..., actions]
+        return np.mean(Q_val, axis=0)*dataset.scale, values
+
+    def bellman_targets(self, dataset, idxs, features=None):
+        # {((x,a), c+gamma*Q(x',pi(x')))}
+        dones = dataset['done'][idxs]
+        policy_action = dataset['pi_of_x_prime'][idxs]
+        if features is None:
+            x_prime = np.rollaxis(dataset['frames'][dataset['next_states'][idxs]],1,4)
+            Q_x_prime = self.Q_k_minus_1.all_actions([x_prime], x_preprocessed=True)
+        else:
+            Q_x_prime = self.Q_k_minus_1.all_actions_from_features(features.next(idxs))
+        Q_val = Q_x_prime[np.arange(len(policy_action)), ..., policy_action] # (N,) or (N, num_outputs)
+        not_done = (1-dones.astype(int)).reshape((-1,) + (1,)*(Q_val.ndim-1))
+        return dataset['cost'][idxs] + self.gamma*Q_val*not_done
+
+    def batch_loader(self, dataset, training_idxs, batch_size=64, targets=None, features=None, num_workers=4, max_queue_size=10):
+        def fill_batch(batch_idxs, X, mask, costs):
+            if features is None:
+                X[...] = np.rollaxis(dataset['frames'][dataset['prev_states'][batch_idxs]],1,4)
             else:
-                batch_idxs = np.random.choice(training_idxs, batch_size)
-            # amount_of_data_calcd += len(batch_idxs)
-            # import pdb; pdb.set_trace()  
-            
-            X = np.rollaxis(dataset['frames'][dataset['prev_states'][batch_idxs]],1,4)
-            actions = np.atleast_2d(dataset['a'][batch_idxs]).T
-            x_prime = np.rollaxis(dataset['frames'][dataset['next_states'][batch_idxs]],1,4)
-            dataset_costs = dataset['cost'][batch_idxs]
-            dones = dataset['done'][batch_idxs]
-            policy_action = dataset['pi_of_x_prime'][batch_idxs]
-
-            # if fixed_permutation:
-            #     if amount_of_data_calcd <= data_length:
-            #         costs = dataset_costs + self.gamma*self.Q_k_minus_1.min_over_a([x_prime], x_preprocessed=True)[0]*(1-dones.astype(int))
-            #         calcd_costs[(i*batch_size):((i+1)*batch_size)] = costs
-            #     else:
-            #         costs = calcd_costs[(i*batch_size):((i+1)*batch_size)]
-            # else:
-            # policy_action = policy(x_prime[:,np.newaxis,...], x_preprocessed=True)
-            Q_val = self.Q_k_minus_1.all_actions([x_prime], x_preprocessed=True)[np.arange(len(policy_action)), policy_action]
-            costs = dataset_costs + (self.gamma*Q_val.reshape(-1)*(1-dones.astype(int))).reshape(-1)
+                X[...] = features.prev(batch_idxs)
+            mask[...] = 0
+            mask[np.arange(len(batch_idxs)), dataset['a'][batch_idxs]] = 1
+            if targets is not None:
+                costs[...] = targets[batch_idxs]
+            else:
+                costs[...] = self.bellman_targets(dataset, batch_idxs, features=features)
 
-            X = self.Q_k_minus_1.representation([X], actions, x_preprocessed=True)
+            return [X, mask], costs
 
-            yield (X, costs)
+        X_shape = self.state_space_dim if features is None else features.features.shape[1:]
+        buffer_specs = [(X_shape, 'float32'), ((self.dim_of_actions,), 'float32'), (dataset['cost'].shape[1:], 'float64')]
+        return BatchLoader(training_idxs, batch_size, buffer_specs, fill_batch, num_workers=num_workers, max_queue_size=max_queue_size)
 
-    def init_Q(self, epsilon=1e-10, **kw):
-        return CarNN(self.state_space_dim, self.dim_of_actions, self.gamma, convergence_of_model_epsilon=epsilon, **kw)
+    def init_Q(self, epsilon=1e-10, num_outputs=1, **kw):
+        model = CarNN(self.state_space_dim, self.dim_of_actions, self.gamma, convergence_of_model_epsilon=epsilon, freeze_cnn_layers=self.freeze_cnn_layers, num_outputs=num_outputs, **kw)
+        self.initialize_Q(model)
+        return model
 
 
 
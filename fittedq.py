@@ -3,12 +3,12 @@ from fitted_algo import FittedAlgo
 import numpy as np
 from tqdm import tqdm
 from env_nn import *
-from thread_safe import threadsafe_generator
+from batch_loader import BatchLoader
 from keras import backend as K
 from keras.callbacks import EarlyStopping, ModelCheckpoint, ReduceLROnPlateau
 
 class LakeFittedQIteration(FittedAlgo):
-    def __init__(self, num_inputs, grid_shape, dim_of_actions, max_epochs, gamma, model_type='mlp', position_of_goals=None, position_of_holes=None, num_frame_stack=None):
+    def __init__(self, num_inputs, grid_shape, dim_of_actions, max_epochs, gamma, model_type='mlp', position_of_goals=None, position_of_holes=None, num_frame_stack=None, warm_start=False, warm_start_epochs=None):
         '''
         An implementation of fitted Q iteration
 
@@ -16,6 +16,8 @@ class LakeFittedQIteration(FittedAlgo):
         dim_of_actions: dimension of action space
         max_epochs: positive int, specifies how many iterations to run the algorithm
         gamma: discount factor
+        warm_start: start each run from the Q of the previous one, see FittedAlgo.networks
+        warm_start_epochs: max_epochs of the warm runs. None: max_epochs
         '''
         self.model_type = model_type
         self.num_inputs = num_inputs
@@ -27,14 +29,14 @@ class LakeFittedQIteration(FittedAlgo):
         self.position_of_holes = position_of_holes
         self.num_frame_stack = num_frame_stack
 
-        super(LakeFittedQIteration, self).__init__()
+        super(LakeFittedQIteration, self).__init__(warm_start, warm_start_epochs)
 
 
     def run(self, dataset, epochs=3000, epsilon=1e-8, desc='FQI', **kw):
         # dataset is the original dataset generated by pi_{old} to which we will find
-        # an approximately optimal Q
+        # an approximately optimal Q. The returned Q is pooled: valid until the next run
 
-        self.Q_k = self.init_Q(model_type=self.model_type, position_of_holes=self.position_of_holes, position_of_goals=self.position_of_goals, num_frame_stack=self.num_frame_stack, **kw)
+        (self.Q_k,), warm = self.networks(lambda: self.init_Q(model_type=self.model_type, position_of_holes=self.position_of_holes, position_of_goals=self.position_of_goals, num_frame_stack=self.num_frame_stack, **kw), count=1)
 
         X_a = np.hstack(dataset.get_state_action_pairs())
         x_prime = dataset['x_prime']
@@ -45,7 +47,7 @@ class LakeFittedQIteration(FittedAlgo):
         dataset_costs = dataset['cost'][index_of_skim]
         dones = dataset['done'][index_of_skim]
         
-        for k in tqdm(range(self.max_epochs), desc=desc):
+        for k in tqdm(range(self.num_epochs(warm)), desc=desc):
             
             # {((x,a), c+gamma*min_a Q(x',a))}
             costs = dataset_costs + self.gamma*self.Q_k.min_over_a(x_prime)[0]*(1-dones.astype(int))
@@ -71,7 +73,12 @@ class CarFittedQIteration(FittedAlgo):
                        model_type='cnn', 
                        num_frame_stack=None,
                        initialization=None,
-                       freeze_cnn_layers=False):
+                       freeze_cnn_layers=False,
+                       target_sweep=True,
+                       cache_features=True,
+                       feature_cache_dir=None,
+                       warm_start=False,
+                       warm_start_epochs=None):
         '''
         An implementation of fitted Q iteration
 
@@ -79,7 +86,16 @@ class CarFittedQIteration(FittedAlgo):
         dim_of_actions: dimension of action space
         max_epochs: positive int, specifies how many iterations to run the algorithm
         gamma: discount factor
+        target_sweep: compute all Bellman targets once per iteration instead of per batch
+        cache_features: with frozen conv layers, compute the conv features of the dataset
+                        once and train only the dense layers on them
+        feature_cache_dir: where to memory-map the cached features. None keeps them in RAM
+        warm_start: start each run from the Q of the previous one, see FittedAlgo.networks
+        warm_start_epochs: max_epochs of the warm runs. None: max_epochs
         '''
+        self.target_sweep = target_sweep
+        self.cache_features = cache_features and freeze_cnn_layers and (initialization is not None)
+        self.feature_cache_dir = feature_cache_dir
         self.initialization = initialization
         self.freeze_cnn_layers = freeze_cnn_layers
         self.model_type = model_type
@@ -97,23 +113,29 @@ class CarFittedQIteration(FittedAlgo):
 
         self.more_callbacks = [earlyStopping, mcp_save, reduce_lr_loss]
 
-        super(CarFittedQIteration, self).__init__()
+        super(CarFittedQIteration, self).__init__(warm_start, warm_start_epochs)
 
 
     def run(self, dataset, epochs=1, epsilon=1e-8, desc='FQI', exact=None, **kw):
         # dataset is the original dataset generated by pi_{old} to which we will find
-        # an approximately optimal Q
+        # an approximately optimal Q. The returned Q is pooled: valid until the next run
 
-        # if self.Q_k is None:
-        self.Q_k = self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, **kw)
-        self.Q_k_minus_1 = self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, **kw)
+        (self.Q_k, self.Q_k_minus_1), warm = self.networks(lambda: self.init_Q(model_type=self.model_type, num_frame_stack=self.num_frame_stack, **kw))
+        max_epochs = self.num_epochs(warm)
         x_prime = np.rollaxis(dataset['frames'][dataset['next_states'][[0]]], 1,4)
         self.Q_k.min_over_a([x_prime], x_preprocessed=True)[0]
         self.Q_k_minus_1.min_over_a([x_prime], x_preprocessed=True)[0]
+        features = None
+        if self.cache_features:
+            for Q in [self.Q_k, self.Q_k_minus_1]:
+                if Q.head is None: Q.create_head()
+            features = self.feature_cache(dataset, self.Q_k)
         self.Q_k.copy_over_to(self.Q_k_minus_1)
+        if warm: K.set_value((self.Q_k.model if features is None else self.Q_k.head).optimizer.lr, self.Q_k.learning_rate) # lowered in the last epochs of the previous run
         values = []
+        loader_stats = []
 
-        for k in tqdm(range(self.max_epochs), desc=desc):
+        for k in tqdm(range(max_epochs), desc=desc):
             batch_size = 64
             
             dataset_length = len(dataset)
@@ -124,78 +146,61 @@ class CarFittedQIteration(FittedAlgo):
             training_steps_per_epoch = int(np.ceil(len(training_idxs)/float(batch_size)))
             validation_steps_per_epoch = int(np.ceil(len(validation_idxs)/float(batch_size)))
             # steps_per_epoch = 1 #int(np.ceil(len(dataset)/float(batch_size)))
-            train_gen = self.generator(dataset, training_idxs, fixed_permutation=True, batch_size=batch_size)
-            # val_gen = self.generator(dataset, validation_idxs, fixed_permutation=True, batch_size=batch_size)
-            if (k >= (self.max_epochs-10)): K.set_value(self.Q_k.model.optimizer.lr, 0.0001)
+            targets = self.sweep_targets(dataset, training_idxs, features=features) if self.target_sweep else None
+            train_gen = self.batch_loader(dataset, training_idxs, batch_size=batch_size, targets=targets, features=features)
+            # val_gen = self.batch_loader(dataset, validation_idxs, batch_size=batch_size)
+            if (k >= (max_epochs-10)): K.set_value((self.Q_k.model if features is None else self.Q_k.head).optimizer.lr, 0.0001)
             self.fit_generator(train_gen, 
                                steps_per_epoch=training_steps_per_epoch,
                                #validation_data=val_gen, 
                                #validation_steps=validation_steps_per_epoch,
                                epochs=epochs, 
-                               max_queue_size=10, 
-                               workers=4, 
-                               use_multiprocessing=False, 
+                               workers=0, # train_gen prefetches with its own workers
                                epsilon=epsilon, 
                                evaluate=False, 
                                verbose=0,
-                               additional_callbacks = self.more_callbacks)
+                               additional_callbacks = self.more_callbacks,
+                               on_features=features is not None)
+            train_gen.close()
+            loader_stats.append(train_gen.stats())
             self.Q_k.copy_over_to(self.Q_k_minus_1)
-            if k >= (self.max_epochs-10):
-                c,g,perf = exact.run(self.Q_k,to_monitor=k==self.max_epochs)
+            if k >= (max_epochs-10):
+                c,g,perf = exact.run(self.Q_k,to_monitor=k==max_epochs)
                 values.append([c,perf])
                 
+        print BatchLoader.summarize(loader_stats)
         return self.Q_k, values
 
-    @threadsafe_generator
-    def generator(self, dataset, training_idxs, fixed_permutation=False,  batch_size = 64):
-        data_length = len(training_idxs)
-        steps = int(np.ceil(data_length/float(batch_size)))
-        i = -1
-        amount_of_data_calcd = 0
-        if fixed_permutation:
-            calcd_costs = np.empty((len(training_idxs),), dtype='float64')
-        while True:
-            i = (i + 1) % steps
-            # print 'Getting batch: %s to %s' % ((i*batch_size),((i+1)*batch_size))
-            if fixed_permutation:
-                if i == 0: perm = np.random.permutation(training_idxs)
-                batch_idxs = perm[(i*batch_size):((i+1)*batch_size)]
+    def bellman_targets(self, dataset, idxs, features=None):
+        # {((x,a), c+gamma*min_a Q(x',a))}
+        dones = dataset['done'][idxs]
+        if features is None:
+            x_prime = np.rollaxis(dataset['frames'][dataset['next_states'][idxs]],1,4)
+            Q_min = self.Q_k_minus_1.min_over_a([x_prime], x_preprocessed=True)[0]
+        else:
+            Q_min = self.Q_k_minus_1.all_actions_from_features(features.next(idxs)).min(axis=1)
+        return dataset['cost'][idxs] + self.gamma*Q_min*(1-dones.astype(int))
+
+    def batch_loader(self, dataset, training_idxs, batch_size=64, targets=None, features=None, num_workers=4, max_queue_size=10):
+        def fill_batch(batch_idxs, X, mask, costs):
+            if features is None:
+                X[...] = np.rollaxis(dataset['frames'][dataset['prev_states'][batch_idxs]],1,4)
             else:
-                batch_idxs = np.random.choice(training_idxs, batch_size)
-            # amount_of_data_calcd += len(batch_idxs)
-            # import pdb; pdb.set_trace()  
-            
-            X = np.rollaxis(dataset['frames'][dataset['prev_states'][batch_idxs]],1,4)
-            actions = np.atleast_2d(dataset['a'][batch_idxs]).T
-            x_prime = np.rollaxis(dataset['frames'][dataset['next_states'][batch_idxs]],1,4)
-            dataset_costs = dataset['cost'][batch_idxs]
-            dones = dataset['done'][batch_idxs]
-
-            # if fixed_permutation:
-            #     if amount_of_data_calcd <= data_length:
-            #         costs = dataset_costs + self.gamma*self.Q_k_minus_1.min_over_a([x_prime], x_preprocessed=True)[0]*(1-dones.astype(int))
-            #         calcd_costs[(i*batch_size):((i+1)*batch_size)] = costs
-            #     else:
-            #         costs = calcd_costs[(i*batch_size):((i+1)*batch_size)]
-            # else:
-            costs = dataset_costs + self.gamma*self.Q_k_minus_1.min_over_a([x_prime], x_preprocessed=True)[0]*(1-dones.astype(int))
+                X[...] = features.prev(batch_idxs)
+            mask[...] = 0
+            mask[np.arange(len(batch_idxs)), dataset['a'][batch_idxs]] = 1
+            if targets is not None:
+                costs[...] = targets[batch_idxs]
+            else:
+                costs[...] = self.bellman_targets(dataset, batch_idxs, features=features)
 
-            X = self.Q_k_minus_1.representation([X], actions, x_preprocessed=True)
+            return [X, mask], costs
 
-            yield (X, costs)
+        X_shape = self.state_space_dim if features is None else features.features.shape[1:]
+        buffer_specs = [(X_shape, 'float32'), ((self.dim_of_actions,), 'float32'), ((), 'float64')]
+        return BatchLoader(training_idxs, batch_size, buffer_specs, fill_batch, num_workers=num_workers, max_queue_size=max_queue_size)
 
     def init_Q(self, epsilon=1e-10, **kw):
         model = CarNN(self.state_space_dim, self.dim_of_actions, self.gamma, convergence_of_model_epsilon=epsilon, freeze_cnn_layers=self.freeze_cnn_layers, **kw)
-        if (self.initialization is not None) and self.freeze_cnn_layers:
-            self.initialization.Q.copy_over_to(model)
-            for layer in model.model.layers:
-                if layer.trainable: 
-                    try:
-                        layer.kernel.initializer.run( session = K.get_session() )
-                    except:
-                        pass
-                    try:
-                        layer.bias.initializer.run( session = K.get_session() )
-                    except:
-                        pass
+        self.initialize_Q(model)
         return model
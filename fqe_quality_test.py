@@ -118,7 +118,7 @@ def main(policy_old, policy, model_type='mlp'):
             trial_estimators = []
             for perc_num, percentage in enumerate(max_percentage):
                 K.clear_session()
-                idxs = np.random.permutation(np.arange(len(dataset.episodes))).tolist()
+                idxs = np.random.permutation(np.arange(dataset.num_episodes())).tolist()
                 estimators = run_trial(idxs, dataset, policy_old, policy, percentage, epsilon, fqi, fqe, ips, exact)
                 
                 trial_estimators.append(estimators)
@@ -142,43 +142,41 @@ def run_trial(idxs, dataset, policy_old, policy, percentage, epsilon, fqi, fqe,
     
     done = False
     maximum = len(np.unique(np.hstack([dataset['x'].reshape(1,-1).T,  dataset['a'].reshape(1,-1).T, dataset['x_prime'].reshape(1,-1).T ]), axis=0))
-    all_episodes = dataset.episodes
+    def unique_pairs(episodes, lengths):
+        rows, _ = dataset.episode_transitions(episodes, lengths)
+        return len(np.unique(np.hstack([dataset['x'][rows].reshape(1,-1).T, dataset['a'][rows].reshape(1,-1).T]), axis=0))
+
+    # sampled episodes and how much of each is kept
     sampled_episodes = []
+    lengths = []
     count = 0
     if (percentage >= 1.):
-        sampled_episodes = all_episodes
-        num_unique = len(np.unique(np.hstack([np.hstack([x['x'] for x in sampled_episodes]).reshape(1,-1).T, np.hstack([x['a'] for x in sampled_episodes]).reshape(1,-1).T]), axis=0))
+        sampled_episodes = range(dataset.num_episodes())
+        lengths = dataset.episode_lengths().tolist()
+        num_unique = unique_pairs(sampled_episodes, lengths)
     else:
         while (not done) and (len(idxs) >= count):
             count += 1
             idx = idxs[count]
-            sampled_episodes.append(all_episodes[idx])
+            sampled_episodes.append(idx)
+            lengths.append(dataset.episode_lengths()[idx])
 
-            num_unique = len(np.unique(np.hstack([np.hstack([x['x'] for x in sampled_episodes]).reshape(1,-1).T, np.hstack([x['a'] for x in sampled_episodes]).reshape(1,-1).T]), axis=0))
+            num_unique = unique_pairs(sampled_episodes, lengths)
             if (float(num_unique)/maximum) > percentage:
-                episode= sampled_episodes.pop()
-                idx = 0
+                length = 0
                 while 1:
-                    idx += 1
-                    new_episode = {k:val[:idx] for k,val in episode.iteritems()}
-                    sampled_episodes.append(new_episode)
-                    num_unique = len(np.unique(np.hstack([np.hstack([x['x'] for x in sampled_episodes]).reshape(1,-1).T, np.hstack([x['a'] for x in sampled_episodes]).reshape(1,-1).T]), axis=0))
-                    sampled_episodes.pop()
+                    length += 1
+                    lengths[-1] = length
+                    num_unique = unique_pairs(sampled_episodes, lengths)
                     if (float(num_unique)/maximum) >= percentage:
-                        new_episode = {k:val[:max(1,(idx-1))] for k,val in episode.iteritems()}
-                        sampled_episodes.append(new_episode)
-                        num_unique = len(np.unique(np.hstack([np.hstack([x['x'] for x in sampled_episodes]).reshape(1,-1).T, np.hstack([x['a'] for x in sampled_episodes]).reshape(1,-1).T]), axis=0))
+                        lengths[-1] = max(1,(length-1))
+                        num_unique = unique_pairs(sampled_episodes, lengths)
                         break
                 done = True
             else:
                 pass
 
-    dataset.episodes = sampled_episodes
-    dataset['x'] = np.hstack([x['x'] for x in dataset.episodes])
-    dataset['a'] = np.hstack([x['a'] for x in dataset.episodes])
-    dataset['x_prime'] = np.hstack([x['x_prime'] for x in dataset.episodes])
-    dataset['cost'] = np.hstack([x['cost'] for x in dataset.episodes])
-    dataset['done'] = np.hstack([x['done'] for x in dataset.episodes])
+    sampled = dataset.subset(sampled_episodes, lengths)
 
     print 'Number of Episodes: ', len(sampled_episodes)
     print 'Num unique: ', num_unique
@@ -186,23 +184,17 @@ def run_trial(idxs, dataset, policy_old, policy, percentage, epsilon, fqi, fqe,
     # print np.unique(np.hstack([np.hstack([x['x'] for x in sampled_episodes]).reshape(1,-1).T, np.hstack([x['a'] for x in sampled_episodes]).reshape(1,-1).T]), axis=0)
 
     # Importance Sampling
-    approx_ips, exact_ips, approx_pdis, exact_pdis, dr, wdr, am = ips.run(dataset, policy, policy_old, epsilon, gamma)
+    approx_ips, exact_ips, approx_pdis, exact_pdis, dr, wdr, am = ips.run(sampled, policy, policy_old, epsilon, gamma)
     # approx_ips, exact_ips, approx_pdis, exact_pdis, dr, wdr, am = 0,0,0,0,0,0,0
     # FQE
     
     # evaluated = fqe.run(policy, 'g', dataset, epochs=1000, epsilon=1e-8, desc='FQE epsilon %s' % np.round(epsilon,2),position_of_holes=position_of_holes, position_of_goals=position_of_goals, g_idx=0)
-    evaluated = FQE(dataset, policy)
+    evaluated = FQE(sampled, policy)
 
 
 
     # evaluated = 0
     print exact-exact, evaluated-exact, approx_ips-exact, exact_ips-exact, approx_pdis-exact, exact_pdis-exact, dr-exact, wdr-exact, am-exact
-    dataset.episodes = all_episodes
-    dataset['x'] = np.hstack([x['x'] for x in dataset.episodes])
-    dataset['a'] = np.hstack([x['a'] for x in dataset.episodes])
-    dataset['x_prime'] = np.hstack([x['x_prime'] for x in dataset.episodes])
-    dataset['cost'] = np.hstack([x['cost'] for x in dataset.episodes])
-    dataset['done'] = np.hstack([x['done'] for x in dataset.episodes])
     return exact-exact, evaluated-exact, approx_ips-exact, exact_ips-exact, approx_pdis-exact, exact_pdis-exact, dr-exact, wdr-exact, am-exact
 
 def FQE(dataset, policy, gamma=.9, epsilon=0.001):
@@ -213,7 +205,7 @@ def FQE(dataset, policy, gamma=.9, epsilon=0.001):
     #         U1[x][y] = 0
 
     U1 = np.random.uniform(size=(64,4))*3.
-    data = np.hstack([np.hstack([x['x'] for x in dataset.episodes]).reshape(1,-1).T, np.hstack([x['a'] for x in dataset.episodes]).reshape(1,-1).T, np.hstack([x['x_prime'] for x in dataset.episodes]).reshape(1,-1).T, np.hstack([x['cost'] for x in dataset.episodes]).reshape(1,-1).T, np.hstack([x['done'] for x in dataset.episodes]).reshape(1,-1).T])
+    data = np.hstack([dataset['x'].reshape(1,-1).T, dataset['a'].reshape(1,-1).T, dataset['x_prime'].reshape(1,-1).T, dataset['cost'].reshape(1,-1).T, dataset['done'].reshape(1,-1).T])
     data = np.unique(data, axis=0)
     pi_of_x_prime = policy(data[:,2])
     data = np.hstack([data, pi_of_x_prime.reshape(1,-1).T]).astype(int)
@@ -292,28 +284,15 @@ def get_dataset(N, epsilon, exact_evaluation):
         exact = exact_c
     exact = exact[0]
     
-    dones = np.hstack([0,1+np.where(dataset['done'])[0]])
-    dataset.buffer_episodes = dataset.episodes
-    dataset.episodes = []
     dataset['x'] = dataset['x'].reshape(-1) 
     dataset['a'] = dataset['a'].reshape(-1) 
     dataset['x_prime'] = dataset['x_prime'].reshape(-1) 
     dataset['cost'] = dataset['cost'].reshape(-1) 
     dataset['done'] = dataset['done'].reshape(-1) 
 
-    for low_, high_ in tqdm(zip(dones[:-1], dones[1:])):
-        new_episode ={
-            'x': dataset['x'][low_:high_].reshape(-1),
-            'a': dataset['a'][low_:high_].reshape(-1),
-            'x_prime': dataset['x_prime'][low_:high_].reshape(-1),
-            'cost': dataset['cost'][low_:high_].reshape(-1),
-            'done': dataset['done'][low_:high_].reshape(-1),
-        }
-        assert new_episode['done'][0] == 0
-        assert new_episode['done'][-1] == 1
-        assert sum(new_episode['done']) == 1
-
-        dataset.episodes.append(new_episode)
+    # whole episodes only: the buffer leaves out the very last transition
+    offsets = dataset.episode_offsets
+    dataset = dataset.subset(np.nonzero(dataset['done'][offsets[1:]-1])[0])
 
     return dataset, exact
 
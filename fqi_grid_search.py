@@ -10,6 +10,7 @@ from optimization_problem import Program
 from fittedq import *
 from exponentiated_gradient import ExponentiatedGradient
 from fitted_off_policy_evaluation import *
+from tabular_q import LakeTabularQIteration, LakeTabularQEvaluation
 from exact_policy_evaluation import ExactPolicyEvaluator
 from stochastic_policy import StochasticPolicy
 from DQN import DeepQLearning
@@ -18,12 +19,19 @@ from keras.models import load_model
 from keras import backend as K
 from env_dqns import *
 import deepdish as dd
+from frame_store import gray_frame_store, memmap_h5
+from grid_sweep import GridSweep, lambdas_grid
+from env_pool import EnvPool
+from vector_collector import VectorCollector, exploration_schedule
 import time
 import os
 np.set_printoptions(suppress=True)
 
-def main(env_name, headless):
-
+def build_problem(env_name, headless):
+    '''
+    Everything the grid points share: pi_old, the algorithms and the dataset.
+    Returns (problem, exact_policy_algorithm)
+    '''
     if headless:
         display = Display(visible=0, size=(1280, 1024))
         display.start()
@@ -34,7 +42,6 @@ def main(env_name, headless):
     if not os.path.exists(model_dir):
         os.makedirs(model_dir)
     ###
-    import pdb; pdb.set_trace()
     if env_name == 'lake':
         from config_lake import *
     elif env_name == 'car':
@@ -119,27 +126,31 @@ def main(env_name, headless):
 
     #### Problem setup
     if env_name == 'lake':
-        best_response_algorithm = LakeFittedQIteration(state_space_dim + action_space_dim, 
-                                                       [map_size, map_size], 
-                                                       action_space_dim, 
-                                                       max_Q_fitting_epochs, 
-                                                       gamma, 
-                                                       model_type=model_type, 
-                                                       position_of_goals=position_of_goals, 
-                                                       position_of_holes=position_of_holes,
-                                                       num_frame_stack=num_frame_stack)
-        
-        fitted_off_policy_evaluation_algorithm = LakeFittedQEvaluation(initial_states, 
-                                                           state_space_dim + action_space_dim, 
+        exact_policy_algorithm = ExactPolicyEvaluator(action_space_map, gamma, env=env, frame_skip=frame_skip, num_frame_stack=num_frame_stack, pic_size = pic_size)
+        if tabular_backend:
+            best_response_algorithm = LakeTabularQIteration(state_space_dim, action_space_dim, gamma, policy_evalutor=exact_policy_algorithm)
+            fitted_off_policy_evaluation_algorithm = LakeTabularQEvaluation(initial_states, state_space_dim, action_space_dim, gamma)
+        else:
+            best_response_algorithm = LakeFittedQIteration(state_space_dim + action_space_dim, 
                                                            [map_size, map_size], 
                                                            action_space_dim, 
-                                                           max_eval_fitting_epochs, 
+                                                           max_Q_fitting_epochs, 
                                                            gamma, 
                                                            model_type=model_type, 
                                                            position_of_goals=position_of_goals, 
                                                            position_of_holes=position_of_holes,
                                                            num_frame_stack=num_frame_stack)
-        exact_policy_algorithm = ExactPolicyEvaluator(action_space_map, gamma, env=env, frame_skip=frame_skip, num_frame_stack=num_frame_stack, pic_size = pic_size)
+        
+            fitted_off_policy_evaluation_algorithm = LakeFittedQEvaluation(initial_states, 
+                                                               state_space_dim + action_space_dim, 
+                                                               [map_size, map_size], 
+                                                               action_space_dim, 
+                                                               max_eval_fitting_epochs, 
+                                                               gamma, 
+                                                               model_type=model_type, 
+                                                               position_of_goals=position_of_goals, 
+                                                               position_of_holes=position_of_holes,
+                                                               num_frame_stack=num_frame_stack)
     elif env_name == 'car':
         best_response_algorithm = CarFittedQIteration(state_space_dim, 
                                                       action_space_dim, 
@@ -148,13 +159,17 @@ def main(env_name, headless):
                                                       model_type=model_type,
                                                       num_frame_stack=num_frame_stack,
                                                       initialization=policy_old,
-                                                      freeze_cnn_layers=freeze_cnn_layers)# for _ in range(2)]
+                                                      freeze_cnn_layers=freeze_cnn_layers,
+                                                      feature_cache_dir=feature_cache_dir)# for _ in range(2)]
         fitted_off_policy_evaluation_algorithm = CarFittedQEvaluation(state_space_dim, 
                                                                       action_space_dim, 
                                                                       max_eval_fitting_epochs, 
                                                                       gamma, 
                                                                       model_type=model_type,
-                                                                      num_frame_stack=num_frame_stack)# for _ in range(2*len(constraints_cared_about) + 2)] 
+                                                                      num_frame_stack=num_frame_stack,
+                                                                      initialization=policy_old,
+                                                                      freeze_cnn_layers=freeze_cnn_layers,
+                                                                      feature_cache_dir=feature_cache_dir)# for _ in range(2*len(constraints_cared_about) + 2)] 
         exact_policy_algorithm = ExactPolicyEvaluator(action_space_map, gamma, env=env, frame_skip=frame_skip, num_frame_stack=num_frame_stack, pic_size = pic_size, constraint_thresholds=constraint_thresholds, constraints_cared_about=constraints_cared_about)
     else:
         raise
@@ -178,10 +193,7 @@ def main(env_name, headless):
                       num_frame_stack,
                       pic_size,)    
 
-    lambdas = []
-    policies = []
-    
-    print exact_policy_algorithm.run(policy_old.Q, to_monitor=True)
+    # print exact_policy_algorithm.run(policy_old.Q, to_monitor=True)
 
     #### Collect Data
     try:
@@ -192,16 +204,13 @@ def main(env_name, headless):
         # num of times breaking  + distance to center of track + zeros
         if env_name == 'car': 
             tic = time.time()
-            action_data = dd.io.load('./seed_2/car_data_actions_seed_2.h5')
-            frame_data = dd.io.load('./seed_2/car_data_frames_seed_2.h5')
-            done_data = dd.io.load('./seed_2/car_data_is_done_seed_2.h5')
-            next_state_data = dd.io.load('./seed_2/car_data_next_states_seed_2.h5')
-            current_state_data = dd.io.load('./seed_2/car_data_prev_states_seed_2.h5')
-            cost_data = dd.io.load('./seed_2/car_data_rewards_seed_2.h5')
+            action_data = memmap_h5('./seed_2/car_data_actions_seed_2.h5')
+            done_data = memmap_h5('./seed_2/car_data_is_done_seed_2.h5')
+            next_state_data = memmap_h5('./seed_2/car_data_next_states_seed_2.h5')
+            current_state_data = memmap_h5('./seed_2/car_data_prev_states_seed_2.h5')
+            cost_data = memmap_h5('./seed_2/car_data_rewards_seed_2.h5')
  
-            frame_gray_scale = np.zeros((len(frame_data),96,96)).astype('float32')
-            for i in range(len(frame_data)):
-                frame_gray_scale[i,:,:] = np.dot(frame_data[i,:,:,:]/255. , [0.299, 0.587, 0.114])
+            frame_gray_scale = gray_frame_store('./seed_2/car_data_frames_seed_2.h5', num_workers=gray_scale_workers)
  
             problem.dataset.data = {'frames':frame_gray_scale,
                         'prev_states': current_state_data,
@@ -218,59 +227,21 @@ def main(env_name, headless):
     except:
         print 'Failed to load'
         print 'Recreating dataset'
-        num_goal = 0
-        num_hole = 0
-        dataset_size = 0 
-        main_tic = time.time()
-        from layer_visualizer import LayerVisualizer; LV = LayerVisualizer(exploratory_policy_old.policy.Q.model)
-        for i in range(max_epochs):
-            tic = time.time()
-            x = env.reset()
-            problem.collect(x, start=True)
-            dataset_size += 1
-            if env_name in ['car']:  env.render()
-            done = False
-            time_steps = 0
-            episode_cost = 0
-            while not done:
-                time_steps += 1
-                if env_name in ['car']: 
-                    # 
-                    # epsilon decay
-                    exploratory_policy_old.epsilon = 1.-np.exp(-3*(i/float(max_epochs)))
-                
-                #LV.display_activation([problem.dataset.current_state()[np.newaxis,...], np.atleast_2d(np.eye(12)[0])], 2, 2, 0)
-                action = exploratory_policy_old([problem.dataset.current_state()], x_preprocessed=False)[0]
-                cost = []
-                for _ in range(frame_skip):
-                    env.render()
-                    x_prime, costs, done, _ = env.step(action_space_map[action])
-                    cost.append(costs)
-                    if done:
-                        break
-                cost = np.vstack([np.hstack(x) for x in cost]).sum(axis=0)
-                early_done, punishment = env.is_early_episode_termination(cost=cost[0], time_steps=time_steps, total_cost=episode_cost)
-                # print cost, action_space_map[action] #env.car.fuel_spent/ENGINE_POWER, env.tile_visited_count, len(env.track), env.tile_visited_count/float(len(env.track))
-                done = done or early_done
-
-                # if done and reward: num_goal += 1
-                # if done and not reward: num_hole += 1
-                episode_cost += cost[0] + punishment
-                c = (cost[0] + punishment).tolist()
-                g = cost[1:].tolist()
-                problem.collect( action,
-                                 x_prime, #np.dot(x_prime/255. , [0.299, 0.587, 0.114]),
-                                 np.hstack([c,g]).reshape(-1).tolist(),
-                                 done
-                                 ) #{(x,a,x',c(x,a), g(x,a)^T, done)}
-                dataset_size += 1
-                x = x_prime
-            if (i % 1) == 0:
-                print 'Epoch: %s. Exploration probability: %s' % (i, np.round(exploratory_policy_old.epsilon,5), ) 
-                print 'Dataset size: %s Time Elapsed: %s. Total time: %s' % (dataset_size, time.time() - tic, time.time()-main_tic)
-                if env_name in ['car']: 
-                    print 'Performance: %s/%s = %s' %  (env.tile_visited_count, len(env.track), env.tile_visited_count/float(len(env.track)))
-                print '*'*20 
+        # collection_workers env replicas (0: env itself) stepped in lockstep, one policy call per step
+        if collection_workers == 0:
+            envs = EnvPool(None, 1, frame_skip=frame_skip, env=env)
+        else:
+            envs = EnvPool(make_env, collection_workers, frame_skip=frame_skip, in_process=collect_in_process)
+        collector = VectorCollector(envs,
+                                    exploratory_policy_old,
+                                    problem.dataset,
+                                    action_space_map,
+                                    epsilon_schedule=exploration_schedule(max_epochs) if env_name in ['car'] else None,
+                                    render=(env_name in ['car']) and (collection_workers == 0))
+        try:
+            collector.collect(max_epochs)
+        finally:
+            envs.close()
         problem.finish_collection(env_name)
 
     if env_name in ['lake']:
@@ -287,35 +258,35 @@ def main(env_name, headless):
         print 'Percentage of State/Action space seen: %s' % (number_of_state_action_pairs_seen/float(number_of_total_state_action_pairs))
 
     # print 'C(pi_old): %s. G(pi_old): %s' % (exact_policy_algorithm.run(exploratory_policy_old,policy_is_greedy=False, to_monitor=True) )
-    ### Solve Batch Constrained Problem
-    
+    return problem, exact_policy_algorithm
 
-    def cart_product(x,y): return np.transpose([np.tile(x, len(y)), np.repeat(y, len(x))])
-    lambdas_grid = cart_product(np.arange(0,1.01,.1), np.arange(0,1.01,.1))
+def evaluate_point(problem, exact_policy_algorithm, point, lambda_t):
+    '''
+    Best response to lambda_t and its exact C, G. Returns the record GridSweep stores
+    '''
+    tic = time.time()
+    K.clear_session()
+    print '*'*20
+    print 'Grid point %s' % point
+    print
+    print 'lambda_{0} = {1}'.format(point, lambda_t)
 
-    iteration = 0
-    for lambda_t in lambdas_grid:
-        iteration += 1
-        K.clear_session()  
-        # policy_printer.pprint(policies)
-        print '*'*20
-        print 'Iteration %s, %s' % (iteration, i)
-        print
-        print 'lambda_{0}_{3} = {2}'.format(iteration, iteration-1, lambda_t, i)
+    pi_t, values = problem.best_response(np.array(lambda_t), desc='FQI pi_{0}'.format(point), exact=exact_policy_algorithm)
+    c_exact, g_exact, performance = problem.calc_exact(pi_t)
 
-        pi_t, values = problem.best_response(lambda_t, desc='FQI pi_{0}_{1}'.format(iteration, i), exact=exact_policy_algorithm)
+    return {'point': point,
+            'lambda': list(lambda_t),
+            'c_pi_exact': float(c_exact),
+            'g_pi_exact': np.array(g_exact, dtype=float).reshape(-1).tolist(),
+            'performance': float(performance),
+            'seconds': time.time() - tic}
 
-        # policies.append(pi_t)
-        # problem.update(pi_t, values, iteration) #Evaluate C(pi_t), G(pi_t) and save
-        problem.calc_exact(pi_t)
-
-        c_exact, g_exact = problem.C_exact.avg(), problem.G_exact.avg()[:-1]
-        c_approx, g_approx = np.zeros(np.array(problem.C_exact.avg()).shape), np.zeros(np.array(problem.G.avg()[:-1]).shape)
-        x = 0
-        y,c_br, g_br, c_br_exact, g_br_exact = 0, 0, [0]*(len(constraints)), 0, [0]*(len(constraints)-1)
-
-        problem.prev_lagrangians.append(np.hstack([iteration, x, y, c_exact, g_exact, c_approx, g_approx, problem.C_exact.last(), problem.G_exact.last()[:-1], problem.C.last(), problem.G.last()[:-1], lambda_t, c_br_exact, g_br_exact, c_br, g_br[:-1]  ]))
-        problem.save('results_grid.csv', 'policy_improvement_grid.h5')
+def main(env_name, headless):
+    # one process. grid_sweep.py runs the same grid on several
+    problem, exact_policy_algorithm = build_problem(env_name, headless)
+    sweep = GridSweep('results_grid.jsonl')
+    sweep.run(lambdas_grid(), lambda job: evaluate_point(problem, exact_policy_algorithm, *job))
+    sweep.save('results_grid.csv', 'policy_improvement_grid.h5')
 
 
 if __name__ == "__main__":
@@ -1,6 +1,7 @@
 import h5py
 import numpy as np
 import deepdish as dd
+from frame_store import gray_frame_store
 #from thread_safe import threadsafe_generator
 import threading
 
@@ -319,15 +320,12 @@ class LossHistory(keras.callbacks.Callback):
 
 
 action_data = dd.io.load('./seed_2/car_data_actions_seed_2.h5')
-frame_data = dd.io.load('./seed_2/car_data_frames_seed_2.h5')
 done_data = dd.io.load('./seed_2/car_data_is_done_seed_2.h5')
 next_state_data = dd.io.load('./seed_2/car_data_next_states_seed_2.h5')
 current_state_data = dd.io.load('./seed_2/car_data_prev_states_seed_2.h5')
 cost_data = dd.io.load('./seed_2/car_data_rewards_seed_2.h5')
 
-frame_gray_scale = np.zeros((len(frame_data),96,96)).astype('float32')
-for i in range(len(frame_data)):
-	frame_gray_scale[i,:,:] = np.dot(frame_data[i,:,:,:]/255. , [0.299, 0.587, 0.114])
+frame_gray_scale = gray_frame_store('./seed_2/car_data_frames_seed_2.h5')
 
 dataset = {'frames':frame_gray_scale,
 			'prev_states': current_state_data,
@@ -341,7 +339,7 @@ dataset = {'frames':frame_gray_scale,
 
 ### Load data set
 #dataset = dd.io.load('car_racing_data.h5')
-data_length = len(frame_data)-1
+data_length = len(frame_gray_scale)-1
 ### Start training
 
 
@@ -0,0 +1,148 @@
+import os
+import hashlib
+import multiprocessing
+import numpy as np
+import tables
+
+# Bump whenever the gray-scale conversion changes so stale caches are not reused
+GRAY_CACHE_VERSION = 1
+
+
+def rgb_to_gray(X):
+    '''
+    (..., 96, 96, 3) uint8 RGB -> (..., 96, 96) float32 grayscale in [0,1]
+    '''
+    return np.dot(X[...,:3]/255. , [0.299, 0.587, 0.114]).astype('float32')
+
+
+class FrameStore(object):
+    def __init__(self, path, transform=None):
+        '''
+        Read-only frame array that lives on disk instead of in RAM.
+
+        The frames are memory-mapped from a .npy file, so indexing only
+        reads the rows that are asked for. Drop-in replacement for the
+        in-memory array in dataset['frames']:
+
+            dataset['frames'][dataset['prev_states'][batch_idxs]]
+
+        path: .npy file holding the frames
+        transform: optional function applied to every gathered batch (e.g. rgb_to_gray)
+        '''
+        self.path = path
+        self.transform = transform
+        self.frames = np.load(path, mmap_mode='r')
+
+    @classmethod
+    def from_h5(cls, h5_path, store_path=None, chunk_size=1024, **kw):
+        '''
+        Open the frame store for a deepdish .h5 frame file, building it on first use.
+        '''
+        if store_path is None:
+            store_path = os.path.splitext(h5_path)[0] + '.npy'
+
+        if not os.path.isfile(store_path):
+            h5_to_npy(h5_path, store_path, chunk_size=chunk_size)
+
+        return cls(store_path, **kw)
+
+    def __getitem__(self, idx):
+        batch = np.asarray(self.frames[idx])
+        if self.transform is not None:
+            return self.transform(batch)
+        return batch
+
+    def __len__(self):
+        return len(self.frames)
+
+
+def memmap_h5(h5_path, **kw):
+    '''
+    Read-only memory map of an array saved with dd.io.save (via its .npy copy, built on
+    first use). Processes that map the same file share its pages instead of each
+    holding a copy.
+    '''
+    return FrameStore.from_h5(h5_path, **kw).frames
+
+
+def h5_to_npy(h5_path, store_path, chunk_size=1024):
+    '''
+    Copy an array saved with dd.io.save into a .npy file, chunk_size rows at a time,
+    so the whole array never has to fit in memory.
+    '''
+    tmp_path = store_path + '.tmp'
+    with tables.open_file(h5_path, mode='r') as h5:
+        node = h5.get_node('/data') # dd.io.save stores non-dict data under /data
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=node.dtype, shape=tuple(int(x) for x in node.shape))
+        for low in range(0, node.shape[0], chunk_size):
+            out[low:(low+chunk_size)] = node[low:(low+chunk_size)]
+        out.flush()
+        del out
+
+    # only a complete file ever shows up under store_path
+    os.rename(tmp_path, store_path)
+
+
+def gray_frame_store(h5_path, cache_dir=None, chunk_size=512, num_workers=1):
+    '''
+    FrameStore of the gray-scaled (float32) frames in h5_path.
+
+    The conversion runs once, chunk_size frames per vectorized np.dot, optionally
+    split over num_workers processes. The result is cached next to the source as
+    <name>.gray_v<GRAY_CACHE_VERSION>_<sha1 of source>.npy, so later runs (and a
+    changed source file or conversion) are picked up without rebuilding by hand.
+    '''
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(h5_path))
+    name = os.path.splitext(os.path.basename(h5_path))[0]
+    store_path = os.path.join(cache_dir, '%s.gray_v%s_%s.npy' % (name, GRAY_CACHE_VERSION, file_hash(h5_path)))
+
+    if not os.path.isfile(store_path):
+        h5_to_gray_npy(h5_path, store_path, chunk_size=chunk_size, num_workers=num_workers)
+
+    return FrameStore(store_path)
+
+
+def h5_to_gray_npy(h5_path, store_path, chunk_size=512, num_workers=1):
+    '''
+    Gray-scale the RGB frames of an array saved with dd.io.save into a float32 .npy file.
+    '''
+    tmp_path = store_path + '.tmp'
+    with tables.open_file(h5_path, mode='r') as h5:
+        shape = tuple(int(x) for x in h5.get_node('/data').shape)
+
+    out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype='float32', shape=shape[:-1])
+    del out
+
+    jobs = [(h5_path, tmp_path, low, min(low+chunk_size, shape[0])) for low in range(0, shape[0], chunk_size)]
+    if num_workers > 1:
+        pool = multiprocessing.Pool(num_workers)
+        try:
+            pool.map(_gray_chunk, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for job in jobs:
+            _gray_chunk(job)
+
+    os.rename(tmp_path, store_path)
+
+
+def _gray_chunk(job):
+    # Worker: each call opens its own handles, so it is safe in a process pool
+    h5_path, out_path, low, high = job
+    with tables.open_file(h5_path, mode='r') as h5:
+        chunk = h5.get_node('/data')[low:high]
+    out = np.load(out_path, mmap_mode='r+')
+    out[low:high] = rgb_to_gray(chunk)
+    out.flush()
+    del out
+
+
+def file_hash(path, block_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
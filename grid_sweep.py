@@ -0,0 +1,160 @@
+'''
+Runs the lambda grid of fqi_grid_search on a pool of worker processes.
+
+Every worker imports tensorflow/keras itself and builds its own Program, so each
+has its own session; this driver never imports them. The car dataset is
+memory-mapped, so the workers share one copy of it through the page cache.
+Finished grid points are appended to one results file as they come in and
+skipped when the same sweep is started again.
+
+Run from the repo root:
+    python grid_sweep.py -env car --workers 8 --headless
+'''
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+CAR_DATA_DIR = './seed_2'
+CAR_DATA = 'car_data_{0}_seed_2.h5'
+
+
+def cart_product(x,y): return np.transpose([np.tile(x, len(y)), np.repeat(y, len(x))])
+
+
+def lambdas_grid():
+    return cart_product(np.arange(0,1.01,.1), np.arange(0,1.01,.1))
+
+
+class GridSweep(object):
+    def __init__(self, results_path):
+        '''
+        results_path: append-only results file, one json record per finished grid point
+        '''
+        self.results_path = results_path
+
+    def finished(self):
+        '''
+        Finished records, by grid point
+        '''
+        records = {}
+        if not os.path.isfile(self.results_path):
+            return records
+        with open(self.results_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # partially written line of a killed sweep
+                records[record['point']] = record
+        return records
+
+    def append(self, record):
+        with open(self.results_path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def run(self, points, evaluate, num_workers=1, initializer=None, initargs=()):
+        '''
+        Evaluates every grid point that has no record yet.
+
+        points: list of lambdas
+        evaluate: evaluate((point, lambda)) -> dict record. Must be picklable if num_workers > 1
+        initializer, initargs: run once in every worker process before the first point
+        '''
+        finished = self.finished()
+        pending = [(point, lamb.tolist()) for point, lamb in enumerate(np.array(points, dtype=float))
+                   if not ((point in finished) and np.allclose(finished[point]['lambda'], lamb))]
+        print 'Grid sweep: %s/%s points done, %s to go on %s worker(s)' % (len(points)-len(pending), len(points), len(pending), num_workers)
+
+        tic = time.time()
+        if num_workers == 1:
+            if initializer is not None: initializer(*initargs)
+            for job in pending:
+                self.append(evaluate(job))
+        else:
+            pool = multiprocessing.Pool(num_workers, initializer=initializer, initargs=initargs)
+            try:
+                # chunksize 1: points take minutes each, so balance them one by one
+                for record in pool.imap_unordered(evaluate, pending, 1):
+                    self.append(record)
+                    print 'Grid point %s done. Time elapsed: %s' % (record['point'], time.time()-tic)
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+        return self.finished()
+
+    def save(self, results_name, policy_improvement_name):
+        '''
+        Writes the finished points, in grid order, in the layout plot_grid_search.py reads
+        '''
+        import pandas as pd
+        import deepdish as dd
+
+        records = [record for point, record in sorted(self.finished().items())]
+        if len(records) == 0: return
+
+        rows = [np.hstack([record['point'], record['lambda'], record['c_pi_exact'], record['g_pi_exact'], record['performance']]) for record in records]
+        labels = np.hstack(['iteration',
+                            ['lambda_%s' % i for i in range(len(records[0]['lambda']))],
+                            'c_pi_exact',
+                            ['g_pi_exact_%s' % i for i in range(len(records[0]['g_pi_exact']))],
+                            'performance'])
+        pd.DataFrame(rows, columns=labels).to_csv(results_name, index=False)
+        dd.io.save(policy_improvement_name, {'c_performance': [[record['performance']] for record in records]})
+
+
+_worker = {}
+
+def _init_worker(env_name, headless):
+    # tensorflow is first imported here, i.e. once per worker process
+    import fqi_grid_search
+    _worker['module'] = fqi_grid_search
+    _worker['problem'] = fqi_grid_search.build_problem(env_name, headless)
+
+def _evaluate(job):
+    problem, exact_policy_algorithm = _worker['problem']
+    return _worker['module'].evaluate_point(problem, exact_policy_algorithm, *job)
+
+
+def prepare_car_data(directory=CAR_DATA_DIR):
+    '''
+    Builds the memory-mapped copies of the car dataset up front, so the workers
+    don't race to create them.
+    '''
+    from frame_store import memmap_h5, gray_frame_store
+    for name in ['actions', 'is_done', 'next_states', 'prev_states', 'rewards']:
+        memmap_h5(os.path.join(directory, CAR_DATA.format(name)))
+    gray_frame_store(os.path.join(directory, CAR_DATA.format('frames')), num_workers=multiprocessing.cpu_count())
+
+
+def main(env_name, headless, num_workers, results_name):
+    if env_name == 'car': prepare_car_data()
+
+    sweep = GridSweep(results_name)
+    sweep.run(lambdas_grid(), _evaluate, num_workers=num_workers, initializer=_init_worker, initargs=(env_name, headless))
+    sweep.save('results_grid.csv', 'policy_improvement_grid.h5')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the lambda grid search on several processes.')
+    parser.add_argument('-env', dest='env', help='lake/car openAI environment')
+    parser.add_argument('--headless', dest='headless', action='store_true',
+                        help = 'Use flag if running on server so you can run render() from openai')
+    parser.add_argument('--workers', dest='workers', type=int, default=multiprocessing.cpu_count(),
+                        help = 'Number of worker processes, each with its own tensorflow session')
+    parser.add_argument('--results', dest='results', default='results_grid.jsonl',
+                        help = 'Append-only results file. Rerun with the same file to resume')
+    parser.set_defaults(headless=False)
+    args = parser.parse_args()
+
+    assert args.env in ['lake', 'car'], 'Need to choose between FrozenLakeEnv (lake) or Car Racing (car) environment'
+
+    main(args.env, args.headless, args.workers, args.results)
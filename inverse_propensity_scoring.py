@@ -4,47 +4,56 @@
 from fitted_algo import FittedAlgo
 from mdp_approximator import MDPApproximator
 from model import Model
+from replay_buffer import pad_episodes
+from behavior_policy import BehaviorPolicy
 import numpy as np
-from tqdm import tqdm
 import scipy.signal as signal
 
+# order of the estimates returned by InversePropensityScorer.run
+ESTIMATORS = ['approx_ips', 'exact_ips', 'approx_pdis', 'exact_pdis', 'doubly_robust', 'weighted_doubly_robust', 'AM']
+
 class InversePropensityScorer(object):
     def __init__(self, env, state_space_dim, action_space_dim, grid_shape):
         '''
-        An implementation of fitted Q iteration
+        Importance sampling (IPS, PDIS) and doubly robust (DR, WDR) off policy estimators
 
-        num_inputs: number of inputs
-        dim_of_actions: dimension of action space
-        max_epochs: positive int, specifies how many iterations to run the algorithm
-        gamma: discount factor
+        env: environment the MDPApproximator is built for
+        state_space_dim: number of states
+        action_space_dim: number of actions
+        grid_shape: shape of the lake
         '''
         self.env = env
         self.action_space_dim = action_space_dim
         self.state_space_dim = state_space_dim
         self.grid_shape = grid_shape
+        self.confidence_intervals = None
         # self.initial_states = initial_states
 
-    def run(self, *args, **kw):
+    def run(self, dataset, pi_new, pi_old, epsilon, gamma, MDP_approximator=None, num_bootstrap=0, confidence=.95, seed=None):
         '''
         V^pi(s) = sum_{i = 1}^n p(h_j| pi_new, s_0 = s)/p(h_j| pi_old, s_0 = s) H(h_j)
         h = (s_1, a_1, r_1, s_2, ...)
         p(h_j | pi, s) = pi(a_0 | s_0)p(r_0 | s_0, a_0)p(s_1 | s_0, a_0)pi(a_1 |s_1) ...
                        = prod_j pi(a_j | x_j)p(r_j | x_j, a_j)p(s_{j+1} | x_j, a_j)
-        deterministic  = prod_j pi(a_j | x_j) * 1 * 1 
+        deterministic  = prod_j pi(a_j | x_j) * 1 * 1
                        = prod_j pi(a_j | x_j)
         H(h_j) = r_0 + gamma * r_1 + gamma^2 r_2 + ...
-        
-        '''
 
+        Every estimator works on the same (episodes, longest episode) tensors, see trajectories.
+        Returns approx_ips, exact_ips, approx_pdis, exact_pdis, dr, wdr, am
 
-        approx_ips = self.approx_ips(*args)
-        exact_ips = self.exact_ips(*args)
-        approx_pdis = self.approx_pdis(*args)
-        exact_pdis = self.exact_pdis(*args)
-        dr, wdr, am = self.doubly_robust_approx(*args, **kw)
+        num_bootstrap: if > 0, the episodes are also resampled this many times and
+                       self.confidence_intervals holds name -> (low, high) at level confidence.
+                       The behavior and MDP models are not refit per resample
+        '''
+        trajectories = self.trajectories(dataset, pi_new, pi_old, epsilon, gamma)
+        trajectories.update(self.model_values(dataset, pi_new, gamma, MDP_approximator))
+        estimates = self.estimates(trajectories)
 
+        if num_bootstrap > 0:
+            self.confidence_intervals = self.bootstrap(trajectories, num_bootstrap, confidence, seed)
 
-        return approx_ips, exact_ips, approx_pdis, exact_pdis, dr, wdr, am
+        return tuple(estimates[name][0] for name in ESTIMATORS)
 
     def approx_pdis(self, dataset, pi_new, pi_old, epsilon, gamma):
         '''
@@ -52,45 +61,7 @@ class InversePropensityScorer(object):
 
         sum_{t=1}^{max L} gamma^t  1/n sum_{i=1}^n (PI_{tau=1}^t p_new/p_old) R^i_t
         '''
-        
-        pi_new_a_given_x = [(pi_new(episode['x']) == episode['a']).astype(float) for episode in dataset.episodes]
-
-        # approx IPS, pi_old_a_given_x is approximated by the dataset
-        actions = np.eye(self.action_space_dim)[dataset['a']]
-        unique_states_seen = np.unique(dataset['x'])
-        probabilities = [np.mean(actions[dataset['x'] == x], axis=0) for x in unique_states_seen]
-
-        prob = {}
-        for idx, state in enumerate(unique_states_seen):
-            prob[state] = probabilities[idx]
-
-        pi_old_a_given_x = [[ prob[x][a]  for x,a in zip(episode['x'],episode['a']) ] for episode in dataset.episodes]
-
-        pi_new_cumprod = np.array([np.pad(np.cumprod(x), (0,dataset.get_max_trajectory_length()-len(x)), 'constant', constant_values=(0,0)) for x in pi_new_a_given_x])
-        pi_old_cumprod = np.array([np.pad(np.cumprod(x), (0,dataset.get_max_trajectory_length()-len(x)), 'constant', constant_values=(0,1)) for x in pi_old_a_given_x])
-        costs = [episode['cost'] for episode in dataset.episodes]
-        costs = np.array([np.pad(x, (0,dataset.get_max_trajectory_length()-len(x)), 'constant', constant_values=(0,0)) for x in costs])
-
-        return self.discounted_sum(np.mean(pi_new_cumprod / pi_old_cumprod * costs, axis=0), gamma)
-
-        # pi_new_cumprod = [np.cumprod(x) for x in pi_new_a_given_x]
-        # pi_old_cumprod = [np.cumprod(x) for x in pi_old_a_given_x]
-        # costs = [episode['cost'] for episode in dataset.episodes]
-
-        # per_decision = []
-        # for i in range(dataset.get_max_trajectory_length()):
-        #     s = 0
-        #     count = 0
-        #     for trajectory in range(len(costs)):
-        #         try:
-        #             s += pi_new_cumprod[trajectory][i] / pi_old_cumprod[trajectory][i] * costs[trajectory][i]
-        #             count += 1
-        #         except:
-        #             pass
-        #     per_decision.append(s/float(count))
-
-
-        # return self.discounted_sum(per_decision, gamma)
+        return self.estimates(self.trajectories(dataset, pi_new, pi_old, epsilon, gamma))['approx_pdis'][0]
 
     def exact_pdis(self, dataset, pi_new, pi_old, epsilon, gamma):
         '''
@@ -98,99 +69,65 @@ class InversePropensityScorer(object):
 
         sum_{t=1}^{max L} gamma^t  1/n sum_{i=1}^n (PI_{tau=1}^t p_new/p_old) R^i_t
         '''
-        
-        pi_new_a_given_x = [(pi_new(episode['x']) == episode['a']).astype(float) for episode in dataset.episodes]
-        pi_old_a_given_x = [(pi_old(episode['x']) == episode['a'])*(1-epsilon) + (1./self.action_space_dim)*epsilon for episode in dataset.episodes]
-
-        pi_new_cumprod = np.array([np.pad(np.cumprod(x), (0,dataset.get_max_trajectory_length()-len(x)), 'constant', constant_values=(0,0)) for x in pi_new_a_given_x])
-        pi_old_cumprod = np.array([np.pad(np.cumprod(x), (0,dataset.get_max_trajectory_length()-len(x)), 'constant', constant_values=(0,1)) for x in pi_old_a_given_x])
-        costs = [episode['cost'] for episode in dataset.episodes]
-        costs = np.array([np.pad(x, (0,dataset.get_max_trajectory_length()-len(x)), 'constant', constant_values=(0,0)) for x in costs])
-
-        return self.discounted_sum(np.mean(pi_new_cumprod / pi_old_cumprod * costs, axis=0), gamma)
-
-        # pi_new_cumprod = [np.cumprod(x) for x in pi_new_a_given_x]
-        # pi_old_cumprod = [np.cumprod(x) for x in pi_old_a_given_x]
-        # costs = [episode['cost'] for episode in dataset.episodes]
-
-        # per_decision = []
-        # for t in range(dataset.get_max_trajectory_length()):
-        #     s = 0
-        #     count = 0
-        #     for trajectory in range(len(costs)):
-        #         try:
-        #             s += pi_new_cumprod[trajectory][t] / pi_old_cumprod[trajectory][t] * costs[trajectory][t]
-        #             count += 1
-        #         except:
-        #             pass
-        #     per_decision.append(s/count)
-
-        # return self.discounted_sum(per_decision, gamma)
+        return self.estimates(self.trajectories(dataset, pi_new, pi_old, epsilon, gamma))['exact_pdis'][0]
 
     def approx_ips(self, dataset, pi_new, pi_old, epsilon, gamma):
         '''
         Inverse propensity scoring (Importance sampling)
         '''
-        H_h_j = [self.discounted_sum(episode['cost'], gamma) for episode in dataset.episodes]
-        pi_new_a_given_x = [(pi_new(episode['x']) == episode['a']).astype(float) for episode in dataset.episodes]
-
-        # approx IPS, pi_old_a_given_x is approximated by the dataset
-        actions = np.eye(self.action_space_dim)[dataset['a']]
-        unique_states_seen = np.unique(dataset['x'])
-        probabilities = [np.mean(actions[dataset['x'] == x], axis=0) for x in unique_states_seen]
-
-        prob = {}
-        for idx, state in enumerate(unique_states_seen):
-            prob[state] = probabilities[idx]
-
-        pi_old_a_given_x = [[ prob[x][a]  for x,a in zip(episode['x'],episode['a'])] for episode in dataset.episodes]
-
-        approx_ips= 0
-        for i in range(len(H_h_j)):
-            prob_new = np.prod(pi_new_a_given_x[i])
-            prob_old = np.prod(pi_old_a_given_x[i])
-            if (prob_new > 0) and (prob_old == 0):
-                return np.inf
-            approx_ips += prob_new/prob_old * H_h_j[i]
-
-        if np.isnan(approx_ips):
-            approx_ips = np.inf
-        else:
-            approx_ips /= len(H_h_j)
-
-        return approx_ips
-
+        return self.estimates(self.trajectories(dataset, pi_new, pi_old, epsilon, gamma))['approx_ips'][0]
 
     def exact_ips(self, dataset, pi_new, pi_old, epsilon, gamma):
-        H_h_j = [self.discounted_sum(episode['cost'], gamma) for episode in dataset.episodes]
-        pi_new_a_given_x = [(pi_new(episode['x']) == episode['a']).astype(float) for episode in dataset.episodes]
-
-        # exact IPS. If you know pi_old, can calculate exactly
-        pi_old_a_given_x = [(pi_old(episode['x']) == episode['a'])*(1-epsilon) + (1./self.action_space_dim)*epsilon for episode in dataset.episodes]
-
-        exact_ips = 0
-        for i in range(len(H_h_j)):
-            prob_new = np.prod(pi_new_a_given_x[i])
-            prob_old = np.prod(pi_old_a_given_x[i])
-            if (prob_new > 0) and (prob_old == 0):
-                return np.inf
-            exact_ips += prob_new/prob_old * H_h_j[i]
-
-        
-        if np.isnan(exact_ips):
-            exact_ips = np.inf
-        else:
-            exact_ips /= len(H_h_j)
-
-        return exact_ips
+        return self.estimates(self.trajectories(dataset, pi_new, pi_old, epsilon, gamma))['exact_ips'][0]
 
     def doubly_robust_approx(self, dataset, pi_new, pi_old, epsilon, gamma, MDP_approximator=None):
         '''
-        sum_{i=0}^n sum_{t=0}^\infty gamma^t w_t^i R_t^{H_i} - 
+        sum_{i=0}^n sum_{t=0}^\infty gamma^t w_t^i R_t^{H_i} -
         sum_{i=0}^n sum_{t=0}^\infty gamma^t (w_t^i \hat{Q}(S^{H_i}_t,A^{H_i}_t) - w_{t-1}^i \hat{V}(S^{H_i}_t,A^{H_i}_{t-1})
 
         w_t^i = rho_t^i / n = 1/n * prod_{n=0}^t pi_new(a_n|x_n) / pi_old(a_n|x_n)
 
+        '''
+        trajectories = self.trajectories(dataset, pi_new, pi_old, epsilon, gamma)
+        trajectories.update(self.model_values(dataset, pi_new, gamma, MDP_approximator))
+        estimates = self.estimates(trajectories)
+        return estimates['doubly_robust'][0], estimates['weighted_doubly_robust'][0], estimates['AM'][0]
+
+    def trajectories(self, dataset, pi_new, pi_old, epsilon, gamma):
+        '''
+        The dataset's episodes as (episodes, longest episode) arrays:
+            mask: real steps
+            costs: cost, 0 past the end
+            w_approx, w_exact: prod_{tau <= t} pi_new(a|x) / pi_old(a|x), 0 past the end. pi_old is
+                               estimated from the dataset (approx) or pi_old with exploration epsilon (exact)
+        and discount: gamma^t
+        '''
+        offsets = dataset.episode_offsets
+        x, a = np.asarray(dataset['x']), np.asarray(dataset['a']).reshape(-1)
+        costs, mask = pad_episodes(np.asarray(dataset['cost']).reshape(-1), offsets, fill=0)
+        lengths = mask.sum(axis=1)
+        last = (np.arange(len(lengths)), lengths - 1)
+
+        pi_new_a_given_x, _ = pad_episodes((pi_new(x) == a).astype(float), offsets, fill=1)
+        pi_new_cumprod = np.cumprod(pi_new_a_given_x, axis=1)
+        trajectories = {'mask': mask, 'costs': costs, 'discount': gamma**np.arange(mask.shape[1])}
+
+        # approx: pi_old_a_given_x is approximated by the dataset. exact: if you know pi_old, can calculate exactly
+        pi_old_a_given_x = {'approx': BehaviorPolicy.of_dataset(dataset, self.action_space_dim)(x, a),
+                            'exact': (pi_old(x) == a)*(1-epsilon) + (1./self.action_space_dim)*epsilon}
+        for kind, probabilities in pi_old_a_given_x.iteritems():
+            pi_old_cumprod = np.cumprod(pad_episodes(probabilities, offsets, fill=1)[0], axis=1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                trajectories['w_' + kind] = np.where(mask, pi_new_cumprod / pi_old_cumprod, 0.)
+            # an episode pi_new can take but pi_old cannot
+            trajectories['impossible_' + kind] = np.any((pi_new_cumprod[last] > 0) & (pi_old_cumprod[last] == 0))
+
+        return trajectories
+
+    def model_values(self, dataset, pi_new, gamma, MDP_approximator=None):
+        '''
+        \hat{Q}(x_t, a_t), \hat{V}(x_t) of the MDPApproximator fit on dataset, as (episodes, longest episode)
+        arrays, and the model based estimate AM = \hat{V}(0). Looked up in the model's Q^pi, V^pi tables
         '''
         if MDP_approximator is None:
             mdp = MDPApproximator(self.env, self.state_space_dim + self.action_space_dim, self.grid_shape, self.action_space_dim, 500, gamma)
@@ -198,78 +135,72 @@ class InversePropensityScorer(object):
             mdp = MDP_approximator
 
         mdp.run(dataset)
+        Q_table, V_table = mdp.values(pi_new)
 
-        actions = np.eye(self.action_space_dim)[dataset['a']]
-        unique_states_seen = np.unique(dataset['x'])
-        probabilities = [np.mean(actions[dataset['x'] == x], axis=0) for x in unique_states_seen]
-
-        prob = {}
-        for idx, state in enumerate(unique_states_seen):
-            prob[state] = probabilities[idx]
-
-
-        pi_new_a_given_x = [(pi_new(episode['x']) == episode['a']).astype(float) for episode in dataset.episodes]
-        pi_old_a_given_x = [[ prob[x][a]  for x,a in zip(episode['x'],episode['a'])] for episode in dataset.episodes]
-        pi_new_cumprod = [np.cumprod(x) for x in pi_new_a_given_x]
-        pi_old_cumprod = [np.cumprod(x) for x in pi_old_a_given_x]
-        w_t = [pi_new_cumprod[i]/pi_old_cumprod[i] for i in range(len(pi_new_cumprod))]
-        def sum_arrays(x,y): 
-            max_len = max(len(x), len(y))
-            x = np.pad(x, (0,max_len-len(x)), mode='constant', constant_values=0)
-            y = np.pad(y, (0,max_len-len(y)), mode='constant', constant_values=0)
-            return x+y
-
-        norms = reduce(lambda x,y,s_a=sum_arrays: s_a(x,y), w_t)
-        how_many_non_zero = np.sum(norms>0)
-
-        drs = []
-        wdrs = []
-        Q_hat = {}
-        V_hat = {}
-
-        print mdp.V(pi_new, 0)
-        for idx, episode in enumerate(dataset.episodes):
-            cost = w_t[idx]*episode['cost']
-            first_term = self.discounted_sum(cost, gamma)
-
-            Q_hats = []
-            V_hats = []
-            for x,a in zip(episode['x'], episode['a']):
-                if tuple([x,a]) not in Q_hat:
-                    Q_ = mdp.Q(pi_new, x, a)
-                    Q_hat[tuple([x,a])] = Q_
-                if tuple([x]) not in V_hat:
-                    V_ = mdp.V(pi_new, x)
-                    V_hat[tuple([x])] = V_
-                
-                Q_hats.append(Q_hat[tuple([x,a])])
-                V_hats.append(V_hat[tuple([x])])
-                
-            # DR
-            w_t_minus_1 = np.hstack([1, w_t[idx][:-1]])
-            cost = w_t[idx]*Q_hats - w_t_minus_1*V_hats
-            second_term = self.discounted_sum(cost, gamma)
-            drs.append(first_term - second_term)
-
-            #WDR
-            #normalize w_t
-            how_many = min(len(w_t[idx]), how_many_non_zero)
-            w_t_  = w_t[idx][:how_many] / np.array(norms[:how_many])
-            w_t_ = np.hstack([w_t_, np.zeros(len(w_t[idx])-how_many) ])
-            cost = w_t_*episode['cost']
-            first_term = self.discounted_sum(cost, gamma)
-
-            w_t_minus_1 = np.hstack([1./len(w_t), w_t_[:-1]])
-            cost = w_t_*Q_hats - w_t_minus_1*V_hats
-            second_term = self.discounted_sum(cost, gamma)
-            wdrs.append(first_term - second_term)
-
-        if tuple([0]) not in V_hat:
-            AM = mdp.V(pi_new, 0)
-        else:
-            AM = V_hat[tuple([0])]
+        offsets = dataset.episode_offsets
+        x, a = np.asarray(dataset['x']).reshape(-1).astype(int), np.asarray(dataset['a']).reshape(-1).astype(int)
+        return {'Q_hat': pad_episodes(Q_table[x, a], offsets, fill=0)[0],
+                'V_hat': pad_episodes(V_table[x], offsets, fill=0)[0],
+                'AM': V_table[0]}
 
-        return np.mean(drs), np.sum(wdrs), AM
+    def estimates(self, trajectories, counts=None):
+        '''
+        Every estimator, for each row of counts: how many times each episode is in the sample
+        (default: the dataset itself, once). Returns name -> array of len(counts).
+        DR, WDR and AM only if trajectories holds the model_values
+        '''
+        mask, costs, discount = trajectories['mask'], trajectories['costs'], trajectories['discount']
+        n = mask.shape[0]
+        counts = np.ones((1, n)) if counts is None else np.asarray(counts, dtype=float)
+        lengths = mask.sum(axis=1)
+        H_h_j = costs.dot(discount)
+
+        estimates = {}
+        for kind in ['approx', 'exact']:
+            w = trajectories['w_' + kind]
+            with np.errstate(invalid='ignore'):
+                ips = counts.dot(w[np.arange(n), lengths - 1] * H_h_j) / n
+            ips[np.isnan(ips) | trajectories['impossible_' + kind]] = np.inf
+            estimates[kind + '_ips'] = ips
+            estimates[kind + '_pdis'] = counts.dot(w * costs).dot(discount) / n
+
+        if 'Q_hat' not in trajectories:
+            return estimates
+
+        Q_hat, V_hat = trajectories['Q_hat'], trajectories['V_hat']
+        w = trajectories['w_approx']
+        w_t_minus_1 = np.where(mask, np.hstack([np.ones((n, 1)), w[:, :-1]]), 0.)
+
+        # DR, one term per episode
+        drs = (w * costs - (w * Q_hat - w_t_minus_1 * V_hat)).dot(discount)
+        estimates['doubly_robust'] = counts.dot(drs) / n
+
+        # WDR: w_t^i normalized by sum_i w_t^i over the sample. 0 once every w_t^i is
+        # (w_{-1} = 1/n for all i)
+        norms = counts.dot(w)
+        w_t_minus_1[:, 0] = 0.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            current = np.where(norms > 0, counts.dot(w * (costs - Q_hat)) / norms, 0.)
+            previous = np.where(norms[:, :-1] > 0, counts.dot(w_t_minus_1 * V_hat)[:, 1:] / norms[:, :-1], 0.)
+        estimates['weighted_doubly_robust'] = current.dot(discount) + previous.dot(discount[1:]) + counts.dot(V_hat[:, 0]) / n
+
+        estimates['AM'] = np.repeat(trajectories['AM'], len(counts))
+        return estimates
+
+    def bootstrap(self, trajectories, num_bootstrap, confidence=.95, seed=None, chunk=100):
+        '''
+        Percentile bootstrap over episodes. Returns name -> (low, high)
+        '''
+        n = trajectories['mask'].shape[0]
+        rng = np.random.RandomState(seed)
+        resampled = {}
+        for start in range(0, num_bootstrap, chunk):
+            counts = rng.multinomial(n, [1./n]*n, size=min(chunk, num_bootstrap - start))
+            for name, values in self.estimates(trajectories, counts).iteritems():
+                resampled.setdefault(name, []).append(values)
+
+        alpha = 100*(1 - confidence)/2.
+        return {name: tuple(np.percentile(np.hstack(values), [alpha, 100 - alpha])) for name, values in resampled.iteritems()}
 
     @staticmethod
     def discounted_sum(costs, discount):
@@ -1,12 +1,9 @@
 
 import numpy as np
-import keras
-from keras.models import Sequential, Model as KerasModel
-from keras.layers import Input, Dense, Flatten, concatenate, dot, MaxPooling2D
-from keras.losses import mean_squared_error
 import scipy.signal as signal
+from scipy import sparse
+from scipy.sparse.linalg import spsolve
 from env_nn import LakeNN
-from keras import optimizers
 
 import gym
 
@@ -15,25 +12,28 @@ import gym
 class MDPApproximator(LakeNN):
     def __init__(self, env, *args, **kw):
         '''
-        Approximate P(s'| s,a)
+        Approximate P(s'| s,a) and R(s,a)
+
+        reward_model: exact (the grid rule), table or ridge, see fit_reward
+        ridge: regularization of the ridge reward model
         '''
         self.env = env
 
         self.model_type = kw['model_type'] if 'model_type' in kw else 'mlp'
         self.gamma = .9
         super(MDPApproximator, self).__init__(68, 1, [8,8], 4, self.gamma, convergence_of_model_epsilon=1e-10, model_type='mlp', num_frame_stack=(1,), frame_skip=1, pic_size = (1,))
-        self.create_model(68,1)
+        self.num_states = np.prod(self.env.desc.shape)
+        self.values_cache = None
+        self.reward_model = kw['reward_model'] if 'reward_model' in kw else 'exact' # exact, table or ridge, see fit_reward
+        self.ridge = kw['ridge'] if 'ridge' in kw else 1e-3
+        if self.reward_model not in ['exact', 'table', 'ridge']:
+            raise ValueError('Unknown reward model %s, need exact, table or ridge' % self.reward_model)
 
     def create_model(self, num_inputs, num_outputs):
-        if self.model_type == 'mlp':
-            model = Sequential()
-            def init(): return keras.initializers.TruncatedNormal(mean=0.0, stddev=0.1, seed=np.random.randint(2**32))
-            model.add(Dense(64, activation='tanh', input_shape=(num_inputs,),kernel_initializer=init(), bias_initializer=init()))
-            model.add(Dense(num_outputs, activation='linear',kernel_initializer=init(), bias_initializer=init()))
-            model.compile(loss='mean_squared_error', optimizer='Adam', metrics=['accuracy'])
-            self.model = model
-        else:
-            self.model = super(MDPApproximator, self).create_model(num_inputs, num_outputs)
+        '''
+        No network: P and R are fit in closed form by run
+        '''
+        return None
 
     def run(self, dataset):
         '''
@@ -47,127 +47,134 @@ class MDPApproximator(LakeNN):
         the terminal absorbing state.
 
         Since everything is deterministic then P(s'|s,a) = 0 or 1.
+
+        The model is kept as sparse (states*actions, states) matrices: self.P, and
+        self.continuation, which leaves out the transitions seen ending an episode.
+        '''
+        num_states, num_actions = self.num_states, self.dim_of_actions
+        x = np.asarray(dataset['x']).reshape(-1).astype(int)
+        a = np.asarray(dataset['a']).reshape(-1).astype(int)
+        x_prime = np.asarray(dataset['x_prime']).reshape(-1).astype(int)
+        done = np.asarray(dataset['done']).reshape(-1).astype(bool)
+
+        # key (x,a,x') = (x*|A| + a)*|S| + x'
+        state_action = x*num_actions + a
+        transitions = state_action*num_states + x_prime
+        unique, count = np.unique(transitions, return_counts=True)
+        count_a_given_x = np.bincount(state_action, minlength=num_states*num_actions)
+        rows, cols = unique // num_states, unique % num_states
+        prob = count / count_a_given_x[rows].astype(float)
+        terminal = np.isin(unique, transitions[done])
+
+        shape = (num_states*num_actions, num_states)
+        self.P = sparse.csr_matrix((prob, (rows, cols)), shape=shape)
+        self.continuation = sparse.csr_matrix((prob[~terminal], (rows[~terminal], cols[~terminal])), shape=shape)
+        self.values_cache = None
+
+        self.fit_reward(dataset['x'], a, np.asarray(dataset['cost']).reshape(-1))
+
+    def fit_reward(self, x, a, cost):
+        '''
+        Fits R according to self.reward_model:
+            exact: the grid rule, nothing to fit
+            table: mean observed cost of every (s,a), 0 if never seen. One bincount pass
+            ridge: one linear model of the state features per action, solved in closed form
         '''
-        transitions = np.vstack([dataset['x'],dataset['a'],dataset['x_prime']]).T
-        unique, idx, count = np.unique(transitions, return_index=True, return_counts=True, axis=0)
-
-        partial_transitions = np.vstack([dataset['x'],dataset['a']]).T
-        unique_a_given_x, idx_a_given_x, count_a_given_x = np.unique(partial_transitions, return_index=True, return_counts=True, axis=0)
-
-        # key=(state, action). value= number of times a was taking in state
-        all_counts_a_given_x = {tuple(key):value for key,value in zip(unique_a_given_x,count_a_given_x)}
-        
-        prob = {}
-        for idx,row in enumerate(unique): 
-            if tuple(row[:-1]) in prob:
-                prob[tuple(row[:-1])][row[-1]] = count[idx] / all_counts_a_given_x[(row[0],row[1])]
-            else:
-                prob[tuple(row[:-1])] = {}
-                prob[tuple(row[:-1])][row[-1]] = count[idx] / all_counts_a_given_x[(row[0],row[1])]
-
-        all_transitions = np.vstack([dataset['x'],dataset['a'],dataset['x_prime'], dataset['done']]).T
-        self.terminal_transitions = {tuple([x,a,x_prime]):1 for x,a,x_prime in all_transitions[all_transitions[:,-1] == True][:,:-1]}
-
-        # Actually fitting R, not Q_k
-        self.Q_k = self.model #init_Q(model_type=self.model_type)
-        X_a = np.array(zip(dataset['x'],dataset['a']))#dataset['state_action']
-        x_prime = dataset['x_prime']
-        index_of_skim = self.skim(X_a, x_prime)
-        self.fit(X_a[index_of_skim], dataset['cost'][index_of_skim], batch_size=len(index_of_skim), verbose=0, epochs=1000)
-        self.reward = self
-        self.P = prob
-
-    def skim(self, X_a, x_prime):
-        full_set = np.hstack([X_a, x_prime.reshape(1,-1).T])
-        idxs = np.unique(full_set, axis=0, return_index=True)[1]
-        return idxs
-
-    def R(self, *args):
-        # Exact R
-        mapping = {0:[0,-1], 1:[1,0], 2:[0,1], 3:[-1,0]}
-        x = args[0]
-        x, y = np.where(np.arange(np.prod(self.env.desc.shape)).reshape(self.env.desc.shape) == x)
-        x,y = x[0], y[0]
-        delta_x,delta_y = mapping[args[1][0]]
-        new_x = x + delta_x
-        new_y = y + delta_y
-        new_x,new_y = (new_x,new_y) if (0 <= new_x < self.env.desc.shape[0] and 0 <= new_y < self.env.desc.shape[1]) else (x,y)
-        return [[1]] if self.env.desc[new_x,new_y]=='H' else [[0]]
-
-        # Approximated Rewards
-        # return self.reward(*args)
-
-    def transition(self, x, a):
-        # Exact MDP dynamics 
-        # mapping = {0:[0,-1], 1:[1,0], 2:[0,1], 3:[-1,0]}
-        # x, y = np.where(np.arange(np.prod(self.env.desc.shape)).reshape(self.env.desc.shape) == x)
-        # x,y = x[0], y[0]
-        # delta_x,delta_y = mapping[a]
-        # new_x = x + delta_x
-        # new_y = y + delta_y
-        # new_x,new_y = (new_x,new_y) if (0 <= new_x < self.env.desc.shape[0] and 0 <= new_y < self.env.desc.shape[1]) else (x,y)
-        # done = True if self.env.desc[new_x,new_y]=='H' else False
-        # done = done or (True if self.env.desc[new_x,new_y]=='G' else False)
-        # return np.arange(np.prod(self.env.desc.shape)).reshape(self.env.desc.shape)[new_x,new_y], done
-        
-        #Approximated dynamics
-        if tuple([x,a]) in self.P:
-            try:
-                state = np.random.choice(self.P[(x,a)].keys(), p=self.P[(x,a)].values())
-            except:
-                import pdb; pdb.set_trace()
-            done = False
+        a = np.asarray(a).reshape(-1).astype(int)
+        if self.reward_model == 'table':
+            state_action = np.asarray(x).reshape(-1).astype(int)*self.dim_of_actions + a
+            total = np.bincount(state_action, weights=cost, minlength=self.num_states*self.dim_of_actions)
+            count = np.bincount(state_action, minlength=self.num_states*self.dim_of_actions)
+            self.rewards = (total / np.maximum(count, 1)).reshape(self.num_states, self.dim_of_actions)
+        elif self.reward_model == 'ridge':
+            features = self.reward_features(x, a)
+            self.reward_weights = np.linalg.solve(features.T.dot(features) + self.ridge*np.eye(features.shape[1]), features.T.dot(cost))
+        elif self.reward_model != 'exact':
+            raise ValueError('Unknown reward model %s' % self.reward_model)
+        self.values_cache = None
+
+    def reward_features(self, x, a):
+        '''
+        [phi(x), 1] in the block of action a, zeros elsewhere. phi: one hot state for
+        lake states, the flattened input otherwise
+        '''
+        x = np.asarray(x)
+        if x.size == len(x):
+            phi = np.eye(self.num_states)[x.reshape(-1).astype(int)]
         else:
-            state = None
-            done = True
+            phi = x.reshape(len(x), -1).astype(float)
+        phi = np.hstack([phi, np.ones((len(phi), 1))])
+        return (np.eye(self.dim_of_actions)[a][:, :, np.newaxis] * phi[:, np.newaxis, :]).reshape(len(phi), -1)
 
-        return state, done
+    def reward_table(self):
+        '''
+        R(s,a) for every state and action
+        '''
+        if self.reward_model == 'table':
+            return self.rewards
+        if self.reward_model == 'ridge':
+            states, actions = np.divmod(np.arange(self.num_states*self.dim_of_actions), self.dim_of_actions)
+            return self.R(states, actions).reshape(self.num_states, self.dim_of_actions)
+        return self.exact_reward_table()
+
+    def exact_reward_table(self):
+        '''
+        Exact R(s,a) for every state and action: 1 if a moves into a hole
+        '''
+        mapping = np.array([[0,-1], [1,0], [0,1], [-1,0]])
+        rows, cols = self.env.desc.shape
+        state = np.arange(rows*cols)
+        new_x = state[:, np.newaxis] // cols + mapping[np.newaxis, :, 0]
+        new_y = state[:, np.newaxis] % cols + mapping[np.newaxis, :, 1]
+        inside = (0 <= new_x) & (new_x < rows) & (0 <= new_y) & (new_y < cols)
+        new_x = np.where(inside, new_x, state[:, np.newaxis] // cols)
+        new_y = np.where(inside, new_y, state[:, np.newaxis] % cols)
+        return (self.env.desc[new_x, new_y] == 'H').astype(float)
+
+    def R(self, x, a):
+        '''
+        R(x_i, a_i) for a batch
+        '''
+        a = np.asarray(a).reshape(-1).astype(int)
+        if self.reward_model == 'ridge':
+            return self.reward_features(x, a).dot(self.reward_weights)
+        return self.reward_table()[np.asarray(x).reshape(-1).astype(int), a]
 
-    def Q(self, policy, x, a):
+    def values(self, policy, horizon=None):
+        '''
+        Q^pi (states, actions) and V^pi (states,) of the fitted model, for every state at once.
+        pi is queried once, on all states.
+
+        Q^pi(s,a) = R(s,a) + gamma sum_s' P(s'|s,a) V^pi(s'), where an unseen (s,a) or a
+        transition seen ending an episode leads to the terminal state.
+
+        horizon: None solves the linear system exactly. Otherwise the value of the first horizon steps
+        '''
+        if (self.values_cache is not None) and (self.values_cache[0] is policy) and (self.values_cache[1] == horizon):
+            return self.values_cache[2:]
+
+        num_states, num_actions = self.num_states, self.dim_of_actions
+        R = self.reward_table()
+        pi = np.asarray(policy(np.arange(num_states))).reshape(-1).astype(int)
+        P_pi = self.continuation[np.arange(num_states)*num_actions + pi]
+        R_pi = R[np.arange(num_states), pi]
+
+        if horizon is None:
+            V = spsolve(sparse.identity(num_states, format='csc') - self.gamma*P_pi.tocsc(), R_pi)
+        else:
+            V = np.zeros(num_states)
+            for _ in range(horizon):
+                V = R_pi + self.gamma*P_pi.dot(V)
+        Q = R + self.gamma*self.continuation.dot(V).reshape(num_states, num_actions)
+
+        self.values_cache = (policy, horizon, Q, V)
+        return Q, V
 
-        Qs = []
-
-        state = x
-        original_a = a
-        done = False
-        costs = []
-        trajectory_length = -1
-        # Q
-        while not done and trajectory_length < 200:
-            trajectory_length += 1
-            if trajectory_length > 0:
-                a = policy([state])[0]
-
-           
-            new_state, done = self.transition(state, a)
-            costs.append( self.R([state], [a])[0][0] )
-            if (tuple([state,a,new_state]) in self.terminal_transitions):
-                done = True
-                
-            
-            state = new_state
-
-        return self.discounted_sum(costs, self.gamma)
+    def Q(self, policy, x, a):
+        return self.values(policy)[0][x, a]
 
     def V(self, policy, x):
-        state = x
-        done = False
-        weighted_costs = []
-        trajectory_length = -1
-        # V
-        while not done and trajectory_length < 200:
-            trajectory_length += 1
-            # Because greedy deterministic policy
-            a = policy([state])[0]
-
-            new_state, done = self.transition(state, a)
-            weighted_costs.append( self.R([state], [a])[0][0] )
-            if (tuple([state,a,new_state]) in self.terminal_transitions):
-                done = True
-                
-            state = new_state
-
-        return self.discounted_sum(weighted_costs, self.gamma)
+        return self.values(policy)[1][x]
 
     @staticmethod
     def discounted_sum(costs, discount):
@@ -23,6 +23,20 @@ class Model(object):
     def copy_over_to(self, to_):
         to_.model.set_weights(self.model.get_weights())
 
+    @property
+    def policy_evalutor(self):
+        '''
+        Debug only. Subclasses can set make_policy_evalutor instead: the evaluator is then built
+        on first use, not with every network
+        '''
+        if (getattr(self, '_policy_evalutor', None) is None) and (getattr(self, 'make_policy_evalutor', None) is not None):
+            self._policy_evalutor = self.make_policy_evalutor()
+        return getattr(self, '_policy_evalutor', None)
+
+    @policy_evalutor.setter
+    def policy_evalutor(self, policy_evalutor):
+        self._policy_evalutor = policy_evalutor
+
     def evaluate(self, verbose=False, render=False, **kw):
         return self.policy_evalutor.run(self, verbose=verbose, render=render, **kw)
 
@@ -3,6 +3,7 @@
 import numpy as np
 from copy import deepcopy
 from value_function import ValueFunction
+from policy_action_cache import PolicyActionCache
 import pandas as pd
 from replay_buffer import Dataset
 import deepdish as dd
@@ -43,6 +44,7 @@ class Program(object):
         self.prev_lagrangians = []
         self.max_iterations = max_iterations if max_iterations is not None else np.inf
         self.iteration = -2
+        self.policy_actions = PolicyActionCache() # pi(x') per policy, for FQE
 
     def best_response(self, lamb, idx=0, **kw):
         '''
@@ -99,34 +101,14 @@ class Program(object):
         best_policy, values = self.best_response(lamb, idx=1, desc='FQI pi(lambda_avg)', exact=self.exact_policy_evaluation)
 
         if self.env.env_type=='car':
-            dataset_length = len(self.dataset)
-            batch_size = 512
-            num_batches = int(np.ceil(dataset_length/float(batch_size)))
+            self.dataset.data['pi_of_x_prime'] = self.policy_actions(best_policy, self.dataset, desc='Creating best_response(x\')')
 
-            actions = []
-            all_idxs = range(dataset_length)
-            print 'Creating best_response(x\')' 
-            for i in tqdm(range(num_batches)):
-                idxs = all_idxs[(batch_size*i):(batch_size*(i+1))]
-                states = np.rollaxis(self.dataset['frames'][self.dataset['next_states'][idxs]],1,4)
-                actions.append(best_policy([states], x_preprocessed=True))
 
-            self.dataset.data['pi_of_x_prime'] = np.hstack(actions)
-
-
-        # print 'Calculating C(best_response(lambda_avg))'
-        # dataset = deepcopy(self.dataset)
-        C_br, values = self.fitted_off_policy_evaluation_algorithm.run(best_policy,'c', self.dataset, desc='FQE C(pi(lambda_avg))')
-
-        
-        # print 'Calculating G(best_response(lambda_avg))'
-        G_br = []
-        for i in range(self.dim-1):
-            # dataset = deepcopy(self.dataset)
-            output, values = self.fitted_off_policy_evaluation_algorithm.run(best_policy,'g', self.dataset,  desc='FQE G_%s(pi(lambda_avg))'% i, g_idx=i)
-            G_br.append(output)
-        G_br.append(0)
-        G_br = np.array(G_br)
+        # print 'Calculating C, G(best_response(lambda_avg))'
+        # one multi-output FQE: [C, G_0, ..., G_{dim-2}]
+        output, values = self.fitted_off_policy_evaluation_algorithm.run(best_policy,'all', self.dataset, desc='FQE C,G(pi(lambda_avg))')
+        C_br = output[0]
+        G_br = np.hstack([output[1:], 0])
 
         if self.env is not None:
             print 'Calculating exact C, G policy evaluation'
@@ -144,38 +126,24 @@ class Program(object):
     def update(self, policy, values, iteration):
         
         if self.env.env_type=='car':
-            dataset_length = len(self.dataset)
-            batch_size = 512
-            num_batches = int(np.ceil(dataset_length/float(batch_size)))
-
-            actions = []
-            all_idxs = range(dataset_length)
-            print 'Creating pi_%s(x\')' % iteration 
-            for i in tqdm(range(num_batches)):
-                idxs = all_idxs[(batch_size*i):(batch_size*(i+1))]
-                states = np.rollaxis(self.dataset['frames'][self.dataset['next_states'][idxs]],1,4)
-                actions.append(policy([states], x_preprocessed=True))
+            self.dataset.data['pi_of_x_prime'] = self.policy_actions(policy, self.dataset, desc='Creating pi_%s(x\')' % iteration)
 
-            self.dataset.data['pi_of_x_prime'] = np.hstack(actions)
+        # one multi-output FQE: [C, G_0, ..., G_{dim-2}]
+        output, eval_values = self.fitted_off_policy_evaluation_algorithm.run(policy,'all', self.dataset, desc='FQE C,G(pi_%s)' %  iteration)
+        eval_values = np.array(eval_values).reshape(-1, len(output))
 
         #update C
-        # dataset = deepcopy(self.dataset)
-        C_pi, eval_values = self.fitted_off_policy_evaluation_algorithm.run(policy,'c', self.dataset, desc='FQE C(pi_%s)' %  iteration)
-        self.C.append(C_pi, policy)
+        C_pi = output[0]
+        self.C.append(C_pi) # not the policy: the best response reuses its network, see FittedAlgo.networks
         C_pi = np.array(C_pi)
         self.C.add_exact_values(values)
-        self.C.add_eval_values(eval_values, 0)
+        self.C.add_eval_values(eval_values[:,0].tolist(), 0)
 
         #update G
-        G_pis = []       
         for i in range(self.dim-1):        
-            # dataset = deepcopy(self.dataset)
-            output, eval_values = self.fitted_off_policy_evaluation_algorithm.run(policy,'g', self.dataset, desc='FQE G_%s(pi_%s)' %  (i, iteration), g_idx = i)
-            G_pis.append(output)
-            self.G.add_eval_values(eval_values, i)
-        G_pis.append(0)
-        self.G.append(G_pis, policy)
-        G_pis = np.array(G_pis)
+            self.G.add_eval_values(eval_values[:,i+1].tolist(), i)
+        G_pis = np.hstack([output[1:], 0])
+        self.G.append(G_pis.tolist())
         
 
         # Get Exact Policy
@@ -199,10 +167,11 @@ class Program(object):
         '''
         Add more data
         '''
+        episode = kw['episode'] if 'episode' in kw else None
         if ('start' in kw) and kw['start']: 
-            self.dataset.start_new_episode(*data)
+            self.dataset.start_new_episode(*data, episode=episode)
         else:
-            self.dataset.append(*data)
+            self.dataset.append(*data, episode=episode)
 
     def finish_collection(self, env_type):
         # preprocess
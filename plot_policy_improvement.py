@@ -9,6 +9,7 @@ from matplotlib.legend import Legend
 import seaborn as sns; sns.set(color_codes=True)
 import os
 import scipy.signal as signal
+from replay_buffer import episode_offsets_from_done
 
 # Colors
 alpha = 0.15
@@ -35,9 +36,9 @@ def color_gen():
 
 dones = dd.io.load(os.path.join('seed_2_data', 'car_data_is_done_seed_2.h5'))
 costs = dd.io.load(os.path.join('seed_2_data', 'car_data_rewards_seed_2.h5'))
-dones = np.hstack([0,1+np.where(dones)[0]])
+offsets = episode_offsets_from_done(dones, complete_only=True)
 episodes = []
-for low_, high_ in zip(dones[:-1], dones[1:]):
+for low_, high_ in zip(offsets[:-1], offsets[1:]):
     new_episode ={
         'c': costs[low_:high_, 0].reshape(-1),
         'brake': costs[low_:high_, -1].reshape(-1),
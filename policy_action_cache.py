@@ -0,0 +1,67 @@
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from tqdm import tqdm
+from feature_cache import FeatureCache
+
+
+class PolicyActionCache(object):
+    def __init__(self, max_size=8, batch_size=2048):
+        '''
+        pi(x') over the whole dataset, computed once per policy.
+
+        Entries are keyed by a hash of the policy's weights (or its identity if it
+        has none), so a policy that is evaluated again reuses its actions. At most
+        max_size action arrays are kept; the least recently used one is dropped first.
+
+        max_size: number of policies to remember
+        batch_size: number of states per forward pass
+        '''
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.actions = OrderedDict()
+
+    def __call__(self, policy, dataset, desc='pi(x\')'):
+        '''
+        Returns pi(x') as a uint8 array, one action per transition in the dataset
+        '''
+        key = (self.key_of(policy), id(dataset), len(dataset))
+        if key in self.actions:
+            self.actions[key] = self.actions.pop(key) # most recently used goes last
+            return self.actions[key]
+
+        actions = self.compute(policy, dataset, desc)
+        self.actions[key] = actions
+        while len(self.actions) > self.max_size:
+            self.actions.popitem(last=False)
+        return actions
+
+    def compute(self, policy, dataset, desc):
+        dataset_length = len(dataset)
+        actions = np.empty(dataset_length, dtype='uint8')
+
+        features = getattr(dataset, 'feature_cache', None)
+        if (features is not None) and (getattr(policy, 'head', None) is not None) and (features.key == FeatureCache.key_of(policy, dataset)):
+            # frozen conv layers: only the dense layers have to run
+            for low in tqdm(range(0, dataset_length, self.batch_size), desc=desc):
+                idxs = np.arange(low, min(low+self.batch_size, dataset_length))
+                actions[idxs] = policy.min_and_argmin(policy.all_actions_from_features(features.next(idxs)), axis=1)[1]
+            return actions
+
+        for low in tqdm(range(0, dataset_length, self.batch_size), desc=desc):
+            high = min(low+self.batch_size, dataset_length)
+            states = np.rollaxis(dataset['frames'][dataset['next_states'][low:high]],1,4)
+            actions[low:high] = policy([states], x_preprocessed=True)
+        return actions
+
+    @staticmethod
+    def key_of(policy):
+        try:
+            weights = policy.model.get_weights()
+        except AttributeError:
+            return id(policy)
+
+        sha1 = hashlib.sha1()
+        for w in weights:
+            sha1.update(np.ascontiguousarray(w).tobytes())
+        return sha1.hexdigest()
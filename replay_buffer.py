@@ -1,6 +1,7 @@
 
 import numpy as np
 import deepdish as dd
+import copy
 
 class Buffer(object):
     """
@@ -175,6 +176,33 @@ class Buffer(object):
 
 
 
+def episode_offsets_from_done(done, complete_only=False):
+    '''
+    CSR episode index from the done flags: episode i is transitions offsets[i]:offsets[i+1].
+    A last episode that has not ended is kept, unless complete_only
+    '''
+    done = np.asarray(done).reshape(-1)
+    ends = 1 + np.nonzero(done)[0]
+    if not complete_only: ends = np.hstack([ends, len(done)])
+    return np.unique(np.hstack([0, ends])).astype(int)
+
+
+def pad_episodes(values, offsets, idxs=None, fill=0):
+    '''
+    Per transition values -> (episodes, longest episode, ...) array padded with fill, and the mask of real entries.
+    offsets: CSR episode index of values. idxs: episodes to take (default all)
+    '''
+    offsets = np.asarray(offsets)
+    idxs = np.arange(len(offsets) - 1) if idxs is None else np.asarray(idxs, dtype=int).reshape(-1)
+    lengths = offsets[idxs + 1] - offsets[idxs]
+    t = np.arange(lengths.max() if len(lengths) else 0)
+    mask = t[np.newaxis, :] < lengths[:, np.newaxis]
+    rows = np.minimum(offsets[idxs][:, np.newaxis] + t[np.newaxis, :], max(offsets[-1] - 1, 0))
+    values = np.asarray(values)[rows]
+    values[~mask] = fill
+    return values, mask
+
+
 class Dataset(Buffer):
     def __init__(self, num_frame_stack, pic_size, n_costs):
         
@@ -184,19 +212,42 @@ class Dataset(Buffer):
         self.max_trajectory_length = 0
         self.n_costs = n_costs
         self.episodes = [Buffer(num_frame_stack=self.num_frame_stack,buffer_size=int(200000),min_buffer_size_to_train=0,pic_size = self.pic_size, n_costs = self.n_costs)]
-
-    def append(self, *args):
+        self.current_episode = None
+        self.frame_windows = {}
+        self.episode_numbers = {} # running episode -> order it was started in
+        self.num_started_episodes = 0
+        self.transition_episodes = [] # episode number of every transition, see preprocess
+        self.behavior_policies = [] # see BehaviorPolicy.of_dataset
+
+    def use_episode(self, episode):
+        '''
+        Several episodes can be collected at once (see VectorCollector). Each keeps its
+        own frame window into the shared buffer; this makes episode's the current one.
+        '''
+        if episode == self.current_episode: return
+        buf = self.episodes[-1]
+        self.frame_windows[self.current_episode] = (buf.frame_window, buf.expecting_new_episode)
+        buf.frame_window, buf.expecting_new_episode = self.frame_windows.pop(episode, (None, True))
+        self.current_episode = episode
+
+    def append(self, *args, **kw):
+        self.use_episode(kw.get('episode'))
         self.episodes[-1].append(*args)
+        self.transition_episodes.append(self.episode_numbers[self.current_episode])
 
         # update max_trajectory_length
         if self.episodes[-1].get_length() > self.max_trajectory_length:
             self.max_trajectory_length = self.episodes[-1].get_length()
 
-    def start_new_episode(self, *args):
+    def start_new_episode(self, *args, **kw):
+        self.use_episode(kw.get('episode'))
+        self.episode_numbers[self.current_episode] = self.num_started_episodes
+        self.num_started_episodes += 1
         # self.episodes.append(Buffer(num_frame_stack=self.num_frame_stack,buffer_size=int(2000),min_buffer_size_to_train=0,pic_size = self.pic_size, n_costs = self.n_costs))
         self.episodes[-1].start_new_episode(args[0])
 
-    def current_state(self):
+    def current_state(self, episode=None):
+        self.use_episode(episode)
         return self.episodes[-1].current_state()
         
     def get_max_trajectory_length(self):
@@ -211,10 +262,89 @@ class Dataset(Buffer):
     def __len__(self):
         return len(self.data['a'])-5
 
+    @property
+    def episode_offsets(self):
+        '''
+        Episode i is transitions episode_offsets[i]:episode_offsets[i+1]. Built by preprocess
+        and saved with the data; rebuilt from done for data loaded without it
+        '''
+        if 'episode_offsets' not in self.data:
+            self.data['episode_offsets'] = episode_offsets_from_done(self.data['done'])
+        return self.data['episode_offsets']
+
+    def num_episodes(self):
+        return len(self.episode_offsets) - 1
+
+    def episode_lengths(self):
+        return np.diff(self.episode_offsets)
+
+    def transition_keys(self):
+        # keys holding one entry per transition
+        num_transitions = self.episode_offsets[-1]
+        return [key for key, val in self.data.iteritems() if (key not in ['frames', 'episode_offsets']) and isinstance(val, np.ndarray) and (len(val) == num_transitions)]
+
+    def episode(self, i, keys=None):
+        '''
+        Episode i as {key: view into the data}. No copies
+        '''
+        low, high = self.episode_offsets[i], self.episode_offsets[i+1]
+        return {key: self.data[key][low:high] for key in (self.transition_keys() if keys is None else keys)}
+
+    def episode_transitions(self, idxs=None, lengths=None):
+        '''
+        Transition indices of the episodes idxs, back to back. lengths: keep only the first lengths[i] of episode idxs[i].
+        Returns indices, offsets of the episodes within them
+        '''
+        offsets = self.episode_offsets
+        idxs = np.arange(len(offsets) - 1) if idxs is None else np.asarray(idxs, dtype=int).reshape(-1)
+        starts = offsets[idxs]
+        full = offsets[idxs + 1] - starts
+        lengths = full if lengths is None else np.minimum(np.asarray(lengths, dtype=int).reshape(-1), full)
+        new_offsets = np.hstack([0, np.cumsum(lengths)]).astype(int)
+        return np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1]), new_offsets
+
+    def ragged(self, key, idxs=None):
+        '''
+        data[key] of the episodes idxs back to back, and their offsets. All episodes: no copy
+        '''
+        if idxs is None: return self.data[key], self.episode_offsets
+        rows, offsets = self.episode_transitions(idxs)
+        return self.data[key][rows], offsets
+
+    def padded(self, key, idxs=None, fill=0):
+        '''
+        data[key] of the episodes idxs as an (episodes, longest episode, ...) array, padded with fill,
+        and the (episodes, longest episode) mask of real entries
+        '''
+        return pad_episodes(self.data[key], self.episode_offsets, idxs, fill)
+
+    def subset(self, idxs, lengths=None):
+        '''
+        A Dataset of the episodes idxs (each cut to lengths[i] if given), sharing the frames
+        '''
+        rows, offsets = self.episode_transitions(idxs, lengths)
+        keys = self.transition_keys()
+        dataset = copy.copy(self)
+        dataset.behavior_policies = []
+        dataset.data = {key: (val[rows] if key in keys else val) for key, val in self.data.iteritems()}
+        dataset.data['episode_offsets'] = offsets
+        dataset.max_trajectory_length = np.max(np.diff(offsets)) if len(offsets) > 1 else 0
+        return dataset
+
     def preprocess(self, env_type):
 
         for key in ['frames', 'prev_states', 'next_states', 'a', 'done', 'c', 'g']:
             self.data[key] = self.episodes[-1].get_all(key)
+
+        # episodes collected side by side (VectorCollector) are interleaved in the buffer.
+        # Make each one contiguous; frames stay where they are
+        episode_of = np.array(self.transition_episodes[:len(self.data['a'])], dtype=int)
+        order = np.argsort(episode_of, kind='mergesort')
+        if np.any(order != np.arange(len(order))):
+            for key in ['prev_states', 'next_states', 'a', 'done', 'c', 'g']:
+                self.data[key] = self.data[key][order]
+        lengths = np.bincount(episode_of)
+        self.data['episode_offsets'] = np.hstack([0, np.cumsum(lengths[lengths > 0])]).astype(int)
         
         # [x.preprocess(env_type) for x in self.episodes]
 
@@ -268,7 +398,7 @@ class Dataset(Buffer):
         # [x.calculate_cost(lamb) for x in self.episodes]
 
     def set_cost(self, key, idx=None):
-        if key == 'g': assert idx is not None, 'Evaluation must be done per constraint until parallelized'
+        if key == 'g': assert idx is not None, "Pick the constraint with idx, or use key='all' to evaluate every cost at once"
 
         if key == 'c':
             self.scale = np.max(np.abs(self.data['c']))
@@ -279,5 +409,11 @@ class Dataset(Buffer):
             self.scale = np.max(np.abs(np.array(self.data['g'])[:,idx]))
             self.data['cost'] = np.array(self.data['g'])[:,idx]/self.scale
             # [x.set_cost('g', idx) for x in self.episodes]
+        elif key == 'all':
+            # c and every g, one column each: [c, g_0, ..., g_m]. Each column (and scale) as if set on its own
+            costs = np.hstack([np.array(self.data['c']).reshape(-1,1), np.array(self.data['g']).reshape(len(self.data['c']),-1)])
+            self.scale = np.max(np.abs(costs), axis=0)
+            self.scale[self.scale == 0] = 1. # a cost that is never incurred
+            self.data['cost'] = costs/self.scale
         else:
             raise
@@ -10,6 +10,7 @@ from optimization_problem import Program
 from fittedq import *
 from exponentiated_gradient import ExponentiatedGradient
 from fitted_off_policy_evaluation import *
+from tabular_q import LakeTabularQIteration, LakeTabularQEvaluation
 from exact_policy_evaluation import ExactPolicyEvaluator
 from stochastic_policy import StochasticPolicy
 from DQN import DeepQLearning
@@ -18,6 +19,9 @@ from keras.models import load_model
 from keras import backend as K
 from env_dqns import *
 import deepdish as dd
+from frame_store import gray_frame_store
+from env_pool import EnvPool
+from vector_collector import VectorCollector, exploration_schedule
 import time
 import os
 np.set_printoptions(suppress=True)
@@ -119,27 +123,35 @@ def main(env_name, headless):
 
     #### Problem setup
     if env_name == 'lake':
-        best_response_algorithm = LakeFittedQIteration(state_space_dim + action_space_dim, 
-                                                       [map_size, map_size], 
-                                                       action_space_dim, 
-                                                       max_Q_fitting_epochs, 
-                                                       gamma, 
-                                                       model_type=model_type, 
-                                                       position_of_goals=position_of_goals, 
-                                                       position_of_holes=position_of_holes,
-                                                       num_frame_stack=num_frame_stack)
-        
-        fitted_off_policy_evaluation_algorithm = LakeFittedQEvaluation(initial_states, 
-                                                           state_space_dim + action_space_dim, 
+        exact_policy_algorithm = ExactPolicyEvaluator(action_space_map, gamma, env=env, frame_skip=frame_skip, num_frame_stack=num_frame_stack, pic_size = pic_size)
+        if tabular_backend:
+            best_response_algorithm = LakeTabularQIteration(state_space_dim, action_space_dim, gamma, policy_evalutor=exact_policy_algorithm)
+            fitted_off_policy_evaluation_algorithm = LakeTabularQEvaluation(initial_states, state_space_dim, action_space_dim, gamma)
+        else:
+            best_response_algorithm = LakeFittedQIteration(state_space_dim + action_space_dim, 
                                                            [map_size, map_size], 
                                                            action_space_dim, 
-                                                           max_eval_fitting_epochs, 
+                                                           max_Q_fitting_epochs, 
                                                            gamma, 
                                                            model_type=model_type, 
                                                            position_of_goals=position_of_goals, 
                                                            position_of_holes=position_of_holes,
-                                                           num_frame_stack=num_frame_stack)
-        exact_policy_algorithm = ExactPolicyEvaluator(action_space_map, gamma, env=env, frame_skip=frame_skip, num_frame_stack=num_frame_stack, pic_size = pic_size)
+                                                           num_frame_stack=num_frame_stack,
+                                                           warm_start=warm_start,
+                                                           warm_start_epochs=warm_start_fitting_epochs)
+        
+            fitted_off_policy_evaluation_algorithm = LakeFittedQEvaluation(initial_states, 
+                                                               state_space_dim + action_space_dim, 
+                                                               [map_size, map_size], 
+                                                               action_space_dim, 
+                                                               max_eval_fitting_epochs, 
+                                                               gamma, 
+                                                               model_type=model_type, 
+                                                               position_of_goals=position_of_goals, 
+                                                               position_of_holes=position_of_holes,
+                                                               num_frame_stack=num_frame_stack,
+                                                               warm_start=warm_start,
+                                                               warm_start_epochs=warm_start_fitting_epochs)
     elif env_name == 'car':
         best_response_algorithm = CarFittedQIteration(state_space_dim, 
                                                       action_space_dim, 
@@ -148,13 +160,21 @@ def main(env_name, headless):
                                                       model_type=model_type,
                                                       num_frame_stack=num_frame_stack,
                                                       initialization=policy_old,
-                                                      freeze_cnn_layers=freeze_cnn_layers)# for _ in range(2)]
+                                                      freeze_cnn_layers=freeze_cnn_layers,
+                                                      feature_cache_dir=feature_cache_dir,
+                                                      warm_start=warm_start,
+                                                      warm_start_epochs=warm_start_fitting_epochs)# for _ in range(2)]
         fitted_off_policy_evaluation_algorithm = CarFittedQEvaluation(state_space_dim, 
                                                                       action_space_dim, 
                                                                       max_eval_fitting_epochs, 
                                                                       gamma, 
                                                                       model_type=model_type,
-                                                                      num_frame_stack=num_frame_stack)# for _ in range(2*len(constraints_cared_about) + 2)] 
+                                                                      num_frame_stack=num_frame_stack,
+                                                                      initialization=policy_old,
+                                                                      freeze_cnn_layers=freeze_cnn_layers,
+                                                                      feature_cache_dir=feature_cache_dir,
+                                                                      warm_start=warm_start,
+                                                                      warm_start_epochs=warm_start_fitting_epochs)# for _ in range(2*len(constraints_cared_about) + 2)] 
         exact_policy_algorithm = ExactPolicyEvaluator(action_space_map, gamma, env=env, frame_skip=frame_skip, num_frame_stack=num_frame_stack, pic_size = pic_size, constraint_thresholds=constraint_thresholds, constraints_cared_about=constraints_cared_about)
     else:
         raise
@@ -194,15 +214,13 @@ def main(env_name, headless):
         if env_name == 'car': 
             tic = time.time()
             action_data = dd.io.load('./seed_2_data/car_data_actions_seed_2.h5')
-            frame_data = dd.io.load('./seed_2_data/car_data_frames_seed_2.h5')
             done_data = dd.io.load('./seed_2_data/car_data_is_done_seed_2.h5')
             next_state_data = dd.io.load('./seed_2_data/car_data_next_states_seed_2.h5')
             current_state_data = dd.io.load('./seed_2_data/car_data_prev_states_seed_2.h5')
             cost_data = dd.io.load('./seed_2_data/car_data_rewards_seed_2.h5')
  
-            frame_gray_scale = np.zeros((len(frame_data),96,96)).astype('float32')
-            for i in range(len(frame_data)):
-                frame_gray_scale[i,:,:] = np.dot(frame_data[i,:,:,:]/255. , [0.299, 0.587, 0.114])
+            # gray-scaled once into an on-disk cache, then memory-mapped
+            frame_gray_scale = gray_frame_store('./seed_2_data/car_data_frames_seed_2.h5', num_workers=gray_scale_workers)
  
             problem.dataset.data = {'frames':frame_gray_scale,
                         'prev_states': current_state_data,
@@ -221,60 +239,22 @@ def main(env_name, headless):
     except:
         print 'Failed to load'
         print 'Recreating dataset'
-        num_goal = 0
-        num_hole = 0
-        dataset_size = 0 
-        main_tic = time.time()
-        # from layer_visualizer import LayerVisualizer; LV = LayerVisualizer(exploratory_policy_old.policy.Q.model)
-        for i in range(max_epochs):
-            tic = time.time()
-            x = env.reset()
-            problem.collect(x, start=True)
-            dataset_size += 1
-            if env_name in ['car']:  env.render()
-            done = False
-            time_steps = 0
-            episode_cost = 0
-            while not done:
-                time_steps += 1
-                if env_name in ['car']: 
-                    # 
-                    # epsilon decay
-                    exploratory_policy_old.epsilon = 1.-np.exp(-3*(i/float(max_epochs)))
-                
-                #LV.display_activation([problem.dataset.current_state()[np.newaxis,...], np.atleast_2d(np.eye(12)[0])], 2, 2, 0)
-                action = exploratory_policy_old([problem.dataset.current_state()], x_preprocessed=False)[0]
-                cost = []
-                for _ in range(frame_skip):
-                    if env_name in ['car']: env.render()
-                    x_prime, costs, done, _ = env.step(action_space_map[action])
-                    cost.append(costs)
-                    if done:
-                        break
-                cost = np.vstack([np.hstack(x) for x in cost]).sum(axis=0)
-                early_done, punishment = env.is_early_episode_termination(cost=cost[0], time_steps=time_steps, total_cost=episode_cost)
-                # print cost, action_space_map[action] #env.car.fuel_spent/ENGINE_POWER, env.tile_visited_count, len(env.track), env.tile_visited_count/float(len(env.track))
-                done = done or early_done
-
-                # if done and reward: num_goal += 1
-                # if done and not reward: num_hole += 1
-                episode_cost += cost[0] + punishment
-                c = (cost[0] + punishment).tolist()
-                g = cost[1:].tolist()
-                if len(g) < len(constraints): g=np.hstack([g,0])
-                problem.collect( action,
-                                 x_prime, #np.dot(x_prime/255. , [0.299, 0.587, 0.114]),
-                                 np.hstack([c,g]).reshape(-1).tolist(),
-                                 done
-                                 ) #{(x,a,x',c(x,a), g(x,a)^T, done)}
-                dataset_size += 1
-                x = x_prime
-            if (i % 1) == 0:
-                print 'Epoch: %s. Exploration probability: %s' % (i, np.round(exploratory_policy_old.epsilon,5), ) 
-                print 'Dataset size: %s Time Elapsed: %s. Total time: %s' % (dataset_size, time.time() - tic, time.time()-main_tic)
-                if env_name in ['car']: 
-                    print 'Performance: %s/%s = %s' %  (env.tile_visited_count, len(env.track), env.tile_visited_count/float(len(env.track)))
-                print '*'*20 
+        # collection_workers env replicas (0: env itself) stepped in lockstep, one policy call per step
+        if collection_workers == 0:
+            envs = EnvPool(None, 1, frame_skip=frame_skip, env=env)
+        else:
+            envs = EnvPool(make_env, collection_workers, frame_skip=frame_skip, in_process=collect_in_process)
+        collector = VectorCollector(envs,
+                                    exploratory_policy_old,
+                                    problem.dataset,
+                                    action_space_map,
+                                    num_constraints=len(constraints),
+                                    epsilon_schedule=exploration_schedule(max_epochs) if env_name in ['car'] else None,
+                                    render=(env_name in ['car']) and (collection_workers == 0))
+        try:
+            collector.collect(max_epochs)
+        finally:
+            envs.close()
         problem.finish_collection(env_name)
 
     if env_name in ['lake']:
@@ -299,7 +279,7 @@ def main(env_name, headless):
     iteration = 0
     while not problem.is_over(policies, lambdas, infinite_loop=infinite_loop, calculate_gap=calculate_gap, results_name=results_name, policy_improvement_name=policy_improvement_name):
         iteration += 1
-        K.clear_session()
+        # no K.clear_session(): FQI/FQE reuse their pooled networks, the graph does not grow
         for i in range(1):
            
             # policy_printer.pprint(policies)
@@ -319,7 +299,7 @@ def main(env_name, headless):
             lambda_t = lambdas[-1]
             pi_t, values = problem.best_response(lambda_t, desc='FQI pi_{0}_{1}'.format(iteration, i), exact=exact_policy_algorithm)
 
-            # policies.append(pi_t)
+            # policies.append(pi_t) # pi_t is pooled, valid until the next best_response
             problem.update(pi_t, values, iteration) #Evaluate C(pi_t), G(pi_t) and save
 
 if __name__ == "__main__":
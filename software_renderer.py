@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def gl_color(color):
+    '''
+    RGB floats in [0,1] -> uint8, rounded like GL stores them in an 8 bit color buffer
+    '''
+    return np.round(np.asarray(color, dtype=np.float32)[..., :3]*np.float32(255)).astype(np.uint8)
+
+
+class SoftwareRasterizer(object):
+    def __init__(self, width, height):
+        '''
+        Fills convex polygons into a preallocated uint8 (height, width, 3) image, in
+        painter's order, with no window, GL context or color buffer readback.
+
+        Coordinates are GL window coordinates: pixel (x, y) covers [x, x+1] x [y, y+1]
+        with y going up, and is filled if its center is inside the polygon.
+        Row 0 of the image is the top, like the array read back from GL.
+        '''
+        self.width = width
+        self.height = height
+        self.buffer = np.zeros((height, width, 3), dtype=np.uint8)
+
+    def clear(self, color=(0,0,0)):
+        self.buffer[...] = gl_color(color)
+
+    def fill_polygon(self, polygon, color):
+        self.fill_polygons([polygon], [color])
+
+    def fill_polygons(self, polygons, colors):
+        '''
+        Draws the polygons in order, later ones on top. All polygons are scan converted
+        at once: one span per (polygon, pixel row), then the last polygon covering a pixel wins.
+
+        polygons: list of (k_i, 2) convex polygons in window coordinates, or an (N, k, 2) array
+        colors: (N, 3) uint8
+        '''
+        if len(polygons) == 0: return
+        colors = np.asarray(colors, dtype=np.uint8).reshape(-1, 3)
+
+        # pad to the same number of vertices by repeating the last one (a zero length edge)
+        k = max(len(polygon) for polygon in polygons)
+        P = np.array([np.vstack([polygon, np.repeat(np.asarray(polygon)[-1:], k-len(polygon), axis=0)]) for polygon in polygons], dtype=float)
+        A, B = P, np.roll(P, -1, axis=1)
+
+        # rows whose pixel centers fall inside each polygon's y extent
+        y0 = np.maximum(np.ceil(P[...,1].min(axis=1) - .5), 0).astype(int)
+        y1 = np.minimum(np.floor(P[...,1].max(axis=1) - .5), self.height - 1).astype(int)
+        num_rows = np.maximum(y1 - y0 + 1, 0)
+        poly = np.repeat(np.arange(len(P)), num_rows)
+        if len(poly) == 0: return
+        row = y0[poly] + np.arange(len(poly)) - np.repeat(np.cumsum(num_rows) - num_rows, num_rows)
+        yc = row + .5
+
+        # x extent of each polygon on each row, from the non horizontal edges crossing it
+        ay, by = A[poly,:,1], B[poly,:,1]
+        ax, bx = A[poly,:,0], B[poly,:,0]
+        crosses = (np.minimum(ay, by) <= yc[:, np.newaxis]) & (yc[:, np.newaxis] <= np.maximum(ay, by)) & (ay != by)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            x = ax + (yc[:, np.newaxis] - ay)/(by - ay)*(bx - ax)
+        x_left = np.where(crosses, x, np.inf).min(axis=1)
+        x_right = np.where(crosses, x, -np.inf).max(axis=1)
+
+        x0 = np.maximum(np.ceil(x_left - .5), 0)
+        x1 = np.minimum(np.floor(x_right - .5), self.width - 1)
+        valid = x1 >= x0
+        poly, row, x0, x1 = poly[valid], row[valid], x0[valid].astype(int), x1[valid].astype(int)
+        num_pixels = x1 - x0 + 1
+        if len(poly) == 0: return
+
+        # every covered (pixel, polygon), image rows top down
+        span = np.repeat(np.arange(len(poly)), num_pixels)
+        column = x0[span] + np.arange(len(span)) - np.repeat(np.cumsum(num_pixels) - num_pixels, num_pixels)
+        pixel = (self.height - 1 - row[span])*self.width + column
+
+        # painter's order: per pixel, the highest polygon index
+        keys = np.sort(pixel*len(P) + poly[span])
+        last = np.hstack([keys[1:] // len(P) != keys[:-1] // len(P), True])
+        self.buffer.reshape(-1, 3)[keys[last] // len(P)] = colors[keys[last] % len(P)]
+
+    def image(self):
+        return self.buffer
@@ -70,12 +70,11 @@ class StochasticPolicy(Model):
 
             return np.atleast_2d(arr)
         else:
-            arr = []
-            for x in X:
-                if np.random.random() < self.epsilon:
-                    arr.append(-np.eye(self.action_space_dim)[np.random.choice(self.action_space_dim, p=self.prob)])
-                else:
-                    arr.append(-np.eye(self.action_space_dim)[self.policy.Q([x], x_preprocessed=x_preprocessed)[0]])
-
-            return np.atleast_2d(np.array(arr))
+            # one forward pass for the batch, then explore row by row.
+            # self.epsilon may be one value per row
+            arr = -np.eye(self.action_space_dim)[np.atleast_1d(self.policy.Q(list(X), x_preprocessed=x_preprocessed))]
+            explore = np.random.random(len(arr)) < self.epsilon
+            arr[explore] = -np.eye(self.action_space_dim)[np.random.choice(self.action_space_dim, size=explore.sum(), p=self.prob)]
+
+            return np.atleast_2d(arr)
 
@@ -0,0 +1,170 @@
+import numpy as np
+import scipy.sparse as sparse
+from model import Model
+from fitted_algo import FittedAlgo
+
+
+class TabularQ(Model):
+    def __init__(self, num_states, dim_of_actions, num_outputs=1, policy_evalutor=None):
+        '''
+        Q as a table. Drop-in replacement for LakeNN: same __call__/min_over_a/all_actions.
+
+        num_states: number of discrete states
+        dim_of_actions: dimension of action space
+        num_outputs: number of Q functions (e.g. one per cost). If > 1, all_actions
+                     returns (N, num_outputs, dim_of_actions) like CarNN
+        '''
+        super(TabularQ, self).__init__()
+        self.num_states = num_states
+        self.dim_of_actions = dim_of_actions
+        self.num_outputs = num_outputs
+        self.policy_evalutor = policy_evalutor
+        shape = (num_states, dim_of_actions) if num_outputs == 1 else (num_states, num_outputs, dim_of_actions)
+        self.Q = np.zeros(shape)
+
+    def representation(self, *args, **kw):
+        if len(args) == 1:
+            return np.array(args[0]).astype(int).reshape(-1)
+        elif len(args) == 2:
+            return np.array(args[0]).astype(int).reshape(-1), np.array(args[1]).astype(int).reshape(-1)
+        else:
+            raise NotImplemented
+
+    def fit(self, X, y, verbose=0):
+        raise NotImplemented # the table is solved for directly, see LakeTabularQIteration/Evaluation
+
+    def predict(self, X, a, **kw):
+        X, a = self.representation(X, a)
+        return self.Q[X, ..., a]
+
+    def all_actions(self, X, **kw):
+        return self.Q[self.representation(X)]
+
+    def copy_over_to(self, to_):
+        to_.Q = self.Q.copy()
+
+
+class TabularBellman(object):
+    def __init__(self, dataset, num_states, dim_of_actions, skim):
+        '''
+        The transitions of a lake dataset, deduplicated like the fitted algorithms do (skim),
+        plus the sparse matrix that averages per-sample targets into one value per (x,a).
+        Fitting a table with MSE to the targets gives exactly that average.
+        '''
+        X_a = np.hstack(dataset.get_state_action_pairs('lake'))
+        x_prime = dataset['x_prime']
+
+        self.index_of_skim = skim(X_a, x_prime)
+        X_a = X_a[self.index_of_skim].astype(int)
+        self.x_prime = np.array(x_prime)[self.index_of_skim].astype(int).reshape(-1)
+        self.not_done = 1 - dataset['done'][self.index_of_skim].astype(int)
+
+        num_samples = len(self.x_prime)
+        state_action = X_a[:,0]*dim_of_actions + X_a[:,1]
+        counts = np.bincount(state_action, minlength=num_states*dim_of_actions).astype(float)
+        self.average = sparse.csr_matrix((1./counts[state_action], (state_action, np.arange(num_samples))), shape=(num_states*dim_of_actions, num_samples))
+        self.seen = counts > 0
+
+    def solve(self, Q, costs, next_values, max_iterations=10000, epsilon=1e-8, values=None):
+        '''
+        Iterate Q(x,a) <- mean over samples of c + gamma*next_values(Q)(x') until converged.
+        Unseen (x,a) keep their value.
+
+        Q: TabularQ, updated in place
+        costs: (num_samples,) or (num_samples, num_outputs)
+        next_values: function Q table -> gamma*V(x') per sample, same shape as costs
+        values: optional function TabularQ -> value to record every iteration
+        '''
+        num_states, dim_of_actions = Q.num_states, Q.dim_of_actions
+        not_done = self.not_done.reshape((-1,) + (1,)*(costs.ndim-1))
+        recorded = []
+        for _ in range(max_iterations):
+            targets = (costs + next_values(Q.Q)*not_done).reshape(len(costs), -1)
+
+            # one row per (x,a), one column per output
+            new_Q = np.swapaxes(Q.Q.reshape(num_states, -1, dim_of_actions), 1, 2).reshape(num_states*dim_of_actions, -1).copy()
+            new_Q[self.seen] = self.average.dot(targets)[self.seen]
+            new_Q = np.swapaxes(new_Q.reshape(num_states, dim_of_actions, -1), 1, 2).reshape(Q.Q.shape)
+
+            delta = np.max(np.abs(new_Q - Q.Q))
+            Q.Q = new_Q
+            if values is not None: recorded.append(values(Q))
+            if delta < epsilon: break
+        return recorded
+
+
+class LakeTabularQIteration(FittedAlgo):
+    def __init__(self, num_states, dim_of_actions, gamma, max_iterations=10000, policy_evalutor=None):
+        '''
+        Fitted Q iteration on the lake with a table as the regressor: Bellman optimality
+        is iterated to convergence on the (skimmed) transitions, vectorized.
+        Same interface as LakeFittedQIteration.
+
+        num_states: number of states
+        dim_of_actions: dimension of action space
+        gamma: discount factor
+        max_iterations: cap on Bellman backups
+        '''
+        self.num_states = num_states
+        self.dim_of_actions = dim_of_actions
+        self.gamma = gamma
+        self.max_iterations = max_iterations
+        self.policy_evalutor = policy_evalutor
+
+        super(LakeTabularQIteration, self).__init__()
+
+    def run(self, dataset, epsilon=1e-8, **kw):
+        self.Q_k = self.init_Q()
+        bellman = TabularBellman(dataset, self.num_states, self.dim_of_actions, self.skim)
+        costs = np.array(dataset['cost'])[bellman.index_of_skim]
+
+        # {((x,a), c+gamma*min_a Q(x',a))}
+        next_values = lambda Q: self.gamma*Q[bellman.x_prime].min(axis=-1)
+        bellman.solve(self.Q_k, costs, next_values, max_iterations=self.max_iterations, epsilon=epsilon)
+        return self.Q_k, []
+
+    def init_Q(self, **kw):
+        return TabularQ(self.num_states, self.dim_of_actions, policy_evalutor=self.policy_evalutor)
+
+
+class LakeTabularQEvaluation(FittedAlgo):
+    def __init__(self, initial_states, num_states, dim_of_actions, gamma, max_iterations=10000):
+        '''
+        Fitted Q evaluation on the lake with a table as the regressor: the Bellman equation
+        of the policy is iterated to convergence on the (skimmed) transitions, vectorized.
+        Same interface as LakeFittedQEvaluation, including which_cost='all'.
+
+        initial_states: list of initial states
+        num_states: number of states
+        dim_of_actions: dimension of action space
+        gamma: discount factor
+        max_iterations: cap on Bellman backups
+        '''
+        self.initial_states = initial_states
+        self.num_states = num_states
+        self.dim_of_actions = dim_of_actions
+        self.gamma = gamma
+        self.max_iterations = max_iterations
+
+        super(LakeTabularQEvaluation, self).__init__()
+
+    def run(self, policy, which_cost, dataset, epsilon=1e-8, g_idx=None, **kw):
+        bellman = TabularBellman(dataset, self.num_states, self.dim_of_actions, self.skim)
+        dataset.set_cost(which_cost, idx=g_idx)
+        costs = np.array(dataset['cost'])[bellman.index_of_skim]
+        pi_of_x_prime = np.array(policy(bellman.x_prime)).astype(int).reshape(-1)
+
+        self.Q_k = self.init_Q(num_outputs=costs.shape[1] if costs.ndim > 1 else 1)
+
+        # {((x,a), c+gamma*Q(x',pi(x')))}
+        next_values = lambda Q: self.gamma*Q[bellman.x_prime, ..., pi_of_x_prime]
+
+        initial_states = np.array(self.initial_states).astype(int).reshape(-1)
+        pi_of_initial_states = np.array(policy(initial_states)).astype(int).reshape(-1)
+        value = lambda Q: np.mean(Q.Q[initial_states, ..., pi_of_initial_states], axis=0)*dataset.scale
+
+        values = bellman.solve(self.Q_k, costs, next_values, max_iterations=self.max_iterations, epsilon=epsilon, values=value)
+        return values[-1], values
+
+    def init_Q(self, num_outputs=1, **kw):
+        return TabularQ(self.num_states, self.dim_of_actions, num_outputs=num_outputs)
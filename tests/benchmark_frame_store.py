@@ -0,0 +1,89 @@
+'''
+Peak memory and batch throughput of the car dataset frames:
+eager (load everything + float32 gray copy) vs the memory-mapped FrameStore,
+gray-scaling per batch (memmap) or reading the cached gray frames (gray_cache).
+
+Run from the repo root:
+    python tests/benchmark_frame_store.py
+    python tests/benchmark_frame_store.py --mode memmap --num-batches 2000
+
+Each mode runs in its own subprocess so the peak RSS numbers don't mix.
+'''
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import resource
+import subprocess
+import argparse
+import numpy as np
+import deepdish as dd
+from frame_store import FrameStore, rgb_to_gray, gray_frame_store
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def load_eager(directory):
+    frame_data = dd.io.load(os.path.join(directory, 'car_data_frames_seed_2.h5'))
+    frame_gray_scale = np.zeros((len(frame_data),96,96)).astype('float32')
+    for i in range(len(frame_data)):
+        frame_gray_scale[i,:,:] = np.dot(frame_data[i,:,:,:]/255. , [0.299, 0.587, 0.114])
+    return frame_gray_scale
+
+
+def load_memmap(directory):
+    return FrameStore.from_h5(os.path.join(directory, 'car_data_frames_seed_2.h5'), transform=rgb_to_gray)
+
+
+def load_gray_cache(directory):
+    return gray_frame_store(os.path.join(directory, 'car_data_frames_seed_2.h5'))
+
+
+def run(mode, directory, num_batches, batch_size):
+    prev_states = dd.io.load(os.path.join(directory, 'car_data_prev_states_seed_2.h5'))
+    next_states = dd.io.load(os.path.join(directory, 'car_data_next_states_seed_2.h5'))
+
+    tic = time.time()
+    loaders = {'eager': load_eager, 'memmap': load_memmap, 'gray_cache': load_gray_cache}
+    frames = loaders[mode](directory)
+    load_time = time.time() - tic
+
+    # Same gather as Car{FittedQIteration,FittedQEvaluation}.generator
+    tic = time.time()
+    for _ in range(num_batches):
+        batch_idxs = np.random.randint(len(prev_states), size=batch_size)
+        X = np.rollaxis(frames[prev_states[batch_idxs]],1,4)
+        x_prime = np.rollaxis(frames[next_states[batch_idxs]],1,4)
+    batch_time = time.time() - tic
+
+    print '%s,%.2f,%.2f,%.2f' % (mode, load_time, num_batches/batch_time, peak_rss_mb())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the car frame store.')
+    parser.add_argument('--mode', default='all', choices=['all', 'eager', 'memmap', 'gray_cache'])
+    parser.add_argument('--directory', default='seed_2_data')
+    parser.add_argument('--num-batches', dest='num_batches', type=int, default=1000)
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    if args.mode != 'all':
+        run(args.mode, args.directory, args.num_batches, args.batch_size)
+        return
+
+    print '%-10s %12s %14s %14s' % ('mode', 'load (s)', 'batches/s', 'peak RSS (MB)')
+    for mode in ['eager', 'memmap', 'gray_cache']:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       '--mode', mode,
+                                       '--directory', args.directory,
+                                       '--num-batches', str(args.num_batches),
+                                       '--batch-size', str(args.batch_size)])
+        mode, load_time, batches_per_sec, peak = out.strip().split('\n')[-1].split(',')
+        print '%-10s %12s %14s %14s' % (mode, load_time, batches_per_sec, peak)
+
+
+if __name__ == '__main__':
+    main()
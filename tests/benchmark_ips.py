@@ -0,0 +1,155 @@
+'''
+Importance sampling estimators on synthetic lake episodes: the per-episode loops
+InversePropensityScorer used to run vs the padded trajectory tensors.
+Also checks that both give the same estimates.
+
+Run from the repo root:
+    python tests/benchmark_ips.py
+    python tests/benchmark_ips.py --num-episodes 10000 --num-bootstrap 1000
+'''
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import argparse
+import numpy as np
+from replay_buffer import Dataset
+from inverse_propensity_scoring import InversePropensityScorer, ESTIMATORS
+
+NUM_STATES = 64
+NUM_ACTIONS = 4
+GAMMA = .9
+EPSILON = .1
+
+
+class TableModel(object):
+    '''
+    Stands in for the MDPApproximator: fixed Q, V tables
+    '''
+    def __init__(self, seed=0):
+        rng = np.random.RandomState(seed)
+        self.Q_table = rng.rand(NUM_STATES, NUM_ACTIONS)
+        self.V_table = rng.rand(NUM_STATES)
+
+    def run(self, dataset):
+        pass
+
+    def values(self, policy):
+        return self.Q_table, self.V_table
+
+
+def make_dataset(num_episodes, seed=0):
+    # pi_old: state % 4, explored with EPSILON. Episodes of 5 to 60 steps
+    rng = np.random.RandomState(seed)
+    lengths = rng.randint(5, 61, size=num_episodes)
+    x = rng.randint(NUM_STATES, size=lengths.sum())
+    a = np.where(rng.rand(len(x)) < EPSILON, rng.randint(NUM_ACTIONS, size=len(x)), x % NUM_ACTIONS)
+    offsets = np.hstack([0, np.cumsum(lengths)])
+    done = np.zeros(len(x), dtype=int)
+    done[offsets[1:] - 1] = 1
+
+    dataset = Dataset(1, (1,), (2,))
+    dataset.data = {'x': x, 'a': a, 'cost': rng.rand(len(x)), 'done': done, 'episode_offsets': offsets}
+    return dataset
+
+
+def pi_old(X):
+    return np.asarray(X) % NUM_ACTIONS
+
+
+def pi_new(X):
+    # agrees with pi_old outside of a few states
+    X = np.asarray(X)
+    return np.where(X % 9 == 0, (X + 1) % NUM_ACTIONS, X % NUM_ACTIONS)
+
+
+def discounted_sum(costs, gamma):
+    return np.sum(costs * gamma**np.arange(len(costs)))
+
+
+def loop_estimates(dataset, model):
+    # the per-episode code InversePropensityScorer used to run
+    offsets = dataset.episode_offsets
+    episodes = [{key: dataset[key][low:high] for key in ['x', 'a', 'cost']} for low, high in zip(offsets[:-1], offsets[1:])]
+    max_length = max(len(episode['x']) for episode in episodes)
+
+    actions = np.eye(NUM_ACTIONS)[dataset['a']]
+    prob = {x: np.mean(actions[dataset['x'] == x], axis=0) for x in np.unique(dataset['x'])}
+
+    pi_new_a_given_x = [(pi_new(episode['x']) == episode['a']).astype(float) for episode in episodes]
+    estimates = {}
+    for kind in ['approx', 'exact']:
+        if kind == 'approx':
+            pi_old_a_given_x = [np.array([prob[x][a] for x, a in zip(episode['x'], episode['a'])]) for episode in episodes]
+        else:
+            pi_old_a_given_x = [(pi_old(episode['x']) == episode['a'])*(1-EPSILON) + (1./NUM_ACTIONS)*EPSILON for episode in episodes]
+
+        ips = 0
+        for new, old, episode in zip(pi_new_a_given_x, pi_old_a_given_x, episodes):
+            ips += np.prod(new)/np.prod(old) * discounted_sum(episode['cost'], GAMMA)
+        estimates[kind + '_ips'] = ips/len(episodes)
+
+        new_cumprod = np.array([np.pad(np.cumprod(x), (0, max_length-len(x)), 'constant', constant_values=(0, 0)) for x in pi_new_a_given_x])
+        old_cumprod = np.array([np.pad(np.cumprod(x), (0, max_length-len(x)), 'constant', constant_values=(0, 1)) for x in pi_old_a_given_x])
+        costs = np.array([np.pad(episode['cost'], (0, max_length-len(episode['cost'])), 'constant', constant_values=(0, 0)) for episode in episodes])
+        estimates[kind + '_pdis'] = discounted_sum(np.mean(new_cumprod / old_cumprod * costs, axis=0), GAMMA)
+
+        if kind == 'approx':
+            w_t = [np.cumprod(new)/np.cumprod(old) for new, old in zip(pi_new_a_given_x, pi_old_a_given_x)]
+
+    norms = np.zeros(max_length)
+    for w in w_t: norms[:len(w)] += w
+    how_many_non_zero = np.sum(norms > 0)
+    drs, wdrs = [], []
+    for w, episode in zip(w_t, episodes):
+        Q_hats = model.Q_table[episode['x'], episode['a']]
+        V_hats = model.V_table[episode['x']]
+        first_term = discounted_sum(w*episode['cost'], GAMMA)
+        drs.append(first_term - discounted_sum(w*Q_hats - np.hstack([1, w[:-1]])*V_hats, GAMMA))
+
+        how_many = min(len(w), how_many_non_zero)
+        w_ = np.hstack([w[:how_many] / norms[:how_many], np.zeros(len(w)-how_many)])
+        first_term = discounted_sum(w_*episode['cost'], GAMMA)
+        wdrs.append(first_term - discounted_sum(w_*Q_hats - np.hstack([1./len(w_t), w_[:-1]])*V_hats, GAMMA))
+    estimates['doubly_robust'] = np.mean(drs)
+    estimates['weighted_doubly_robust'] = np.sum(wdrs)
+    estimates['AM'] = model.V_table[0]
+    return estimates
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the off policy estimators.')
+    parser.add_argument('--num-episodes', dest='num_episodes', type=int, default=10000)
+    parser.add_argument('--num-bootstrap', dest='num_bootstrap', type=int, default=200)
+    args = parser.parse_args()
+
+    dataset = make_dataset(args.num_episodes)
+    model = TableModel()
+    scorer = InversePropensityScorer(None, NUM_STATES, NUM_ACTIONS, (8, 8))
+
+    tic = time.time()
+    expected = loop_estimates(dataset, model)
+    loop_time = time.time() - tic
+
+    tic = time.time()
+    got = dict(zip(ESTIMATORS, scorer.run(dataset, pi_new, pi_old, EPSILON, GAMMA, MDP_approximator=model)))
+    tensor_time = time.time() - tic
+
+    tic = time.time()
+    scorer.run(dataset, pi_new, pi_old, EPSILON, GAMMA, MDP_approximator=model, num_bootstrap=args.num_bootstrap, seed=0)
+    bootstrap_time = time.time() - tic
+
+    for name in ESTIMATORS:
+        assert np.isclose(expected[name], got[name]), '%s disagrees with the loop: %s vs %s' % (name, expected[name], got[name])
+
+    print 'Episodes: %s, transitions: %s' % (args.num_episodes, dataset.episode_offsets[-1])
+    print '%-24s %12s %24s' % ('estimator', 'estimate', '95% bootstrap interval')
+    for name in ESTIMATORS:
+        print '%-24s %12.5f %24s' % (name, got[name], '(%.5f, %.5f)' % scorer.confidence_intervals[name])
+    print '%-24s %10.3fs' % ('loop', loop_time)
+    print '%-24s %10.3fs' % ('tensors', tensor_time)
+    print '%-24s %10.3fs' % ('tensors + %s bootstrap' % args.num_bootstrap, bootstrap_time)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+'''
+Frames per second of ExtendedCarRacing's state pixels, GL (pyglet window + color
+buffer readback) vs the numpy software renderer, and env steps per second with each.
+
+Run from the repo root:
+    python tests/benchmark_software_render.py
+    python tests/benchmark_software_render.py --mode software   # no X server needed
+
+Each mode runs in its own subprocess.
+'''
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import subprocess
+import argparse
+import numpy as np
+
+
+def run(mode, num_frames):
+    if mode == 'gl':
+        from pyvirtualdisplay import Display
+        display = Display(visible=0, size=(1280, 1024))
+        display.start()
+    from car_racing import ExtendedCarRacing
+    env = ExtendedCarRacing(2, False, 50, software_render=(mode == 'software'))
+    env.reset()
+
+    rng = np.random.RandomState(0)
+    for _ in range(50): env.step((rng.uniform(-1,1), rng.rand(), 0.)) # get the car moving
+
+    tic = time.time()
+    for _ in range(num_frames):
+        env.render('state_pixels')
+    render_fps = num_frames/(time.time() - tic)
+
+    tic = time.time()
+    for _ in range(num_frames):
+        _, _, done, _ = env.step((rng.uniform(-1,1), rng.rand(), 0.))
+        if done: env.reset()
+    steps_per_sec = num_frames/(time.time() - tic)
+
+    print '%s,%.1f,%.1f' % (mode, render_fps, steps_per_sec)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the car state pixel renderers.')
+    parser.add_argument('--mode', default='all', choices=['all', 'gl', 'software'])
+    parser.add_argument('--num-frames', dest='num_frames', type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.mode != 'all':
+        run(args.mode, args.num_frames)
+        return
+
+    print '%-10s %14s %14s' % ('mode', 'frames/s', 'env steps/s')
+    for mode in ['gl', 'software']:
+        out = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                       '--mode', mode,
+                                       '--num-frames', str(args.num_frames)])
+        mode, render_fps, steps_per_sec = out.strip().split('\n')[-1].split(',')
+        print '%-10s %14s %14s' % (mode, render_fps, steps_per_sec)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+'''
+Distance from the car to the track center line: the per-segment loop
+ExtendedCarRacing.step used to run vs the TrackIndex grid query.
+Also checks that both give the same distance and closest point.
+
+Run from the repo root:
+    python tests/benchmark_track_distance.py
+    python tests/benchmark_track_distance.py --env   # env steps/s of ExtendedCarRacing, needs gym + Box2D
+'''
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import time
+import argparse
+import numpy as np
+from numpy.linalg import norm
+from track_index import TrackIndex
+
+SCALE = 6.0
+PLAYFIELD = 2000/SCALE
+TRACK_RAD = 900/SCALE
+TRACK_DETAIL_STEP = 21/SCALE
+
+
+def make_track(seed=0):
+    '''
+    A closed wobbly loop with the segment length of CarRacing tracks
+    '''
+    rng = np.random.RandomState(seed)
+    harmonics = rng.uniform(-.15, .15, size=(4,2))
+    track = []
+    theta = 0.
+    while theta < 2*np.pi:
+        r = TRACK_RAD*(1 + sum(a*np.cos((k+2)*theta) + b*np.sin((k+2)*theta) for k, (a, b) in enumerate(harmonics)))
+        track.append((theta, theta + np.pi/2, r*np.cos(theta), r*np.sin(theta)))
+        theta += TRACK_DETAIL_STEP/r
+    return track
+
+
+def distance_from_segment_to_point(A, B, P):
+    if np.all(A == P) or np.all(B == P):
+        return 0, P
+    if np.arccos(np.dot((P - A) / norm(P - A), (B - A) / norm(B - A))) > np.pi / 2:
+        return norm(P - A), A
+    if np.arccos(np.dot((P - B) / norm(P - B), (A - B) / norm(A - B))) > np.pi / 2:
+        return norm(P - B), B
+    a = B-A
+    b = P-A
+    projection = np.dot(a, b) / norm(a)**2 * a + A
+    return norm(np.cross(A-B, A-P))/norm(B-A), projection
+
+
+def loop_nearest(track, p0):
+    # the loop ExtendedCarRacing.step used to run
+    best, best_point = np.inf, None
+    for idx in range(len(track)):
+        alpha1, beta1, x2, y2 = track[idx]
+        alpha2, beta2, x1, y1 = track[idx-1]
+        p1 = np.array([x1,y1])
+        p2 = np.array([x2,y2])
+        if norm(p2-p0) <= best + 10:
+            distance, point = distance_from_segment_to_point(p1,p2,p0)
+            if distance < best:
+                best, best_point = distance, point
+    return best, best_point
+
+
+def positions(track, num_points, seed=1):
+    # mostly on or near the road, some far off it
+    rng = np.random.RandomState(seed)
+    points = np.array(track)[rng.randint(len(track), size=num_points), 2:4]
+    points += rng.normal(scale=8., size=points.shape)
+    far = rng.rand(num_points) < .1
+    points[far] = rng.uniform(-PLAYFIELD*1.05, PLAYFIELD*1.05, size=(far.sum(), 2))
+    return points
+
+
+def bench_queries(num_points):
+    track = make_track()
+    tic = time.time()
+    index = TrackIndex(track, PLAYFIELD)
+    build_time = time.time() - tic
+    points = positions(track, num_points)
+
+    tic = time.time()
+    expected = [loop_nearest(track, p) for p in points]
+    loop_time = time.time() - tic
+
+    tic = time.time()
+    got = [index.nearest(p) for p in points]
+    index_time = time.time() - tic
+
+    for (d1, p1), (d2, p2) in zip(expected, got):
+        assert np.isclose(d1, d2) and np.allclose(p1, p2), 'TrackIndex disagrees with the loop'
+
+    print 'Track: %s segments. Index build: %.3fs, %s candidates per cell on average' % (len(track), build_time, len(index.segments)/float(index.num_cells**2))
+    print '%-8s %14s' % ('method', 'queries/s')
+    print '%-8s %14.1f' % ('loop', num_points/loop_time)
+    print '%-8s %14.1f' % ('index', num_points/index_time)
+
+
+def bench_env(num_steps):
+    from pyvirtualdisplay import Display
+    display = Display(visible=0, size=(1280, 1024))
+    display.start()
+    from car_racing import ExtendedCarRacing
+    env = ExtendedCarRacing(2, False, 50)
+    rng = np.random.RandomState(0)
+    tic = time.time()
+    for _ in range(num_steps):
+        _, _, done, _ = env.step((rng.uniform(-1,1), rng.rand(), 0.))
+        if done: env.reset()
+    print 'ExtendedCarRacing: %.1f steps/s' % (num_steps/(time.time() - tic))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the distance to the track center.')
+    parser.add_argument('--num-points', dest='num_points', type=int, default=5000)
+    parser.add_argument('--env', dest='env', action='store_true', help='Also time env steps')
+    parser.add_argument('--num-steps', dest='num_steps', type=int, default=2000)
+    args = parser.parse_args()
+
+    bench_queries(args.num_points)
+    if args.env: bench_env(args.num_steps)
+
+
+if __name__ == '__main__':
+    main()
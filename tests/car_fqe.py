@@ -3,6 +3,7 @@
 # display.start()
 import deepdish as dd
 from replay_buffer import Dataset
+from frame_store import gray_frame_store
 from config_car import *
 import os
 import numpy as np
@@ -14,16 +15,13 @@ np.random.seed(2718)
 which_pi = './videos/ohio/run_1/pi_1.hdf5'
 directory = 'seed_2_data'
 action_data = dd.io.load(os.path.join(os.getcwd(), directory, 'car_data_actions_seed_2.h5'))
-frame_data = dd.io.load(os.path.join(os.getcwd(), directory, 'car_data_frames_seed_2.h5'))
 done_data = dd.io.load(os.path.join(os.getcwd(), directory, 'car_data_is_done_seed_2.h5'))
 next_state_data = dd.io.load(os.path.join(os.getcwd(), directory, 'car_data_next_states_seed_2.h5'))
 current_state_data = dd.io.load(os.path.join(os.getcwd(), directory, 'car_data_prev_states_seed_2.h5'))
 cost_data = dd.io.load(os.path.join(os.getcwd(), directory, 'car_data_rewards_seed_2.h5'))
 
 
-frame_gray_scale = np.zeros((len(frame_data),96,96)).astype('float32')
-for i in range(len(frame_data)):
-    frame_gray_scale[i,:,:] = np.dot(frame_data[i,:,:,:]/255. , [0.299, 0.587, 0.114])
+frame_gray_scale = gray_frame_store(os.path.join(os.getcwd(), directory, 'car_data_frames_seed_2.h5'), num_workers=gray_scale_workers)
 
 dic = {'frames':frame_gray_scale,
             'prev_states': current_state_data,
@@ -40,12 +38,10 @@ EVALUATING = 'c'
 
 
 def sample_N_trajectories(dataset, N):
-    dones = np.where(dataset['done'])[0]
-    dones = np.hstack([[0], dones])
-    trajectory_idxs = zip(dones[:-1], dones[1:])
-    N = min(len(trajectory_idxs), N)
-    idxs = np.random.choice(len(trajectory_idxs), size=N, replace=False)
-    return np.array(trajectory_idxs)[idxs]
+    offsets = dataset.episode_offsets
+    N = min(dataset.num_episodes(), N)
+    idxs = np.random.choice(dataset.num_episodes(), size=N, replace=False)
+    return np.vstack([offsets[idxs], offsets[idxs+1]]).T
 
 
 def create_trajectories(dataset, N):
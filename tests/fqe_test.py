@@ -16,6 +16,7 @@ import deepdish as dd
 from keras.models import load_model
 import time
 from replay_buffer import Dataset
+from frame_store import gray_frame_store
 from stochastic_policy import StochasticPolicy
 
 
@@ -53,16 +54,13 @@ print exact_policy_algorithm.run(policy_old.Q, to_monitor=False)
 
 tic = time.time()
 action_data = dd.io.load('./seed_2/car_data_actions_seed_2.h5')
-frame_data = dd.io.load('./seed_2/car_data_frames_seed_2.h5')
 done_data = dd.io.load('./seed_2/car_data_is_done_seed_2.h5')
 next_state_data = dd.io.load('./seed_2/car_data_next_states_seed_2.h5')
 current_state_data = dd.io.load('./seed_2/car_data_prev_states_seed_2.h5')
 cost_data = dd.io.load('./seed_2/car_data_rewards_seed_2.h5')
 
 
-frame_gray_scale = np.zeros((len(frame_data),96,96)).astype('float32')
-for i in range(len(frame_data)):
-    frame_gray_scale[i,:,:] = np.dot(frame_data[i,:,:,:]/255. , [0.299, 0.587, 0.114])
+frame_gray_scale = gray_frame_store('./seed_2/car_data_frames_seed_2.h5', num_workers=gray_scale_workers)
 
 dic = {'frames':frame_gray_scale,
             'prev_states': current_state_data,
@@ -0,0 +1,53 @@
+'''
+Pixel parity of ExtendedCarRacing's software state pixels with the GL ones.
+
+Two envs on the same track take the same random actions; every state is compared,
+the score digits included (seven segment glyphs on the software side, so a few of
+their pixels may differ from pyglet's text).
+
+Run from the repo root (needs gym, Box2D, pyglet and an X server or pyvirtualdisplay):
+    python tests/software_render_parity.py
+'''
+import os
+import sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import argparse
+import numpy as np
+from pyvirtualdisplay import Display
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare software and GL state pixels.')
+    parser.add_argument('--num-steps', dest='num_steps', type=int, default=500)
+    parser.add_argument('--max-mismatch', dest='max_mismatch', type=float, default=.01,
+                        help='Largest allowed fraction of differing pixels per frame')
+    args = parser.parse_args()
+
+    display = Display(visible=0, size=(1280, 1024))
+    display.start()
+    from car_racing import ExtendedCarRacing
+
+    gl_env = ExtendedCarRacing(2, False, 50)
+    software_env = ExtendedCarRacing(2, False, 50, software_render=True)
+
+    rng = np.random.RandomState(0)
+    x_gl, x_software = gl_env.reset(), software_env.reset()
+    mismatches = []
+    for step in range(args.num_steps):
+        differs = np.any(x_gl != x_software, axis=-1)
+        mismatches.append(differs.mean())
+        assert mismatches[-1] <= args.max_mismatch, 'Step %s: %.2f%% of the pixels differ' % (step, 100*mismatches[-1])
+
+        action = (rng.uniform(-1,1), rng.rand(), .2*rng.rand())
+        x_gl, _, done_gl, _ = gl_env.step(action)
+        x_software, _, done_software, _ = software_env.step(action)
+        assert done_gl == done_software
+        if done_gl:
+            x_gl, x_software = gl_env.reset(), software_env.reset()
+
+    print 'Pixels differing per frame: mean %.3f%%, max %.3f%%, identical frames %.1f%%' % (
+        100*np.mean(mismatches), 100*np.max(mismatches), 100*np.mean(np.array(mismatches) == 0))
+
+
+if __name__ == '__main__':
+    main()
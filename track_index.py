@@ -0,0 +1,73 @@
+import numpy as np
+
+
+def distances_to_segments(A, B, P):
+    '''
+    Distances from the points P (N,2) to the segments AB (M,2), (M,2), and the closest points.
+    Returns (N,M) distances, (N,M,2) closest points
+    '''
+    AB = B - A
+    AP = P[:, np.newaxis, :] - A[np.newaxis, :, :]
+    length_sq = np.sum(AB**2, axis=1)
+    t = np.clip(np.sum(AP*AB, axis=2) / np.maximum(length_sq, 1e-12), 0., 1.)
+    closest = A[np.newaxis] + t[..., np.newaxis]*AB[np.newaxis]
+    return np.sqrt(np.sum((P[:, np.newaxis, :] - closest)**2, axis=2)), closest
+
+
+class TrackIndex(object):
+    def __init__(self, track, extent, cell_size=10., offsets=None, segments=None):
+        '''
+        Nearest track segment queries on a uniform grid, built once per track.
+
+        Segment i goes from track[i-1] to track[i] (x, y are the last two entries
+        of a track tuple). Every cell keeps the segments that can be the nearest one
+        to some point of the cell: those within min distance + cell diagonal of its center.
+        Queries outside the grid check every segment.
+
+        track: list of (alpha, beta, x, y)
+        extent: the grid covers [-extent, extent]^2
+        cell_size: side of a grid cell
+        offsets, segments: the grid of an earlier TrackIndex of the same track, skips building it
+        '''
+        points = np.array(track, dtype=float)[:, 2:4]
+        self.B = points
+        self.A = np.roll(points, 1, axis=0)
+        self.extent = float(extent)
+        self.cell_size = float(cell_size)
+        self.num_cells = int(np.ceil(2*self.extent/self.cell_size))
+        self.all_segments = np.arange(len(self.A))
+        if offsets is not None:
+            self.offsets, self.segments = np.asarray(offsets), np.asarray(segments)
+            return
+
+        centers = (np.arange(self.num_cells) + .5)*self.cell_size - self.extent
+        cx, cy = np.meshgrid(centers, centers, indexing='ij')
+        centers = np.vstack([cx.ravel(), cy.ravel()]).T
+
+        candidates = []
+        for chunk in range(0, len(centers), 512):
+            distances, _ = distances_to_segments(self.A, self.B, centers[chunk:(chunk+512)])
+            within = distances <= (distances.min(axis=1, keepdims=True) + np.sqrt(2)*self.cell_size + 1e-9)
+            candidates.extend([np.nonzero(row)[0] for row in within])
+
+        # csr layout: cell k owns segments[offsets[k]:offsets[k+1]]
+        self.offsets = np.hstack([0, np.cumsum([len(c) for c in candidates])]).astype(int)
+        self.segments = np.hstack(candidates).astype(int)
+
+    def cell_of(self, p):
+        i, j = np.floor((np.asarray(p, dtype=float) + self.extent)/self.cell_size).astype(int)
+        if (0 <= i < self.num_cells) and (0 <= j < self.num_cells):
+            return i*self.num_cells + j
+        return None
+
+    def nearest(self, p):
+        '''
+        Distance from p to the track center line and the closest point on it.
+        Ties go to the lowest segment index
+        '''
+        p = np.asarray(p, dtype=float)
+        cell = self.cell_of(p)
+        segments = self.all_segments if cell is None else self.segments[self.offsets[cell]:self.offsets[cell+1]]
+        distances, closest = distances_to_segments(self.A[segments], self.B[segments], p[np.newaxis])
+        best = np.argmin(distances[0])
+        return distances[0, best], closest[0, best]
@@ -0,0 +1,93 @@
+import time
+import numpy as np
+
+
+def exploration_schedule(num_episodes, rate=3.):
+    '''
+    Exploration probability 1 - exp(-rate*i/num_episodes) of episode i
+    '''
+    def epsilon(i):
+        return 1.-np.exp(-rate*(i/float(num_episodes)))
+    return epsilon
+
+
+class VectorCollector(object):
+    def __init__(self, envs, policy, dataset, action_space_map, num_constraints=None, epsilon_schedule=None, render=False):
+        '''
+        Collects episodes on the K replicas of an EnvPool in lockstep. Every step the
+        K current states go through the policy in one batch, and the transitions are
+        written into the dataset's buffer as they come (each running episode keeps its own
+        frame window, see Dataset.use_episode).
+
+        envs: EnvPool
+        policy: policy(list of states) -> actions, e.g. a StochasticPolicy
+        dataset: Dataset to fill
+        action_space_map: action index -> env action
+        num_constraints: g is padded with zeros up to this length
+        epsilon_schedule: function episode number -> exploration probability of policy in that episode
+        render: env.render() every step. Only for a pool holding the env itself
+        '''
+        self.envs = envs
+        self.policy = policy
+        self.dataset = dataset
+        self.action_space_map = action_space_map
+        self.num_constraints = num_constraints
+        self.epsilon_schedule = epsilon_schedule
+        self.render = render
+
+    def collect(self, num_episodes, seed=None, verbose=True):
+        '''
+        Runs num_episodes episodes. Returns the number of transitions collected.
+
+        seed: episode i seeds its replica with seed+i (None: replicas are not reseeded)
+        '''
+        running = {}   # replica -> [episode, time_steps, episode_cost]
+        next_episode = 0
+        dataset_size = 0
+        main_tic = time.time()
+        while (next_episode < num_episodes) or running:
+            free = [idx for idx in range(self.envs.num_envs) if idx not in running][:num_episodes-next_episode]
+            seeds = None if seed is None else [seed + next_episode + k for k in range(len(free))]
+            for idx, x in zip(free, self.envs.reset(free, seeds) if free else []):
+                self.dataset.start_new_episode(x, episode=idx)
+                running[idx] = [next_episode, 0, 0.]
+                next_episode += 1
+                dataset_size += 1
+
+            idxs = sorted(running)
+            if self.render: self.envs.envs[0].render()
+            if self.epsilon_schedule is not None:
+                self.policy.epsilon = np.array([self.epsilon_schedule(running[idx][0]) for idx in idxs])
+            actions = self.policy([self.dataset.current_state(episode=idx) for idx in idxs], x_preprocessed=False)
+
+            for idx in idxs: running[idx][1] += 1
+            outputs = self.envs.step(idxs,
+                                     [self.action_space_map[action] for action in actions],
+                                     [running[idx][1] for idx in idxs],
+                                     [running[idx][2] for idx in idxs])
+
+            for idx, action, (x_prime, cost, done, early_done, punishment) in zip(idxs, actions, outputs):
+                done = done or early_done
+                running[idx][2] += cost[0] + punishment
+                c = (cost[0] + punishment).tolist()
+                g = cost[1:].tolist()
+                if (self.num_constraints is not None) and (len(g) < self.num_constraints): g = np.hstack([g, [0]*(self.num_constraints-len(g))])
+                self.dataset.append(action,
+                                    x_prime,
+                                    np.hstack([c,g]).reshape(-1).tolist(),
+                                    done,
+                                    episode=idx) #{(x,a,x',c(x,a), g(x,a)^T, done)}
+                dataset_size += 1
+
+                if done:
+                    if verbose:
+                        print 'Episode: %s. Exploration probability: %s' % (running[idx][0], np.round(self.epsilon_schedule(running[idx][0]) if self.epsilon_schedule is not None else self.policy.epsilon, 5))
+                        print 'Dataset size: %s. Total time: %s' % (dataset_size, time.time()-main_tic)
+                        if self.envs.get(idx, 'env_type') == 'car':
+                            tiles, track = self.envs.get(idx, 'tile_visited_count'), self.envs.get(idx, 'track')
+                            print 'Performance: %s/%s = %s' % (tiles, len(track), tiles/float(len(track)))
+                        print '*'*20
+                    del running[idx]
+
+        self.dataset.use_episode(None)
+        return dataset_size